@@ -0,0 +1,449 @@
+# Medição de desempenho das operações de reserva.
+#
+# Popula um banco separado com uma quantidade configurável de reservas,
+# espalhadas por muitas viagens (um dia após o outro, em todos os horários
+# da rota padrão), e mede a latência (percentis) e a vazão das operações
+# usadas pelos guichês: ocupação do mapa, disponibilidade dos horários,
+# calendário, clique em um assento, reserva, cancelamento e pesquisa. Com
+# vários volumes ('--reservas 10000,100000,1000000'), a carga continua de
+# onde parou e as operações são medidas em cada volume. Com um display
+# disponível (ou um servidor X virtual, como o Xvfb), mede também o tempo
+# de desenho do mapa de assentos da JanelaPrincipal em várias capacidades.
+#
+# O resultado é gravado em JSON, para comparar versões:
+#     python benchmark_reservas.py --reservas 10000,100000 --saida atual.json
+#     python benchmark_reservas.py --comparar anterior.json atual.json
+# A comparação termina com erro quando alguma operação ficou mais lenta
+# que a tolerância.
+#
+# Com '--banco mongo' (padrão), usa o MongoDB de MONGO_URI, no banco
+# informado em '--nome-banco', que é apagado no início e no fim (exceto
+# com '--manter'). Com '--banco local', usa um arquivo SQLite temporário
+# ('OnibusLocal'), sem precisar de servidor.
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from reserva_passagens import (FORMATO_DATA, HORARIOS_PADRAO, ROTA_PADRAO,
+                               TEMPO_LIMITE_CONEXAO_MS, MapaOcupacao, Onibus, OnibusLocal)
+
+# Volumes, capacidade dos veículos e fração dos lugares de cada viagem
+# ocupada pela carga. Os lugares que sobram são usados para medir a
+# reserva e o cancelamento.
+VOLUMES_PADRAO = [10000, 100000]
+CAPACIDADE_BENCHMARK = 40
+OCUPACAO_BENCHMARK = 0.8
+
+# Quantidade de medições de cada operação em cada volume.
+REPETICOES_BENCHMARK = 200
+
+# Capacidades dos mapas de assentos desenhados na medição da interface.
+CAPACIDADES_MAPA = [20, 40, 60, 100]
+
+# Quantidade de reservas enviadas por vez a 'reservar_lugares' na carga.
+TAMANHO_LOTE_CARGA = 1000
+
+# Primeiro dia das viagens da carga. Um volume de 10 milhões de reservas
+# ocupa cerca de 120 anos de viagens.
+INICIO_CARGA = date(2000, 1, 1)
+
+# Banco do MongoDB usado por padrão; nunca o banco dos guichês.
+BANCO_BENCHMARK = "reserva_onibus_benchmark"
+
+# Percentis gravados para cada operação.
+PERCENTIS = [50, 90, 95, 99]
+
+# Aumento máximo aceito (em fração) da mediana e do percentil 95 de uma
+# operação ao comparar dois resultados.
+TOLERANCIA_COMPARACAO = 0.2
+
+
+# Define a função 'resumir_tempos', que converte uma lista de durações (em
+# segundos) em um dicionário com os percentis, a média e o máximo (em
+# milissegundos) e a vazão (operações por segundo, executadas em sequência).
+def resumir_tempos(tempos):
+    ordenados = sorted(tempos)
+    total = sum(ordenados)
+    resumo = {"medicoes": len(ordenados)}
+    for p in PERCENTIS:
+        # Percentil pelo método do posto mais próximo.
+        posto = max(1, math.ceil(p / 100 * len(ordenados)))
+        resumo[f"p{p}_ms"] = round(ordenados[posto - 1] * 1000, 3)
+    resumo["media_ms"] = round(total / len(ordenados) * 1000, 3)
+    resumo["max_ms"] = round(ordenados[-1] * 1000, 3)
+    resumo["operacoes_por_segundo"] = round(len(ordenados) / total, 1) if total else None
+    return resumo
+
+
+# Define a função 'medir', que executa 'funcao(*args)' e retorna a
+# duração em segundos.
+def medir(funcao, *args):
+    inicio = time.perf_counter()
+    funcao(*args)
+    return time.perf_counter() - inicio
+
+
+# Define a classe 'CargaReservas', que gera as reservas da carga. A reserva
+# de número 'i' é sempre a mesma (viagem, lugar, nome e CPF), então a
+# carga pode continuar de onde parou e dois resultados medidos com os
+# mesmos parâmetros usam os mesmos dados.
+class CargaReservas:
+
+    def __init__(self, capacidade, ocupacao):
+        self.capacidade = capacidade
+        self.horarios = HORARIOS_PADRAO
+
+        # Lugares ocupados em cada viagem: de 1 até 'por_viagem'.
+        self.por_viagem = max(1, min(capacidade, int(capacidade * ocupacao)))
+
+        # Quantidade de reservas já gravadas.
+        self.gravadas = 0
+
+    # Retorna o dia e o horário da viagem de número 't'.
+    def viagem(self, t):
+        dia = INICIO_CARGA + timedelta(days=t // len(self.horarios))
+        return dia.strftime(FORMATO_DATA), self.horarios[t % len(self.horarios)]
+
+    def reserva(self, i):
+        dia, horario = self.viagem(i // self.por_viagem)
+        return (i % self.por_viagem + 1, f"Passageiro {i:09d}", f"{i:011d}",
+                dia, horario, ROTA_PADRAO)
+
+    # Viagens com todos os 'por_viagem' lugares já gravados.
+    def viagens_completas(self):
+        return max(1, self.gravadas // self.por_viagem)
+
+    # Último dia com reservas gravadas.
+    def ultimo_dia(self):
+        return INICIO_CARGA + timedelta(days=(self.gravadas - 1) // self.por_viagem
+                                        // len(self.horarios))
+
+    # Grava as reservas até completar 'volume', em lotes, e retorna a
+    # duração em segundos.
+    def gravar(self, onibus, volume):
+        inicio = time.perf_counter()
+        while self.gravadas < volume:
+            fim = min(volume, self.gravadas + TAMANHO_LOTE_CARGA)
+            resultados = onibus.reservar_lugares([self.reserva(i)
+                                                  for i in range(self.gravadas, fim)])
+            recusadas = [mensagem for reservado, mensagem in resultados if not reservado]
+            if recusadas:
+                raise RuntimeError(f"A carga foi recusada pelo banco: {recusadas[0]}")
+            self.gravadas = fim
+            print(f"\rReservas gravadas: {self.gravadas}/{volume}", end="", flush=True)
+        print()
+        return time.perf_counter() - inicio
+
+
+# Define a função 'medir_operacoes', que mede cada operação 'repeticoes'
+# vezes, em viagens e lugares sorteados entre os já gravados. A reserva é
+# feita em um lugar livre de uma viagem da carga e cancelada em seguida,
+# então o banco termina a medição como começou.
+def medir_operacoes(onibus, carga, repeticoes, sorteio):
+
+    tempos = {nome: [] for nome in (
+        "consultar_ocupacao", "consultar_ocupacao_cache", "disponibilidade_dia",
+        "ocupacao_mes", "buscar_reserva", "reservar_lugar", "cancelar_reserva",
+        "pesquisa_cpf", "pesquisa_nome", "pesquisa_dia", "pesquisa_todas",
+        "pesquisa_proxima_pagina",
+    )}
+
+    ultimo_dia = carga.ultimo_dia()
+    dias = (ultimo_dia - INICIO_CARGA).days + 1
+    cursor = None
+
+    for _ in range(repeticoes):
+        t = sorteio.randrange(carga.viagens_completas())
+        dia, horario = carga.viagem(t)
+        i = sorteio.randrange(carga.gravadas)
+        _, nome, cpf, _, _, _ = carga.reserva(i)
+        data = INICIO_CARGA + timedelta(days=sorteio.randrange(dias))
+
+        # Mapa de assentos: sem o cache, como na primeira vez em que a
+        # viagem é exibida, e com o cache.
+        onibus.cache_ocupacao.invalidar()
+        tempos["consultar_ocupacao"].append(
+            medir(onibus.consultar_ocupacao, dia, horario, ROTA_PADRAO))
+        tempos["consultar_ocupacao_cache"].append(
+            medir(onibus.consultar_ocupacao, dia, horario, ROTA_PADRAO))
+
+        # Disponibilidade dos horários de um dia e cores do calendário.
+        tempos["disponibilidade_dia"].append(
+            medir(onibus.resumos_periodo, data, data, ROTA_PADRAO))
+        tempos["ocupacao_mes"].append(
+            medir(onibus.ocupacao_mes, data.year, data.month, ROTA_PADRAO))
+
+        # Clique em um assento ocupado.
+        tempos["buscar_reserva"].append(
+            medir(onibus.buscar_reserva, sorteio.randint(1, carga.por_viagem), dia, horario,
+                  ROTA_PADRAO))
+
+        # Reserva e cancelamento de um lugar livre. Sem lugares livres na
+        # carga, usa as viagens seguintes, ainda vazias.
+        if carga.por_viagem < carga.capacidade:
+            lugar = sorteio.randint(carga.por_viagem + 1, carga.capacidade)
+        else:
+            lugar = sorteio.randint(1, carga.capacidade)
+            dia, horario = carga.viagem(carga.viagens_completas() + 1 + t)
+        tempos["reservar_lugar"].append(
+            medir(onibus.reservar_lugar, lugar, "Passageiro Benchmark", "00000000000",
+                  dia, horario, ROTA_PADRAO))
+        tempos["cancelar_reserva"].append(
+            medir(onibus.cancelar_reserva, lugar, dia, horario, ROTA_PADRAO))
+
+        # Pesquisas da JanelaPesquisa ('filtrar_reservas'): por CPF, por
+        # prefixo do nome (cerca de cem reservas), por dia, sem filtros e
+        # as páginas seguintes, percorridas em sequência.
+        tempos["pesquisa_cpf"].append(medir(onibus.pesquisar_reservas, {"cpf": cpf}))
+        tempos["pesquisa_nome"].append(medir(onibus.pesquisar_reservas, {"nome": nome[:-2]}))
+        tempos["pesquisa_dia"].append(
+            medir(onibus.pesquisar_reservas, {"dia": data.strftime(FORMATO_DATA)}))
+        tempos["pesquisa_todas"].append(medir(onibus.pesquisar_reservas, {}))
+
+        inicio = time.perf_counter()
+        _, cursor = onibus.pesquisar_reservas({}, cursor)
+        tempos["pesquisa_proxima_pagina"].append(time.perf_counter() - inicio)
+
+    return {nome: resumir_tempos(lista) for nome, lista in tempos.items()}
+
+
+# Define a função 'medir_mapa', que mede na JanelaPrincipal o desenho do
+# mapa de assentos ('exibir_ocupacao', a parte de 'atualizar_mapa' feita
+# na thread da interface) para cada capacidade: com a criação dos botões
+# (troca de veículo) e apenas com a troca das cores (outra viagem do mesmo
+# veículo). Sem display, retorna o erro do Tk.
+def medir_mapa(onibus, capacidades, repeticoes, sorteio):
+
+    # Importado apenas aqui, pois a medição do banco não precisa da interface.
+    import tkinter as tk
+    from reserva_passagens import JanelaPrincipal
+
+    # Sem a assinatura da viagem exibida, que consultaria o banco.
+    os.environ["MAPA_AO_VIVO"] = "0"
+
+    try:
+        janela = tk.Tk()
+    except tk.TclError as e:
+        print(f"Medição do mapa ignorada: {e}")
+        return {"erro": str(e)}
+
+    try:
+        app = JanelaPrincipal(janela, onibus)
+        janela.update()
+
+        resultado = {}
+        for capacidade in capacidades:
+            veiculo = {"_id": "BENCHMARK", "descricao": f"{capacidade} lugares",
+                       "capacidade": capacidade, "colunas": 2}
+            construir = []
+            colorir = []
+
+            for n in range(repeticoes):
+                lugares = MapaOcupacao(capacidade, sorteio.getrandbits(capacidade))
+                viagem = (f"{n % 28 + 1:02d}/01/2000", HORARIOS_PADRAO[0], ROTA_PADRAO)
+
+                # Esquece o layout exibido, para que os botões sejam recriados.
+                app.colunas_mapa = None
+                inicio = time.perf_counter()
+                app.exibir_ocupacao(*viagem, veiculo, lugares)
+                janela.update_idletasks()
+                construir.append(time.perf_counter() - inicio)
+
+                lugares = MapaOcupacao(capacidade, sorteio.getrandbits(capacidade))
+                viagem = (viagem[0], HORARIOS_PADRAO[1], ROTA_PADRAO)
+                inicio = time.perf_counter()
+                app.exibir_ocupacao(*viagem, veiculo, lugares)
+                janela.update_idletasks()
+                colorir.append(time.perf_counter() - inicio)
+
+            resultado[str(capacidade)] = {"construir": resumir_tempos(construir),
+                                          "atualizar": resumir_tempos(colorir)}
+        return resultado
+
+    finally:
+        janela.destroy()
+
+
+# Define a função 'abrir_onibus', que cria o banco vazio da medição e
+# retorna o objeto 'onibus' e a função que o apaga no fim.
+def abrir_onibus(argumentos):
+
+    if argumentos.banco == "local":
+        pasta = tempfile.mkdtemp(prefix="benchmark_reservas_")
+        caminho = os.path.join(pasta, "reservas.db")
+        onibus = OnibusLocal(caminho, capacidade_padrao=argumentos.capacidade)
+
+        def apagar():
+            for nome in os.listdir(pasta):
+                os.remove(os.path.join(pasta, nome))
+            os.rmdir(pasta)
+
+        return onibus, apagar
+
+    if argumentos.nome_banco == "reserva_onibus_db":
+        sys.exit("Use um banco separado para o benchmark (--nome-banco), "
+                 "pois ele é apagado no início e no fim.")
+
+    # Importado apenas aqui, pois o banco local não precisa do pymongo.
+    from pymongo import MongoClient
+
+    cliente = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/'),
+                          serverSelectionTimeoutMS=TEMPO_LIMITE_CONEXAO_MS)
+    cliente.drop_database(argumentos.nome_banco)
+
+    os.environ["MONGO_BANCO"] = argumentos.nome_banco
+    onibus = Onibus(capacidade_padrao=argumentos.capacidade)
+
+    def apagar():
+        cliente.drop_database(argumentos.nome_banco)
+        cliente.close()
+        onibus.cliente.close()
+
+    return onibus, apagar
+
+
+# Retorna o commit atual do repositório, gravado no resultado para
+# identificar a versão medida, ou None fora de um repositório git.
+def versao_codigo():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def executar(argumentos):
+
+    sorteio = random.Random(argumentos.semente)
+    onibus, apagar = abrir_onibus(argumentos)
+    carga = CargaReservas(argumentos.capacidade, argumentos.ocupacao)
+
+    resultado = {
+        "versao": versao_codigo(),
+        "gerado_em": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "parametros": {
+            "banco": argumentos.banco,
+            "capacidade": argumentos.capacidade,
+            "ocupacao": argumentos.ocupacao,
+            "repeticoes": argumentos.repeticoes,
+            "semente": argumentos.semente,
+        },
+        "volumes": [],
+    }
+
+    try:
+        for volume in argumentos.reservas:
+            duracao = carga.gravar(onibus, volume)
+            print(f"Medindo as operações com {volume} reservas...")
+            resultado["volumes"].append({
+                "reservas": volume,
+                "viagens": math.ceil(volume / carga.por_viagem),
+                "carga_segundos": round(duracao, 3),
+                "operacoes": medir_operacoes(onibus, carga, argumentos.repeticoes, sorteio),
+            })
+
+        if argumentos.capacidades_mapa:
+            print("Medindo o desenho do mapa de assentos...")
+            resultado["mapa"] = medir_mapa(onibus, argumentos.capacidades_mapa,
+                                           argumentos.repeticoes, sorteio)
+    finally:
+        if not argumentos.manter:
+            apagar()
+
+    with open(argumentos.saida, "w", encoding="utf-8") as arquivo:
+        json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+    print(f"Resultado gravado em {argumentos.saida}")
+
+
+# Define a função 'tempos_resultado', que achata um resultado em
+# {(volume, operação): resumo}, incluindo as medições do mapa.
+def tempos_resultado(resultado):
+    tempos = {}
+    for volume in resultado["volumes"]:
+        for operacao, resumo in volume["operacoes"].items():
+            tempos[(str(volume["reservas"]), operacao)] = resumo
+    for capacidade, medicoes in resultado.get("mapa", {}).items():
+        if isinstance(medicoes, dict):
+            for etapa, resumo in medicoes.items():
+                tempos[("mapa", f"{etapa}_{capacidade}")] = resumo
+    return tempos
+
+
+# Define a função 'comparar', que mostra a variação da mediana e do
+# percentil 95 de cada operação medida nos dois resultados. Retorna o
+# código de saída: 1 se alguma operação piorou mais que a tolerância.
+def comparar(anterior, atual, tolerancia):
+
+    with open(anterior, encoding="utf-8") as arquivo:
+        antes = json.load(arquivo)
+    with open(atual, encoding="utf-8") as arquivo:
+        depois = json.load(arquivo)
+
+    print(f"{antes.get('versao')} -> {depois.get('versao')}")
+
+    tempos_antes = tempos_resultado(antes)
+    pioraram = 0
+    for chave, resumo in tempos_resultado(depois).items():
+        if chave not in tempos_antes:
+            continue
+        linha = f"{chave[0]:>10} {chave[1]:<26}"
+        for medida in ("p50_ms", "p95_ms"):
+            valor_antes = tempos_antes[chave][medida]
+            variacao = (resumo[medida] - valor_antes) / valor_antes if valor_antes else 0
+            linha += f" {medida} {valor_antes:9.3f} -> {resumo[medida]:9.3f} ({variacao:+7.1%})"
+            if variacao > tolerancia:
+                pioraram += 1
+                linha += " PIOROU"
+        print(linha)
+
+    if pioraram:
+        print(f"{pioraram} medida(s) piorou(aram) mais de {tolerancia:.0%}.")
+        return 1
+    return 0
+
+
+def lista_inteiros(texto):
+    return [int(valor) for valor in texto.split(",") if valor.strip()]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Mede o desempenho das operações de reserva.")
+    parser.add_argument("--banco", choices=["mongo", "local"], default="mongo",
+                        help="MongoDB de MONGO_URI ou arquivo SQLite temporário")
+    parser.add_argument("--nome-banco", default=BANCO_BENCHMARK,
+                        help="banco do MongoDB usado (apagado no início e no fim)")
+    parser.add_argument("--reservas", type=lista_inteiros, default=VOLUMES_PADRAO,
+                        help="volumes medidos, separados por vírgula")
+    parser.add_argument("--capacidade", type=int, default=CAPACIDADE_BENCHMARK)
+    parser.add_argument("--ocupacao", type=float, default=OCUPACAO_BENCHMARK,
+                        help="fração dos lugares de cada viagem ocupada pela carga")
+    parser.add_argument("--repeticoes", type=int, default=REPETICOES_BENCHMARK)
+    parser.add_argument("--capacidades-mapa", type=lista_inteiros, default=CAPACIDADES_MAPA,
+                        help="capacidades do mapa de assentos desenhado (vazio para não medir)")
+    parser.add_argument("--semente", type=int, default=1)
+    parser.add_argument("--manter", action="store_true",
+                        help="não apaga o banco da medição no fim")
+    parser.add_argument("--saida", default="benchmark_reservas.json")
+    parser.add_argument("--comparar", nargs=2, metavar=("ANTERIOR", "ATUAL"),
+                        help="compara dois resultados em vez de medir")
+    parser.add_argument("--tolerancia", type=float, default=TOLERANCIA_COMPARACAO)
+    argumentos = parser.parse_args()
+
+    if argumentos.comparar:
+        sys.exit(comparar(*argumentos.comparar, argumentos.tolerancia))
+
+    argumentos.reservas.sort()
+    executar(argumentos)
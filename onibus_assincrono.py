@@ -0,0 +1,553 @@
+# Acesso assíncrono ao banco de dados de reservas.
+#
+# A classe 'OnibusAssincrono' oferece as mesmas operações da classe
+# 'Onibus' (reserva_passagens.py), com os mesmos parâmetros e resultados,
+# mas como corrotinas sobre o driver assíncrono do MongoDB (motor). Uma
+# consulta em andamento não ocupa uma thread, então um único processo
+# atende milhares de consultas de disponibilidade ao mesmo tempo.
+#
+# É usada pelo serviço HTTP quando BANCO_ASSINCRONO=1. A preparação da
+# base feita pelo 'Onibus' ao iniciar (migrações de reservas antigas e
+# remoção de índices obsoletos) continua sendo feita pelo 'Onibus' e pelas
+# ferramentas de linha de comando de reserva_passagens.py.
+
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+
+from reserva_passagens import (
+    CAMPOS_RESERVA,
+    CAMPOS_RESUMO_RESERVA,
+    HORARIOS_PADRAO,
+    INDICES_BLOQUEIOS,
+    INDICES_RESERVAS,
+    INDICES_RESUMOS,
+    MENSAGEM_RESERVADO,
+    OBSERVADOR_MONGO,
+    ROTA_PADRAO,
+    TAMANHO_LOTE_CANCELAMENTO,
+    TAMANHO_PAGINA,
+    VALIDADE_CACHE_OCUPACAO,
+    VEICULO_PADRAO,
+    CacheOcupacao,
+    MapaOcupacao,
+    Onibus,
+    erro_indice_unico,
+    validar_limite,
+)
+
+
+class OnibusAssincrono:
+
+    # Métodos que não acessam o banco são os mesmos do 'Onibus'.
+    id_viagem = Onibus.id_viagem
+    partida_viagem = Onibus.partida_viagem
+    montar_consulta = Onibus.montar_consulta
+    montar_pagina = Onibus.montar_pagina
+    campos_pagina = Onibus.campos_pagina
+    dividir_pagina = Onibus.dividir_pagina
+    operacoes_resumo = Onibus.operacoes_resumo
+    documento_resumo = Onibus.documento_resumo
+    bits_resumo = Onibus.bits_resumo
+    montar_reserva = Onibus.montar_reserva
+    normalizar_entradas = Onibus.normalizar_entradas
+    validar_entradas = Onibus.validar_entradas
+    escolher_lugares = Onibus.escolher_lugares
+    recusar_grupo = Onibus.recusar_grupo
+    concluir_resultados = Onibus.concluir_resultados
+    consulta_cancelamento = Onibus.consulta_cancelamento
+    arquivamento = Onibus.arquivamento
+    resumo_cancelamento = Onibus.resumo_cancelamento
+    agrupar_lugares = Onibus.agrupar_lugares
+    regravacao_resumo = Onibus.regravacao_resumo
+
+
+    # Método construtor da classe. Cria o cliente do MongoDB; a conexão é
+    # aberta na primeira operação. 'preparar' deve ser aguardado antes de
+    # usar o objeto.
+    def __init__(self, capacidade_padrao=20):
+        self.capacidade_padrao = capacidade_padrao
+
+        # Mapa de ocupação da última viagem carregada por 'carregar_reservas'.
+        self.lugares = MapaOcupacao(0)
+
+        self.cliente = AsyncIOMotorClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/'),
+                                          serverSelectionTimeoutMS=5000,
+                                          event_listeners=[OBSERVADOR_MONGO])
+        self.bd = self.cliente[os.getenv('MONGO_BANCO', 'reserva_onibus_db')]
+        self.colecao_reservas = self.bd["reservas"]
+        self.colecao_rotas = self.bd["rotas"]
+        self.colecao_veiculos = self.bd["veiculos"]
+        self.colecao_resumos = self.bd["viagens"]
+        self.colecao_bloqueios = self.bd["bloqueios"]
+        self.terminal = uuid.uuid4().hex
+
+        self.rotas = {}
+        self.veiculos = {}
+        self.rotas_listadas = False
+
+        self.cache_ocupacao = CacheOcupacao()
+
+
+    # Define o método 'preparar', que cadastra a frota padrão, se ainda não
+    # existir, e cria os índices de INDICES_RESERVAS, INDICES_RESUMOS e
+    # INDICES_BLOQUEIOS que estiverem faltando. Lança RuntimeError se um
+    # índice único não puder ser criado (veja 'erro_indice_unico'): em uma
+    # base antiga, inicie antes o 'Onibus', que prepara as reservas.
+    async def preparar(self):
+        await self.colecao_veiculos.update_one(
+            {"_id": VEICULO_PADRAO},
+            {"$setOnInsert": {"descricao": "Ônibus convencional",
+                              "capacidade": self.capacidade_padrao,
+                              "colunas": 2}},
+            upsert=True
+        )
+        await self.colecao_rotas.update_one(
+            {"_id": ROTA_PADRAO},
+            {"$setOnInsert": {"nome": "Rota Padrão",
+                              "veiculo": VEICULO_PADRAO,
+                              "horarios": HORARIOS_PADRAO}},
+            upsert=True
+        )
+
+        for colecao, declarados in ((self.colecao_reservas, INDICES_RESERVAS),
+                                    (self.colecao_resumos, INDICES_RESUMOS),
+                                    (self.colecao_bloqueios, INDICES_BLOQUEIOS)):
+            existentes = set(await colecao.index_information())
+            for indice in declarados:
+                if indice["nome"] in existentes:
+                    continue
+                try:
+                    await colecao.create_indexes([
+                        IndexModel(indice["chaves"], name=indice["nome"], **indice["opcoes"])
+                    ])
+                except OperationFailure as e:
+                    if indice["opcoes"].get("unique"):
+                        raise erro_indice_unico(indice["nome"], e)
+                    print(f"Não foi possível criar o índice {indice['nome']}: {e}")
+
+        if os.getenv('OBSERVAR_RESERVAS') == '1':
+            self.observar_alteracoes()
+
+
+    # Define o método 'observar_alteracoes', que acompanha em uma tarefa do
+    # laço de eventos as alterações da coleção de reservas (change stream) e
+    # descarta do cache as viagens alteradas por outros processos, como
+    # 'Onibus.observar_alteracoes'.
+    def observar_alteracoes(self):
+
+        async def observar():
+            try:
+                async with self.colecao_reservas.watch(
+                        full_document_before_change="whenAvailable") as fluxo:
+                    self.cache_ocupacao.validade = None
+
+                    async for alteracao in fluxo:
+                        doc = (alteracao.get("fullDocument")
+                               or alteracao.get("fullDocumentBeforeChange"))
+                        if doc and "viagem" in doc:
+                            self.cache_ocupacao.invalidar(doc["viagem"])
+                        else:
+                            self.cache_ocupacao.invalidar()
+
+            except PyMongoError as e:
+                print(f"Não foi possível observar as alterações das reservas: {e}")
+
+            self.cache_ocupacao.validade = VALIDADE_CACHE_OCUPACAO
+            self.cache_ocupacao.invalidar()
+
+        self.observacao = asyncio.get_running_loop().create_task(observar())
+
+
+    # Define o método 'verificar_conexao', que lança um erro do pymongo se o
+    # MongoDB não responder.
+    async def verificar_conexao(self):
+        await self.cliente.admin.command("ping")
+
+
+    # Define o método 'rota', que retorna o documento de uma rota, lendo-o
+    # do banco apenas na primeira vez. Lança ValueError se não existir.
+    async def rota(self, codigo):
+        rota = self.rotas.get(codigo)
+        if rota is None:
+            rota = await self.colecao_rotas.find_one({"_id": codigo})
+            if rota is None:
+                raise ValueError(f"Rota {codigo} não cadastrada")
+            self.rotas[codigo] = rota
+        return rota
+
+
+    # Define o método 'listar_rotas', que retorna os códigos de todas as
+    # rotas cadastradas (lidas do banco uma única vez).
+    async def listar_rotas(self):
+        if not self.rotas_listadas:
+            async for rota in self.colecao_rotas.find({}):
+                self.rotas[rota["_id"]] = rota
+            self.rotas_listadas = True
+        return sorted(self.rotas)
+
+
+    # Define o método 'horarios_rota', que retorna os horários de partida
+    # de uma rota.
+    async def horarios_rota(self, rota):
+        return (await self.rota(rota))["horarios"]
+
+
+    # Define o método 'veiculo', que retorna o documento de um veículo,
+    # lendo-o do banco apenas na primeira vez.
+    async def veiculo(self, codigo):
+        veiculo = self.veiculos.get(codigo)
+        if veiculo is None:
+            veiculo = await self.colecao_veiculos.find_one({"_id": codigo})
+            if veiculo is None:
+                raise ValueError(f"Veículo {codigo} não cadastrado")
+            self.veiculos[codigo] = veiculo
+        return veiculo
+
+
+    # Define o método 'veiculo_viagem', que retorna o veículo que faz uma
+    # viagem (veja 'Onibus.veiculo_viagem').
+    async def veiculo_viagem(self, rota, horario):
+        dados = await self.rota(rota)
+        codigo = dados.get("veiculos_por_horario", {}).get(horario, dados["veiculo"])
+        return await self.veiculo(codigo)
+
+
+    # Define o método 'capacidade_viagem', que retorna o número de lugares
+    # da viagem.
+    async def capacidade_viagem(self, rota, horario):
+        return (await self.veiculo_viagem(rota, horario))["capacidade"]
+
+
+    # Define o método 'frota', que retorna todas as rotas com seus
+    # horários e o veículo de cada horário (veja 'Onibus.frota').
+    async def frota(self):
+        frota = []
+        for rota in await self.listar_rotas():
+            frota.append({"codigo": rota,
+                          "horarios": [{"horario": horario,
+                                        "veiculo": await self.veiculo_viagem(rota, horario)}
+                                       for horario in await self.horarios_rota(rota)]})
+        return frota
+
+
+    # Define o método 'validar_reserva', que lança ValueError se a rota, a
+    # data, o horário ou o lugar de uma reserva forem inválidos.
+    async def validar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        self.partida_viagem(dia, horario)
+        if not 1 <= lugar <= await self.capacidade_viagem(rota, horario):
+            raise ValueError("Lugar inválido")
+
+
+    # Define o método 'carregar_reservas', que guarda em 'lugares' a
+    # ocupação de uma viagem.
+    async def carregar_reservas(self, data, horario, rota=ROTA_PADRAO):
+        self.lugares = await self.consultar_ocupacao(data, horario, rota)
+
+
+    # Define o método 'consultar_ocupacao', que retorna um novo MapaOcupacao
+    # com os lugares da viagem. Viagens consultadas recentemente são
+    # respondidas pelo cache, sem acessar o banco.
+    async def consultar_ocupacao(self, data, horario, rota=ROTA_PADRAO):
+        viagem = self.id_viagem(rota, data, horario)
+        capacidade = await self.capacidade_viagem(rota, horario)
+
+        lugares = self.cache_ocupacao.obter(viagem)
+        if lugares is not None:
+            return lugares
+
+        versao = self.cache_ocupacao.versao()
+        lugares = MapaOcupacao.de_lugares(capacidade, await self.lugares_ocupados(data, horario, rota))
+        self.cache_ocupacao.guardar(viagem, lugares, versao)
+        return lugares
+
+
+    # Define o método 'lugares_ocupados', que retorna o conjunto dos números
+    # dos lugares reservados em uma viagem, lendo somente o índice
+    # 'reserva_viagem_lugar'.
+    async def lugares_ocupados(self, dia, horario, rota=ROTA_PADRAO):
+        reservas = self.colecao_reservas.find({"viagem": self.id_viagem(rota, dia, horario)},
+                                              {"lugar": 1, "_id": 0})
+        return {r["lugar"] async for r in reservas}
+
+
+    # Define o método 'lugares_bloqueados', que retorna o conjunto dos
+    # lugares de uma viagem em atendimento nos guichês (veja
+    # 'Onibus.bloquear_lugar'). O serviço não bloqueia lugares, mas também
+    # não reserva os que estão em atendimento.
+    async def lugares_bloqueados(self, dia, horario, rota=ROTA_PADRAO):
+        bloqueios = self.colecao_bloqueios.find(
+            {"viagem": self.id_viagem(rota, dia, horario),
+             "expira_em": {"$gt": datetime.now(timezone.utc)},
+             "terminal": {"$ne": self.terminal}},
+            {"lugar": 1, "_id": 0}
+        )
+        return {b["lugar"] async for b in bloqueios}
+
+
+    # Define o método 'lugar_em_atendimento', que informa se um lugar está em
+    # atendimento em um guichê, lendo apenas o seu bloqueio pelo '_id'.
+    async def lugar_em_atendimento(self, lugar, viagem):
+        return await self.colecao_bloqueios.find_one(
+            {"_id": f"{viagem}|{lugar}",
+             "terminal": {"$ne": self.terminal},
+             "expira_em": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 1}
+        ) is not None
+
+
+    # Define o método 'reservar_lugar', que grava a reserva de um lugar com
+    # uma única inserção; o índice único (viagem, lugar) recusa lugares já
+    # ocupados. Retorna a mesma mensagem de 'Onibus.reservar_lugar'.
+    async def reservar_lugar(self, num_lugar, nome, cpf, dia, horario, rota=ROTA_PADRAO):
+        doc, erro = self.montar_reserva(num_lugar, nome, cpf, dia, horario, rota,
+                                        await self.capacidade_viagem(rota, horario))
+        if erro is not None:
+            return erro
+
+        if await self.lugar_em_atendimento(num_lugar, doc["viagem"]):
+            return f"Lugar {num_lugar} em atendimento em outro guichê para {horario}"
+
+        try:
+            await self.colecao_reservas.insert_one(doc)
+        except DuplicateKeyError:
+            self.cache_ocupacao.invalidar(doc["viagem"])
+            return f"Lugar {num_lugar} indisponível para {horario}"
+
+        self.cache_ocupacao.invalidar(doc["viagem"])
+        await self.colecao_resumos.bulk_write(self.operacoes_resumo([doc], True))
+
+        return MENSAGEM_RESERVADO.format(lugar=num_lugar, horario=horario)
+
+
+    # Define o método 'reservar_lugares', que reserva vários lugares de uma
+    # vez, com os mesmos parâmetros e resultados de 'Onibus.reservar_lugares'.
+    # A validação das entradas, a escolha dos lugares e os resultados são os
+    # do 'Onibus'; aqui ficam apenas as consultas e as gravações.
+    async def reservar_lugares(self, entradas, tudo_ou_nada=False):
+
+        entradas = self.normalizar_entradas(entradas)
+
+        capacidades = {}
+        for _, _, _, _, horario, rota in entradas:
+            if (rota, horario) not in capacidades:
+                try:
+                    capacidades[(rota, horario)] = await self.capacidade_viagem(rota, horario)
+                except ValueError as e:
+                    capacidades[(rota, horario)] = e
+        resultados, candidatos = self.validar_entradas(entradas, capacidades)
+
+        ocupacao = {}
+        bloqueados = {}
+        for _, doc in candidatos:
+            viagem = doc["viagem"]
+            if viagem not in ocupacao:
+                ocupacao[viagem] = await self.lugares_ocupados(doc["dia"], doc["horario"],
+                                                               doc["rota"])
+                bloqueados[viagem] = await self.lugares_bloqueados(doc["dia"], doc["horario"],
+                                                                   doc["rota"])
+
+        docs, posicoes = self.escolher_lugares(entradas, resultados, candidatos,
+                                               ocupacao, bloqueados)
+
+        if tudo_ou_nada and len(posicoes) < len(entradas):
+            return self.recusar_grupo(entradas, resultados, posicoes,
+                                      "há outros lugares do grupo indisponíveis")
+
+        if not docs:
+            return resultados
+
+        recusados = set()
+
+        try:
+            if tudo_ou_nada:
+                async def gravar(s):
+                    await self.colecao_reservas.insert_many(docs, session=s)
+                    await self.colecao_resumos.bulk_write(self.operacoes_resumo(docs, True), session=s)
+
+                async with await self.cliente.start_session() as sessao:
+                    await sessao.with_transaction(gravar)
+            else:
+                await self.colecao_reservas.insert_many(docs, ordered=False)
+
+        except BulkWriteError as e:
+            if tudo_ou_nada:
+                return self.recusar_grupo(entradas, resultados, posicoes,
+                                          "lugar reservado por outro terminal")
+            recusados = {erro["index"] for erro in e.details["writeErrors"]}
+
+        except DuplicateKeyError:
+            return self.recusar_grupo(entradas, resultados, posicoes,
+                                      "lugar reservado por outro terminal")
+
+        finally:
+            for viagem in ocupacao:
+                self.cache_ocupacao.invalidar(viagem)
+
+        if not tudo_ou_nada:
+            gravados = [doc for j, doc in enumerate(docs) if j not in recusados]
+            if gravados:
+                await self.colecao_resumos.bulk_write(self.operacoes_resumo(gravados, True))
+
+        return self.concluir_resultados(entradas, resultados, posicoes, recusados)
+
+
+    # Define o método 'cancelar_reserva', que cancela a reserva de um lugar
+    # e retorna a mensagem exibida ao usuário.
+    async def cancelar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        if await self.remover_reserva(lugar, dia, horario, rota):
+            return f"Lugar {lugar} reserva cancelada para {horario}"
+        return f"Lugar {lugar} não está reservado para {horario}"
+
+
+    # Define o método 'remover_reserva', que remove a reserva de um lugar
+    # em uma viagem e retorna True, ou False se o lugar não estava reservado.
+    async def remover_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        if not 1 <= lugar <= await self.capacidade_viagem(rota, horario):
+            return False
+
+        viagem = self.id_viagem(rota, dia, horario)
+        resultado = await self.colecao_reservas.delete_one({"viagem": viagem, "lugar": lugar})
+        self.cache_ocupacao.invalidar(viagem)
+
+        if not resultado.deleted_count:
+            return False
+
+        await self.colecao_resumos.bulk_write(self.operacoes_resumo(
+            [{"lugar": lugar, "dia": dia, "horario": horario, "rota": rota, "viagem": viagem}],
+            False))
+        return True
+
+
+    # Define o método 'cancelar_reservas', que cancela de uma só vez todas as
+    # reservas que atendem aos filtros, em lotes arquivados e removidos
+    # pelos identificadores e descontados dos resumos (veja
+    # 'Onibus.cancelar_reservas'). Retorna quantas reservas foram removidas.
+    async def cancelar_reservas(self, filtros, arquivar=False):
+        consulta = self.consulta_cancelamento(filtros)
+
+        removidas = 0
+        try:
+            while True:
+                lote = await (self.colecao_reservas.find(consulta, CAMPOS_RESUMO_RESERVA)
+                              .limit(TAMANHO_LOTE_CANCELAMENTO)
+                              .to_list(TAMANHO_LOTE_CANCELAMENTO))
+                if not lote:
+                    break
+                ids = {"_id": {"$in": [reserva["_id"] for reserva in lote]}}
+
+                if arquivar:
+                    await self.colecao_reservas.aggregate(self.arquivamento(ids)).to_list(None)
+
+                quantidade = (await self.colecao_reservas.delete_many(ids)).deleted_count
+                removidas += quantidade
+
+                operacoes, reconciliar = self.resumo_cancelamento(lote, quantidade)
+                if operacoes:
+                    await self.colecao_resumos.bulk_write(operacoes)
+                if reconciliar:
+                    await self.reconciliar_resumos(reconciliar)
+        finally:
+            self.cache_ocupacao.invalidar()
+
+        return removidas
+
+
+    # Define o método 'reconciliar_resumos', que reconstrói os resumos das
+    # viagens informadas a partir das reservas, como
+    # 'Onibus.reconciliar_resumos'. Retorna quantos resumos foram gravados.
+    # A reconstrução de todos os resumos continua sendo feita pelo 'Onibus'
+    # (--reconciliar-resumos).
+    async def reconciliar_resumos(self, viagens):
+        reservas = await (self.colecao_reservas.find({"viagem": {"$in": list(viagens)}},
+                                                     {"viagem": 1, "lugar": 1, "_id": 0})
+                          .sort([("viagem", ASCENDING), ("lugar", ASCENDING)])
+                          .to_list(None))
+
+        inicio = datetime.now()
+        grupos = list(self.agrupar_lugares(reservas))
+        if grupos:
+            await self.colecao_resumos.bulk_write(
+                [self.regravacao_resumo(codigo, lugares, inicio) for codigo, lugares in grupos],
+                ordered=False)
+
+        gravados = {codigo for codigo, _ in grupos}
+        vazias = [codigo for codigo in viagens if codigo not in gravados]
+        if vazias:
+            await self.colecao_resumos.delete_many({"_id": {"$in": vazias}})
+
+        return len(grupos)
+
+
+    # Define o método 'buscar_reserva', que retorna os campos de
+    # CAMPOS_RESERVA da reserva de um lugar em uma viagem, ou None se o
+    # lugar estiver livre.
+    async def buscar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        return await self.colecao_reservas.find_one({"viagem": self.id_viagem(rota, dia, horario),
+                                                     "lugar": lugar},
+                                                    {**dict.fromkeys(CAMPOS_RESERVA, 1), "_id": 0})
+
+
+    # Define o método 'pesquisar_reservas', que busca uma página de reservas
+    # que atendem aos filtros. Retorna uma tupla (reservas, cursor), como
+    # 'Onibus.pesquisar_reservas'.
+    async def pesquisar_reservas(self, filtros, cursor=None, limite=TAMANHO_PAGINA):
+        validar_limite(limite)
+        consulta, ordenacao = self.montar_pagina(filtros, cursor)
+        reservas = await (self.colecao_reservas.find(consulta, self.campos_pagina(ordenacao))
+                          .sort(ordenacao)
+                          .limit(limite + 1)
+                          .to_list(limite + 1))
+        return self.dividir_pagina(reservas, ordenacao, limite)
+
+
+    # Define o método 'resumos_periodo', que retorna a ocupação das viagens
+    # de uma rota entre duas datas, lida dos resumos, no formato
+    # {(dia, horario): MapaOcupacao}.
+    async def resumos_periodo(self, inicio, fim, rota=ROTA_PADRAO):
+        resumos = self.colecao_resumos.find({
+            "rota": rota,
+            "partida": {"$gte": datetime.combine(inicio, datetime.min.time()),
+                        "$lt": datetime.combine(fim + timedelta(days=1), datetime.min.time())},
+        }, {"dia": 1, "horario": 1, "ocupacao": 1, "_id": 0})
+
+        ocupacao = {}
+        async for resumo in resumos:
+            try:
+                capacidade = await self.capacidade_viagem(rota, resumo["horario"])
+            except ValueError:
+                continue
+            ocupacao[(resumo["dia"], resumo["horario"])] = MapaOcupacao(capacidade,
+                                                                       self.bits_resumo(resumo))
+        return ocupacao
+
+
+    # Define o método 'ocupacao_mes', que retorna quantos lugares estão
+    # reservados em cada dia de um mês de uma rota, no formato
+    # {dia: (reservados, capacidade do dia)}.
+    async def ocupacao_mes(self, ano, mes, rota=ROTA_PADRAO):
+        inicio = datetime(ano, mes, 1)
+        fim = datetime(ano + mes // 12, mes % 12 + 1, 1)
+
+        grupos = self.colecao_resumos.aggregate([
+            {"$match": {"rota": rota, "partida": {"$gte": inicio, "$lt": fim}}},
+            {"$group": {"_id": {"dia": "$dia", "horario": "$horario"},
+                        "reservados": {"$sum": "$reservados"}}},
+        ])
+
+        capacidade = 0
+        for horario in await self.horarios_rota(rota):
+            capacidade += await self.capacidade_viagem(rota, horario)
+
+        reservados = {}
+        async for grupo in grupos:
+            dia = grupo["_id"]["dia"]
+            reservados[dia] = reservados.get(dia, 0) + grupo["reservados"]
+
+        return {dia: (quantidade, capacidade)
+                for dia, quantidade in reservados.items() if quantidade > 0}
@@ -2,12 +2,30 @@
 # facilitar seu uso no código.
 import tkinter as tk
 from math import expm1
+import bisect
+import csv
+import functools
+import inspect
+import json
 import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+import threading
 import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Importa submódulos ttk e messagebox do tkinter, utilizados
 # para criar widgets com estilos melhorados e exibir caixas de diálogo.
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 
 # Importa o módulo Calendar do pacote tkcalendar, que permite
 # criar um widget de calendário para seleção de datas.
@@ -15,11 +33,20 @@ from tkcalendar import Calendar
 
 # Importa o módulo datetime da biblioteca datetime, usado
 # para manipular datas e tempos.
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 # Importa o módulo MongoClient do pacote pymongo, que
 # permite conexão com um servidor MongoDB.
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, ReplaceOne, UpdateOne, ASCENDING, monitoring
+
+# Importa o tipo inteiro de 64 bits do BSON, usado nos mapas de ocupação
+# dos resumos das viagens.
+from bson.int64 import Int64
+
+# Importa a exceção levantada pelo MongoDB quando uma escrita viola
+# um índice único, usada para detectar lugares já reservados.
+from pymongo.errors import (BulkWriteError, ConnectionFailure, DuplicateKeyError,
+                            OperationFailure, PyMongoError)
 
 # Adicione esta função para configurar o estilo
 def configurar_estilo():
@@ -61,71 +88,1147 @@ def configurar_estilo():
                    background='#FFC107',
                    foreground='black')
 
-# Chame esta função no início do seu programa
-configurar_estilo()
+# Conjunto de índices declarados para a coleção 'reservas'. Cada entrada
+# tem o nome do índice, as chaves e as opções usadas na criação.
+# - reserva_viagem_lugar: identificador da viagem seguido do lugar.
+#   Atende a carga do mapa ({viagem}), o clique em um assento e o
+#   cancelamento ({viagem, lugar}) e impede vendas em duplicidade. O custo
+#   de cada consulta não depende do tamanho da frota.
+# - reserva_partida: pesquisa, cancelamento e relatórios por data ou
+#   período (de qualquer rota), percorrendo apenas o intervalo de datas de
+#   partida pedido, já em ordem cronológica para a paginação.
+# - reserva_cpf: pesquisa de reservas pelo CPF do cliente, já ordenada
+#   por '_id' para a paginação da janela de pesquisa.
+# - reserva_nome_busca: pesquisa por prefixo do nome, usando o campo
+#   'nome_busca' (nome em minúsculas), ordenada por nome e '_id'.
+INDICES_RESERVAS = [
+    {
+        "nome": "reserva_viagem_lugar",
+        "chaves": [("viagem", ASCENDING), ("lugar", ASCENDING)],
+        "opcoes": {"unique": True},
+    },
+    {
+        "nome": "reserva_partida",
+        "chaves": [("partida", ASCENDING), ("_id", ASCENDING)],
+        "opcoes": {},
+    },
+    {
+        "nome": "reserva_cpf",
+        "chaves": [("cpf", ASCENDING), ("_id", ASCENDING)],
+        "opcoes": {},
+    },
+    {
+        "nome": "reserva_nome_busca",
+        "chaves": [("nome_busca", ASCENDING), ("_id", ASCENDING)],
+        "opcoes": {},
+    },
+]
+
+# Índices criados por versões anteriores que devem ser removidos, cada um
+# com o índice que o substitui: só são removidos depois que o substituto
+# existe. O antigo índice único por (dia, horario, lugar) impediria que
+# duas rotas vendessem o mesmo lugar no mesmo dia e horário. O índice por
+# (dia, horario) foi substituído pelo índice da data de partida.
+INDICES_OBSOLETOS = {
+    "reserva_lugar_unico": "reserva_viagem_lugar",
+    "reserva_dia_horario": "reserva_partida",
+}
+
+# Índices da coleção 'viagens', que guarda um resumo (lugares reservados e
+# mapa de ocupação) de cada viagem com reservas:
+# - viagem_rota_partida_reservados: resumos de uma rota em um dia ou mês,
+#   lidos em uma única consulta para mostrar a disponibilidade dos
+#   horários. Também guarda o dia, o horário e a quantidade de lugares
+#   reservados, então a ocupação dos dias do calendário ('ocupacao_mes')
+#   é calculada lendo somente o índice.
+INDICES_RESUMOS = [
+    {
+        "nome": "viagem_rota_partida_reservados",
+        "chaves": [("rota", ASCENDING), ("partida", ASCENDING), ("dia", ASCENDING),
+                   ("horario", ASCENDING), ("reservados", ASCENDING)],
+        "opcoes": {},
+    },
+]
+
+# Índice da coleção 'viagens' criado por versões anteriores, substituído
+# por 'viagem_rota_partida_reservados'.
+INDICES_RESUMOS_OBSOLETOS = {"viagem_rota_partida": "viagem_rota_partida_reservados"}
+
+
+# Define a função 'erro_indice_unico', que monta o erro lançado ao iniciar
+# quando um índice único não existe e não pôde ser criado. Sem ele, nada
+# impede que o mesmo lugar seja vendido duas vezes (a reserva é uma única
+# inserção, recusada apenas pelo índice), então o sistema não pode ser usado.
+def erro_indice_unico(nome, erro):
+    return RuntimeError(
+        f"Não foi possível criar o índice único {nome}, que impede a venda do mesmo "
+        f"lugar duas vezes: {erro}. Se há lugares vendidos em duplicidade, corrija-os "
+        f"antes de iniciar o sistema.")
+
+
+# Mensagens de 'reservar_lugar' e 'reservar_lugares'. O serviço HTTP e o
+# simulador de guichês comparam o resultado com elas para saber se o lugar
+# foi reservado, então devem ser sempre montadas a partir destas
+# constantes.
+MENSAGEM_RESERVADO = "Lugar {lugar} reservado com sucesso para {horario}"
+MENSAGEM_LUGAR_INVALIDO = "Lugar inválido"
+MENSAGEM_DATA_INVALIDA = "Data inválida: {dia} {horario}"
+
+# Campos das reservas exibidos ao clicar em um assento ocupado, na
+# pesquisa e pelo serviço HTTP. As consultas dessas telas trazem apenas
+# estes campos (e os da ordenação da pesquisa), sem o restante do
+# documento.
+CAMPOS_RESERVA = ["lugar", "nome", "cpf", "dia", "horario", "rota"]
+
+# Índices da coleção 'bloqueios', que guarda os lugares em atendimento
+# (veja 'Onibus.bloquear_lugar'):
+# - bloqueio_expiracao: índice TTL; o MongoDB remove sozinho os bloqueios
+#   vencidos (a remoção roda a cada minuto, então os bloqueios vencidos
+#   ainda presentes são ignorados pelas consultas).
+# - bloqueio_viagem: bloqueios de uma viagem, lidos para colorir o mapa.
+INDICES_BLOQUEIOS = [
+    {
+        "nome": "bloqueio_expiracao",
+        "chaves": [("expira_em", ASCENDING)],
+        "opcoes": {"expireAfterSeconds": 0},
+    },
+    {
+        "nome": "bloqueio_viagem",
+        "chaves": [("viagem", ASCENDING), ("expira_em", ASCENDING)],
+        "opcoes": {},
+    },
+]
+
+# Duração (em segundos) do bloqueio de um lugar em atendimento. A janela
+# de cadastro renova o bloqueio na metade desse tempo enquanto está
+# aberta; se o terminal cair, o lugar volta a ficar livre sozinho.
+DURACAO_BLOQUEIO = 120
+
+# Quantidade de lugares guardada em cada palavra do mapa de ocupação dos
+# resumos. O mapa é gravado como um subdocumento {"0": bits dos lugares
+# 1 a 32, "1": bits dos lugares 33 a 64, ...}, atualizado com '$bit'.
+BITS_PALAVRA_RESUMO = 32
+
+# Rota e veículo cadastrados automaticamente quando a frota está vazia,
+# correspondendo ao único ônibus de 20 lugares das versões anteriores. As
+# reservas antigas, sem rota, pertencem a esta rota.
+ROTA_PADRAO = "PADRAO"
+VEICULO_PADRAO = "ONIBUS-01"
+HORARIOS_PADRAO = ["08:00", "10:00", "12:00", "14:00", "16:00", "18:00", "20:00"]
+
+# Formato das datas das reservas (o mesmo 'date_pattern' dos calendários).
+FORMATO_DATA = "%d/%m/%Y"
+
+# Formatos aceitos para o campo 'dia' de reservas gravadas por versões
+# anteriores, que usavam o formato do idioma do sistema. Anos com dois
+# dígitos seguem o padrão do calendário em inglês (mês primeiro), que é
+# o que o gerava.
+FORMATOS_DATA_ANTIGOS = [FORMATO_DATA, "%m/%d/%y", "%d/%m/%y", "%Y-%m-%d"]
+
+# Quantidade de reservas regravadas por vez na migração das datas, de
+# resumos regravados por vez na reconstrução dos resumos das viagens e de
+# reservas arquivadas e removidas por vez no cancelamento em lote.
+TAMANHO_LOTE_MIGRACAO = 500
+TAMANHO_LOTE_RESUMOS = 500
+TAMANHO_LOTE_CANCELAMENTO = 1000
+
+# Campos das reservas usados para descontá-las dos resumos das viagens
+# (veja 'Onibus.operacoes_resumo').
+CAMPOS_RESUMO_RESERVA = {"viagem": 1, "lugar": 1, "dia": 1, "horario": 1, "rota": 1}
+
+# Quantidade de reservas trazidas do banco por página na janela de pesquisa.
+TAMANHO_PAGINA = 100
+
+# Quantidade de linhas extras mantidas no Treeview da pesquisa acima e abaixo
+# das linhas visíveis, para que pequenas rolagens não recriem os itens.
+LINHAS_EXTRAS_PESQUISA = 20
+
+# Quantidade de threads que executam as consultas ao banco fora da
+# thread da interface e intervalo (em milissegundos) com que a interface
+# verifica se há respostas prontas.
+TRABALHADORES_BANCO = 4
+INTERVALO_RESPOSTAS_MS = 20
+
+# Quantidade máxima de viagens mantidas no cache de ocupação
+# e tempo máximo (em segundos) que uma entrada é considerada válida quando
+# as alterações feitas por outros terminais não estão sendo observadas.
+CAPACIDADE_CACHE_OCUPACAO = 64
+VALIDADE_CACHE_OCUPACAO = 30
+
+# Tabelas e índices do banco local (SQLite) usado por 'OnibusLocal'. As
+# reservas têm as mesmas colunas dos documentos do MongoDB, e os índices
+# correspondem aos de INDICES_RESERVAS, mais o índice (rota, partida) usado
+# pela disponibilidade e pelo calendário no lugar dos resumos das viagens.
+ESQUEMA_LOCAL = """
+CREATE TABLE IF NOT EXISTS veiculos (
+    codigo TEXT PRIMARY KEY,
+    descricao TEXT,
+    capacidade INTEGER NOT NULL,
+    colunas INTEGER NOT NULL DEFAULT 2
+);
+CREATE TABLE IF NOT EXISTS rotas (
+    codigo TEXT PRIMARY KEY,
+    nome TEXT,
+    veiculo TEXT NOT NULL REFERENCES veiculos (codigo),
+    horarios TEXT NOT NULL,
+    veiculos_por_horario TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS reservas (
+    _id INTEGER PRIMARY KEY,
+    viagem TEXT NOT NULL,
+    lugar INTEGER NOT NULL,
+    nome TEXT,
+    nome_busca TEXT,
+    cpf TEXT,
+    dia TEXT,
+    horario TEXT,
+    partida TEXT,
+    rota TEXT
+);
+CREATE TABLE IF NOT EXISTS reservas_canceladas (
+    _id INTEGER PRIMARY KEY,
+    viagem TEXT,
+    lugar INTEGER,
+    nome TEXT,
+    nome_busca TEXT,
+    cpf TEXT,
+    dia TEXT,
+    horario TEXT,
+    partida TEXT,
+    rota TEXT,
+    cancelada_em TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS reserva_viagem_lugar ON reservas (viagem, lugar);
+CREATE INDEX IF NOT EXISTS reserva_partida ON reservas (partida, _id);
+CREATE INDEX IF NOT EXISTS reserva_cpf ON reservas (cpf, _id);
+CREATE INDEX IF NOT EXISTS reserva_nome_busca ON reservas (nome_busca, _id);
+CREATE INDEX IF NOT EXISTS reserva_rota_partida ON reservas (rota, partida);
+"""
+
+# Tempo máximo (em segundos) que uma gravação no banco local espera por
+# outra que esteja em andamento.
+ESPERA_BANCO_LOCAL = 5
+
+# Tabelas do diário local usado por 'OnibusSincronizado': as operações
+# feitas sem conexão com o servidor ('pendente' até serem enviadas, ou
+# 'conflito' se o servidor as recusou), a última ocupação lida do
+# servidor para cada viagem consultada e os passageiros dos lugares
+# consultados, para os cancelamentos feitos sem conexão.
+ESQUEMA_DIARIO = """
+CREATE TABLE IF NOT EXISTS diario (
+    _id INTEGER PRIMARY KEY,
+    operacao TEXT NOT NULL,
+    viagem TEXT NOT NULL,
+    lugar INTEGER NOT NULL,
+    nome TEXT,
+    cpf TEXT,
+    dia TEXT NOT NULL,
+    horario TEXT NOT NULL,
+    rota TEXT NOT NULL,
+    registrada_em TEXT NOT NULL,
+    situacao TEXT NOT NULL DEFAULT 'pendente',
+    mensagem TEXT
+);
+CREATE INDEX IF NOT EXISTS diario_situacao ON diario (situacao, _id);
+CREATE INDEX IF NOT EXISTS diario_viagem ON diario (viagem, lugar, situacao);
+CREATE INDEX IF NOT EXISTS diario_rota ON diario (rota, situacao);
+CREATE TABLE IF NOT EXISTS ocupacao (
+    viagem TEXT PRIMARY KEY,
+    rota TEXT NOT NULL,
+    dia TEXT NOT NULL,
+    horario TEXT NOT NULL,
+    lugares TEXT NOT NULL,
+    atualizada_em TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ocupacao_rota ON ocupacao (rota);
+CREATE TABLE IF NOT EXISTS passageiros (
+    viagem TEXT NOT NULL,
+    lugar INTEGER NOT NULL,
+    nome TEXT NOT NULL,
+    cpf TEXT NOT NULL,
+    PRIMARY KEY (viagem, lugar)
+);
+"""
+
+# Intervalo (em segundos) entre as tentativas de enviar o diário local ao
+# servidor e quantidade de operações lidas do diário por lote.
+INTERVALO_SINCRONIZACAO = 10
+TAMANHO_LOTE_SINCRONIZACAO = 100
+
+# Erros que indicam falta de conexão com o servidor: do MongoDB
+# (ConnectionFailure) ou do serviço HTTP (OSError).
+ERROS_CONEXAO = (ConnectionFailure, OSError)
+
+# Respostas do serviço HTTP que também indicam falta de conexão: o
+# balanceador sem instâncias disponíveis ou o banco de dados fora do ar.
+ERROS_HTTP_CONEXAO = (502, 503, 504)
+
+# Conexão com o MongoDB: tempo máximo (em milissegundos) de cada tentativa,
+# espera (em segundos) antes da segunda tentativa, dobrada a cada nova
+# falha até ESPERA_MAXIMA_CONEXAO, e quantidade de tentativas feitas pelas
+# ferramentas de linha de comando e pelo serviço (a interface tenta até
+# conseguir, sem bloquear a janela).
+TEMPO_LIMITE_CONEXAO_MS = 5000
+ESPERA_INICIAL_CONEXAO = 1
+ESPERA_MAXIMA_CONEXAO = 30
+TENTATIVAS_CONEXAO = 8
+
+# Intervalo (em segundos) entre as consultas da viagem exibida no mapa
+# quando o MongoDB não oferece change streams (servidor fora de replica set).
+INTERVALO_CONSULTA_MAPA = 5
+
+# Intervalo (em segundos) entre as consultas dos lugares em atendimento em
+# outros guichês na viagem exibida no mapa.
+INTERVALO_BLOQUEIOS = 3
+
+# Cores dos dias no calendário conforme a fração dos lugares do dia (em
+# todos os horários da rota) já reservada: (fração máxima, etiqueta, cor).
+# Dias sem reservas ficam sem cor; dias com todos os lugares reservados
+# usam a cor de CALENDARIO_LOTADO.
+NIVEIS_CALENDARIO = [
+    (0.5, "ocupacao_baixa", "#c8e6c9"),
+    (0.8, "ocupacao_media", "#fff59d"),
+    (1.0, "ocupacao_alta", "#ffcc80"),
+]
+CALENDARIO_LOTADO = ("ocupacao_lotado", "#ef9a9a")
+
+# Limites (em segundos) das faixas dos histogramas de latência das
+# métricas (veja 'MetricasOperacoes'), como os 'buckets' do Prometheus.
+FAIXAS_LATENCIA = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+# Arquivo e intervalo (em segundos) com que a interface grava as métricas
+# em JSON enquanto elas estão habilitadas.
+ARQUIVO_METRICAS = "metricas_reservas.json"
+INTERVALO_METRICAS = 60
+
+
+# Define a classe 'MapaOcupacao', que guarda a ocupação dos lugares de uma
+# viagem como um mapa de bits: o bit 'lugar - 1' de um único inteiro vale 1
+# quando o lugar está reservado. Um ônibus de 20 lugares ocupa poucos bytes,
+# então a ocupação de todas as viagens de um dia cabe em alguns kilobytes, e
+# as consultas de lugares livres são feitas com operações sobre o inteiro
+# inteiro, sem percorrer os lugares um a um.
+class MapaOcupacao:
+
+    __slots__ = ("capacidade", "bits")
+
+    def __init__(self, capacidade, bits=0):
+        self.capacidade = capacidade
+        self.bits = bits
+
+    # Retorna a quantidade de lugares da viagem.
+    def __len__(self):
+        return self.capacidade
+
+    def __eq__(self, outro):
+        return (isinstance(outro, MapaOcupacao)
+                and (self.capacidade, self.bits) == (outro.capacidade, outro.bits))
+
+    def __repr__(self):
+        return f"MapaOcupacao({self.capacidade}, {bin(self.bits)})"
+
+    # Retorna uma cópia independente do mapa.
+    def copia(self):
+        return MapaOcupacao(self.capacidade, self.bits)
+
+    # Retorna o mapa de bits com todos os lugares da viagem.
+    def todos(self):
+        return (1 << self.capacidade) - 1
+
+    # Retorna o mapa de bits dos lugares livres.
+    def bits_livres(self):
+        return ~self.bits & self.todos()
+
+    # Informa se o lugar (de 1 até a capacidade) está reservado.
+    def ocupado(self, lugar):
+        return bool(self.bits >> (lugar - 1) & 1)
+
+    # Marca o lugar como reservado. Lugares fora da capacidade são ignorados.
+    def ocupar(self, lugar):
+        if 1 <= lugar <= self.capacidade:
+            self.bits |= 1 << (lugar - 1)
+
+    # Marca o lugar como livre.
+    def liberar(self, lugar):
+        self.bits &= ~(1 << (lugar - 1))
+
+    # Retorna a quantidade de lugares livres.
+    def contar_livres(self):
+        return bin(self.bits_livres()).count("1")
+
+    # Retorna os números dos lugares livres, em ordem crescente.
+    def livres(self):
+        return self.lugares_marcados(self.bits_livres())
+
+    # Retorna os números dos lugares reservados, em ordem crescente.
+    def ocupados(self):
+        return self.lugares_marcados(self.bits & self.todos())
+
+    # Retorna os números dos lugares cujos bits estão ligados em 'bits'.
+    @staticmethod
+    def lugares_marcados(bits):
+        lugares = []
+        while bits:
+            menor = bits & -bits
+            lugares.append(menor.bit_length())
+            bits ^= menor
+        return lugares
+
+    # Cria o mapa de uma viagem a partir dos números dos lugares reservados.
+    @classmethod
+    def de_lugares(cls, capacidade, lugares):
+        mapa = cls(capacidade)
+        for lugar in lugares:
+            mapa.ocupar(lugar)
+        return mapa
+
+    # Retorna o primeiro lugar de uma sequência de 'quantidade' lugares
+    # livres consecutivos, ou None se não houver. Com 'colunas', a
+    # sequência precisa estar inteira em uma mesma fileira do mapa.
+    def adjacentes_livres(self, quantidade, colunas=None):
+        if quantidade < 1 or quantidade > self.capacidade:
+            return None
+
+        # Desloca o mapa de lugares livres sobre si mesmo: restam apenas os
+        # bits que iniciam 'quantidade' lugares livres seguidos.
+        livres = self.bits_livres()
+        inicios = livres
+        for deslocamento in range(1, quantidade):
+            inicios &= livres >> deslocamento
+
+        if colunas:
+            inicios &= sum(1 << i for i in range(self.capacidade)
+                           if i % colunas + quantidade <= colunas)
+
+        if not inicios:
+            return None
+        return (inicios & -inicios).bit_length()
+
+
+# Define a classe 'CacheOcupacao', que guarda em memória a ocupação dos
+# lugares de cada viagem (pelo seu identificador), evitando consultar o banco ao
+# voltar para uma viagem já exibida. Quando o cache está cheio, a viagem
+# usada há mais tempo é descartada (LRU). Pode ser usado por várias threads.
+class CacheOcupacao:
+
+    def __init__(self, capacidade=CAPACIDADE_CACHE_OCUPACAO, validade=VALIDADE_CACHE_OCUPACAO):
+        self.capacidade = capacidade
+
+        # Validade das entradas em segundos, ou None para não expirarem
+        # (quando as alterações de outros terminais são observadas).
+        self.validade = validade
+
+        # Entradas na ordem de uso: chave -> (instante, MapaOcupacao).
+        self.entradas = OrderedDict()
+
+        # Contador de invalidações. Uma consulta iniciada antes de uma
+        # invalidação não pode guardar seu resultado, que pode estar defasado.
+        self.geracao = 0
+
+        self.trava = threading.Lock()
+
+    # Retorna uma cópia da ocupação guardada para a chave, ou None.
+    def obter(self, chave):
+        with self.trava:
+            entrada = self.entradas.get(chave)
+            if entrada is None:
+                return None
+
+            instante, lugares = entrada
+            if self.validade is not None and time.monotonic() - instante > self.validade:
+                del self.entradas[chave]
+                return None
+
+            self.entradas.move_to_end(chave)
+            return lugares.copia()
+
+    # Retorna a geração atual, que deve ser lida antes de consultar o banco
+    # e repassada a 'guardar'.
+    def versao(self):
+        with self.trava:
+            return self.geracao
+
+    # Guarda a ocupação consultada, a menos que o cache tenha sido
+    # invalidado depois que a consulta começou.
+    def guardar(self, chave, lugares, versao):
+        with self.trava:
+            if versao != self.geracao:
+                return
+
+            self.entradas[chave] = (time.monotonic(), lugares.copia())
+            self.entradas.move_to_end(chave)
+
+            while len(self.entradas) > self.capacidade:
+                self.entradas.popitem(last=False)
+
+    # Descarta a entrada de uma viagem, ou todas quando 'chave' é None.
+    def invalidar(self, chave=None):
+        with self.trava:
+            self.geracao += 1
+            if chave is None:
+                self.entradas.clear()
+            else:
+                self.entradas.pop(chave, None)
+
+
+# Define a função 'ler_csv_reservas', que lê um arquivo CSV com as colunas
+# lugar, nome, cpf, dia, horario e, opcionalmente, rota (com cabeçalho).
+# Retorna, para cada linha, uma tupla (entrada, erro): a entrada no formato
+# aceito por 'reservar_lugares' e None, ou None e a mensagem que explica
+# por que a linha foi recusada (por exemplo, um lugar que não é número ou
+# uma coluna vazia), sem interromper a leitura das demais.
+def ler_csv_reservas(caminho):
+    linhas = []
+    with open(caminho, newline="", encoding="utf-8-sig") as arquivo:
+        leitor = csv.DictReader(arquivo)
+        for linha in leitor:
+            campos = {campo: (linha.get(campo) or "").strip()
+                      for campo in ("lugar", "nome", "cpf", "dia", "horario", "rota")}
+
+            faltando = [campo for campo in ("lugar", "nome", "cpf", "dia", "horario")
+                        if not campos[campo]]
+            if faltando:
+                linhas.append((None, f"Linha {leitor.line_num}: "
+                                     f"{', '.join(faltando)} não informado(s)"))
+                continue
+
+            try:
+                lugar = int(campos["lugar"])
+            except ValueError:
+                linhas.append((None, f"Linha {leitor.line_num}: lugar inválido "
+                                     f"({campos['lugar']})"))
+                continue
+
+            linhas.append(((lugar, campos["nome"], campos["cpf"], campos["dia"],
+                            campos["horario"], campos["rota"] or ROTA_PADRAO), None))
+    return linhas
+
+
+# Define a função 'validar_limite', que lança ValueError se o tamanho de
+# uma página da pesquisa não for positivo: com o MongoDB, 'limit(0)' leria
+# todas as reservas.
+def validar_limite(limite):
+    if limite < 1:
+        raise ValueError("O limite da página deve ser maior que zero")
+
+
+# Define a função 'intervalo_partida', que converte os filtros 'dia'
+# (dd/mm/aaaa) e 'data_inicial'/'data_final' (objetos date) de uma pesquisa
+# em um único intervalo de datas de partida (inicio, fim): do início do
+# primeiro dia até antes do dia seguinte ao último. Retorna None se
+# nenhum desses filtros foi informado e lança ValueError se 'dia' for uma
+# data inválida.
+def intervalo_partida(filtros):
+    inicios = []
+    fins = []
+    if "dia" in filtros:
+        dia = datetime.strptime(filtros["dia"], FORMATO_DATA).date()
+        inicios.append(dia)
+        fins.append(dia)
+    if "data_inicial" in filtros or "data_final" in filtros:
+        inicios.append(filtros.get("data_inicial", filtros.get("data_final")))
+        fins.append(filtros.get("data_final", filtros.get("data_inicial")))
+
+    if not inicios:
+        return None
+    return (datetime.combine(max(inicios), datetime.min.time()),
+            datetime.combine(min(fins) + timedelta(days=1), datetime.min.time()))
+
+
+# Define a classe 'MetricasOperacoes', que acumula, para cada operação
+# medida (acessos ao banco e atualizações da interface), a quantidade de
+# chamadas, o tempo total, um histograma da latência (com as faixas de
+# FAIXAS_LATENCIA), a quantidade de documentos retornados e de falhas.
+# Pode ser habilitada e desabilitada a qualquer momento; desabilitada,
+# cada ponto de medição apenas confere 'habilitado' e segue em frente.
+# Pode ser usada por várias threads.
+class MetricasOperacoes:
+
+    def __init__(self, habilitado=False):
+        self.habilitado = habilitado
+        self.trava = threading.Lock()
+        self.operacoes = {}
+
+    def habilitar(self, habilitado=True):
+        self.habilitado = habilitado
+
+    def limpar(self):
+        with self.trava:
+            self.operacoes.clear()
+
+    # Registra uma execução da operação 'nome', com 'duracao' em segundos.
+    def registrar(self, nome, duracao, documentos=0, falha=False):
+        faixa = bisect.bisect_left(FAIXAS_LATENCIA, duracao)
+        with self.trava:
+            operacao = self.operacoes.get(nome)
+            if operacao is None:
+                operacao = self.operacoes[nome] = {
+                    "contagem": 0, "segundos": 0.0, "documentos": 0, "falhas": 0,
+                    "faixas": [0] * (len(FAIXAS_LATENCIA) + 1),
+                }
+            operacao["contagem"] += 1
+            operacao["segundos"] += duracao
+            operacao["documentos"] += documentos
+            operacao["falhas"] += falha
+            operacao["faixas"][faixa] += 1
+
+    # Define o método 'exportar_json', que retorna uma cópia das métricas
+    # como um dicionário pronto para ser gravado em JSON.
+    def exportar_json(self):
+        with self.trava:
+            operacoes = {nome: dict(operacao, faixas=list(operacao["faixas"]))
+                         for nome, operacao in self.operacoes.items()}
+
+        limites = [str(limite) for limite in FAIXAS_LATENCIA] + ["+Inf"]
+        for operacao in operacoes.values():
+            operacao["media_ms"] = round(operacao["segundos"] / operacao["contagem"] * 1000, 3)
+            operacao["faixas"] = dict(zip(limites, operacao["faixas"]))
+
+        return {"gerado_em": datetime.now().isoformat(timespec="seconds"),
+                "habilitado": self.habilitado,
+                "operacoes": operacoes}
+
+    # Define o método 'exportar_prometheus', que retorna as métricas no
+    # formato de texto do Prometheus, com um histograma por operação.
+    def exportar_prometheus(self):
+        with self.trava:
+            operacoes = {nome: dict(operacao, faixas=list(operacao["faixas"]))
+                         for nome, operacao in sorted(self.operacoes.items())}
+
+        linhas = [
+            "# HELP reserva_operacao_segundos Duração das operações de reserva.",
+            "# TYPE reserva_operacao_segundos histogram",
+        ]
+        for nome, operacao in operacoes.items():
+            acumulado = 0
+            for limite, quantidade in zip(FAIXAS_LATENCIA + ["+Inf"], operacao["faixas"]):
+                acumulado += quantidade
+                linhas.append(f'reserva_operacao_segundos_bucket{{operacao="{nome}",le="{limite}"}} '
+                              f'{acumulado}')
+            linhas.append(f'reserva_operacao_segundos_sum{{operacao="{nome}"}} {operacao["segundos"]}')
+            linhas.append(f'reserva_operacao_segundos_count{{operacao="{nome}"}} {operacao["contagem"]}')
+
+        for metrica, campo, ajuda in (
+                ("reserva_operacao_documentos_total", "documentos",
+                 "Documentos retornados ou alterados pelas operações."),
+                ("reserva_operacao_falhas_total", "falhas", "Operações que falharam.")):
+            linhas.append(f"# HELP {metrica} {ajuda}")
+            linhas.append(f"# TYPE {metrica} counter")
+            for nome, operacao in operacoes.items():
+                linhas.append(f'{metrica}{{operacao="{nome}"}} {operacao[campo]}')
+
+        linhas.append("# HELP reserva_metricas_habilitadas Indica se as métricas estão sendo coletadas.")
+        linhas.append("# TYPE reserva_metricas_habilitadas gauge")
+        linhas.append(f"reserva_metricas_habilitadas {int(self.habilitado)}")
+        return "\n".join(linhas) + "\n"
+
+    # Define o método 'gravar', que grava as métricas em JSON no arquivo
+    # 'caminho', substituindo-o de uma só vez.
+    def gravar(self, caminho):
+        temporario = caminho + ".tmp"
+        with open(temporario, "w", encoding="utf-8") as arquivo:
+            json.dump(self.exportar_json(), arquivo, indent=2, ensure_ascii=False)
+        os.replace(temporario, caminho)
+
+    # Define o método 'gravar_periodicamente', que inicia uma thread que
+    # grava as métricas em 'caminho' a cada 'intervalo' segundos, enquanto
+    # estiverem habilitadas.
+    def gravar_periodicamente(self, caminho, intervalo=INTERVALO_METRICAS):
+        def gravar():
+            while True:
+                time.sleep(intervalo)
+                if self.habilitado:
+                    try:
+                        self.gravar(caminho)
+                    except OSError as e:
+                        print(f"Não foi possível gravar as métricas em {caminho}: {e}")
+
+        threading.Thread(target=gravar, name="gravar-metricas", daemon=True).start()
+
+
+# Métricas do processo, habilitadas desde o início com METRICAS=1.
+METRICAS = MetricasOperacoes(os.getenv('METRICAS') == '1')
+
+
+# Define a função 'medir_operacao', um decorador que registra em METRICAS
+# a duração de cada chamada da função decorada com o nome 'nome'. Usado nos
+# métodos das janelas que redesenham a interface.
+def medir_operacao(nome):
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def medida(*args, **kwargs):
+            if not METRICAS.habilitado:
+                return funcao(*args, **kwargs)
+            inicio = time.perf_counter()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                METRICAS.registrar(nome, time.perf_counter() - inicio)
+        return medida
+    return decorador
+
+
+# Define a classe 'ObservadorComandos', que recebe do pymongo (e do motor)
+# cada comando enviado ao MongoDB e registra em METRICAS sua duração e a
+# quantidade de documentos retornados (consultas) ou alterados
+# (gravações), com o nome 'mongo.<comando>.<coleção>'. Assim cada ida e
+# volta ao servidor dentro de uma operação do 'Onibus' é medida.
+class ObservadorComandos(monitoring.CommandListener):
+
+    def __init__(self):
+        # Coleção de cada comando em andamento, pelo 'request_id'.
+        self.colecoes = {}
+
+    def started(self, event):
+        if METRICAS.habilitado:
+            colecao = event.command.get(event.command_name)
+            if isinstance(colecao, str):
+                self.colecoes[event.request_id] = colecao
+
+    def succeeded(self, event):
+        colecao = self.colecoes.pop(event.request_id, None)
+        if METRICAS.habilitado:
+            METRICAS.registrar(self.nome(event, colecao), event.duration_micros / 1e6,
+                               self.documentos(event.reply))
+
+    def failed(self, event):
+        colecao = self.colecoes.pop(event.request_id, None)
+        if METRICAS.habilitado:
+            METRICAS.registrar(self.nome(event, colecao), event.duration_micros / 1e6,
+                               falha=True)
+
+    @staticmethod
+    def nome(event, colecao):
+        return f"mongo.{event.command_name}" + (f".{colecao}" if colecao else "")
+
+    # Documentos do lote devolvido por 'find', 'aggregate' e 'getMore', ou
+    # quantidade de documentos gravados ('n') pelas alterações.
+    @staticmethod
+    def documentos(resposta):
+        cursor = resposta.get("cursor")
+        if cursor is not None:
+            return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        return resposta.get("n", 0)
+
+
+# Observador registrado nos clientes do MongoDB ('Onibus' e 'OnibusAssincrono').
+OBSERVADOR_MONGO = ObservadorComandos()
+
+
+# Define a classe 'OnibusMedido', que envolve um objeto 'onibus' (veja o
+# comentário antes da classe 'Onibus') e registra em METRICAS a duração de
+# cada chamada aos seus métodos, com o nome 'banco.<método>'. Os atributos
+# que não são métodos (como 'cache_ocupacao') e a detecção de recursos
+# com 'hasattr' passam direto para o objeto envolvido. Corrotinas (do
+# 'OnibusAssincrono') são medidas até terminarem.
+class OnibusMedido:
+
+    def __init__(self, onibus):
+        self.onibus = onibus
+
+    def __getattr__(self, nome):
+        atributo = getattr(self.onibus, nome)
+        if nome.startswith("_") or not callable(atributo):
+            return atributo
+
+        operacao = f"banco.{nome}"
+        if inspect.iscoroutinefunction(atributo):
+            async def medido(*args, **kwargs):
+                if not METRICAS.habilitado:
+                    return await atributo(*args, **kwargs)
+                inicio = time.perf_counter()
+                falha = True
+                try:
+                    resultado = await atributo(*args, **kwargs)
+                    falha = False
+                    return resultado
+                finally:
+                    METRICAS.registrar(operacao, time.perf_counter() - inicio, falha=falha)
+        else:
+            def medido(*args, **kwargs):
+                if not METRICAS.habilitado:
+                    return atributo(*args, **kwargs)
+                inicio = time.perf_counter()
+                falha = True
+                try:
+                    resultado = atributo(*args, **kwargs)
+                    falha = False
+                    return resultado
+                finally:
+                    METRICAS.registrar(operacao, time.perf_counter() - inicio, falha=falha)
+
+        # Guarda o método medido no próprio objeto, para que as próximas
+        # chamadas não passem mais por '__getattr__'.
+        setattr(self, nome, medido)
+        return medido
+
+
+# As janelas acessam as reservas apenas pelos métodos de um objeto
+# 'onibus' (o repositório de reservas), que pode ser:
+# - 'Onibus': as reservas ficam no MongoDB;
+# - 'OnibusLocal': as reservas ficam em um arquivo SQLite no próprio
+#   computador, para guichês isolados que não têm um servidor;
+# - 'ClienteServico': as reservas são acessadas pelo serviço HTTP.
+# Todos oferecem os mesmos métodos, com os mesmos parâmetros e resultados:
+# frota ('listar_rotas', 'horarios_rota', 'veiculo_viagem',
+# 'capacidade_viagem'), ocupação ('consultar_ocupacao', 'lugares_ocupados',
+# 'resumos_periodo', 'ocupacao_mes'), reservas ('reservar_lugar',
+# 'reservar_lugares', 'importar_csv', 'cancelar_reserva',
+# 'cancelar_reservas', 'buscar_reserva', 'pesquisar_reservas'), além de
+# 'id_viagem' e do cache 'cache_ocupacao'. Os que também oferecem
+# 'fluxo_viagem' avisam as alterações de outros terminais sem consultas
+# periódicas (veja 'AssinaturaViagem').
 
 # Define a classe Onibus, responsável pela gestão das
 # reservas de um ônibus.
 class Onibus:
 
-    # Método construtor da classe com parâmetro capacidade, que
-    # define o número de lugares no ônibus.
-    def __init__(self, capacidade):
-
-        # Atributo que armazena a capacidade total de lugares no ônibus.
-        self.capacidade = capacidade
+    # Método construtor da classe. A frota (rotas e veículos) fica no
+    # MongoDB; 'capacidade_padrao' é usada apenas para cadastrar o veículo
+    # padrão quando a frota ainda está vazia.
+    def __init__(self, capacidade_padrao=20):
 
-        # Lista que representa os lugares no ônibus, inicializada
-        # com 0 (desocupado) para cada lugar baseado na capacidade.
-        self.lugares = [0] * capacidade
+        # Mapa de ocupação (MapaOcupacao) da última viagem carregada por
+        # 'carregar_reservas'.
+        self.lugares = MapaOcupacao(0)
 
         # Obtém a URI do MongoDB da variável de ambiente ou usa o valor padrão
         mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
 
-        # Adiciona retry na conexão com o MongoDB
-        max_retries = 5
-        retry_delay = 5  # segundos
-        
-        for attempt in range(max_retries):
-            try:
-                # Cria um cliente MongoDB, conectando-se ao servidor MongoDB.
-                self.cliente = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
-                # Testa a conexão
-                self.cliente.admin.command('ping')
-                break
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    raise Exception(f"Falha ao conectar ao MongoDB após {max_retries} tentativas: {str(e)}")
-                print(f"Tentativa {attempt + 1} de {max_retries} falhou. Tentando novamente em {retry_delay} segundos...")
-                time.sleep(retry_delay)
+        # Cria um cliente MongoDB e testa a conexão uma única vez. Se o
+        # servidor não responder, o erro do pymongo é lançado; quem cria o
+        # 'Onibus' decide quando tentar de novo (veja 'conectar_banco' e
+        # 'JanelaInicial').
+        self.cliente = MongoClient(mongo_uri, serverSelectionTimeoutMS=TEMPO_LIMITE_CONEXAO_MS,
+                                   event_listeners=[OBSERVADOR_MONGO])
+        try:
+            self.cliente.admin.command('ping')
+        except PyMongoError:
+            self.cliente.close()
+            raise
 
-        # Seleciona o banco de dados 'reserva_onibus_db' dentro do servidor MongoDB.
-        self.bd = self.cliente["reserva_onibus_db"]
+        # Seleciona o banco de dados dentro do servidor MongoDB: 'reserva_onibus_db',
+        # ou o informado em MONGO_BANCO (usado pelo benchmark_reservas.py).
+        self.bd = self.cliente[os.getenv('MONGO_BANCO', 'reserva_onibus_db')]
 
         # Seleciona a coleção 'reservas' dentro do banco de dados especificado.
         self.colecao_reservas = self.bd["reservas"]
 
-        # Adiciona lista de horários disponíveis
-        self.horarios = ["08:00", "10:00", "12:00", "14:00", "16:00", "18:00", "20:00"]
+        # Seleciona as coleções da frota: rotas (com seus horários e o
+        # veículo de cada horário) e veículos (com capacidade e layout).
+        self.colecao_rotas = self.bd["rotas"]
+        self.colecao_veiculos = self.bd["veiculos"]
+
+        # Seleciona a coleção com o resumo de cada viagem (quantidade de
+        # lugares reservados e mapa de ocupação), mantido a cada reserva
+        # e cancelamento.
+        self.colecao_resumos = self.bd["viagens"]
+
+        # Seleciona a coleção com os lugares em atendimento (bloqueados
+        # enquanto um guichê digita os dados do passageiro) e gera o
+        # identificador deste terminal, gravado em cada bloqueio.
+        self.colecao_bloqueios = self.bd["bloqueios"]
+        self.terminal = uuid.uuid4().hex
+
+        # Identificadores dos bloqueios feitos por este terminal, para que
+        # as reservas só os removam quando existirem.
+        self.bloqueios_terminal = set()
+
+        # Rotas e veículos já lidos do banco. São carregados sob demanda,
+        # na primeira vez em que cada um é usado.
+        self.rotas = {}
+        self.veiculos = {}
+        self.rotas_listadas = False
+
+        # Passa a True quando o MongoDB já foi instruído a guardar as
+        # imagens anteriores dos documentos (veja 'fluxo_viagem').
+        self.imagens_habilitadas = False
+
+        self.cadastrar_frota_padrao(capacidade_padrao)
+
+        # Garante que todos os índices declarados em INDICES_RESERVAS
+        # existam na coleção antes de qualquer consulta.
+        self.garantir_indices()
+
+        # Reservas gravadas antes da frota existir (sem 'viagem') não
+        # aparecem nos mapas até serem migradas. A consulta por None usa o
+        # índice 'reserva_viagem_lugar', sem percorrer a coleção.
+        if self.colecao_reservas.find_one({"viagem": None}, {"_id": 1}):
+            print("Há reservas sem viagem. Execute "
+                  "'python reserva_passagens.py --migrar-campos' para migrá-las.")
+
+        # Reservas gravadas antes da data de partida existir não aparecem
+        # nas pesquisas por data até serem migradas.
+        if self.colecao_reservas.find_one({"partida": {"$exists": False}}, {"_id": 1}):
+            print("Há reservas sem data de partida. Execute "
+                  "'python reserva_passagens.py --migrar-datas' para migrá-las.")
+
+        # Reservas gravadas antes do campo 'nome_busca' existir não
+        # aparecem na pesquisa por nome até serem migradas (a consulta usa
+        # o índice 'reserva_nome_busca').
+        if self.colecao_reservas.find_one({"nome_busca": None, "nome": {"$type": "string"}},
+                                          {"_id": 1}):
+            print("Há reservas sem o nome para pesquisa. Execute "
+                  "'python reserva_passagens.py --migrar-campos' para migrá-las.")
+
+        # Cache da ocupação das viagens consultadas recentemente.
+        self.cache_ocupacao = CacheOcupacao()
+
+        # Bases com reservas gravadas antes dos resumos existirem precisam
+        # gerá-los uma única vez, com os terminais parados. A geração lê
+        # todas as reservas, então não é feita aqui.
+        if (self.colecao_resumos.find_one({}, {"_id": 1}) is None
+                and self.colecao_reservas.find_one({}, {"_id": 1}) is not None):
+            print("As viagens ainda não têm resumos. Execute "
+                  "'python reserva_passagens.py --reconciliar-resumos' para gerá-los.")
+
+        # Opcionalmente observa as alterações feitas por outros terminais
+        # (requer que o MongoDB seja um replica set).
+        if os.getenv('OBSERVAR_RESERVAS') == '1':
+            self.observar_alteracoes()
+
+
+    # Define o método 'cadastrar_frota_padrao', que cadastra a rota e o
+    # veículo padrão caso ainda não existam. Usa 'upsert' com
+    # '$setOnInsert', então nunca altera uma frota já cadastrada e pode ser
+    # executado por vários terminais ao mesmo tempo.
+    def cadastrar_frota_padrao(self, capacidade):
+
+        self.colecao_veiculos.update_one(
+            {"_id": VEICULO_PADRAO},
+            {"$setOnInsert": {"descricao": "Ônibus convencional",
+                              "capacidade": capacidade,
+                              "colunas": 2}},
+            upsert=True
+        )
+
+        self.colecao_rotas.update_one(
+            {"_id": ROTA_PADRAO},
+            {"$setOnInsert": {"nome": "Rota Padrão",
+                              "veiculo": VEICULO_PADRAO,
+                              "horarios": HORARIOS_PADRAO}},
+            upsert=True
+        )
+
+
+    # Define o método 'id_viagem', que monta o identificador de uma viagem
+    # (uma partida de uma rota em um dia e horário). As reservas são
+    # gravadas e consultadas por esse identificador.
+    def id_viagem(self, rota, dia, horario):
+        return f"{rota}|{dia}|{horario}"
+
+
+    # Define o método 'partida_viagem', que converte a data (dd/mm/aaaa) e o
+    # horário (hh:mm) de uma viagem na data e hora da partida, gravada em
+    # cada reserva para permitir consultas por intervalo de datas.
+    # Lança ValueError se a data ou o horário forem inválidos.
+    def partida_viagem(self, dia, horario):
+        return datetime.strptime(f"{dia} {horario}", f"{FORMATO_DATA} %H:%M")
+
+
+    # Define o método 'rota', que retorna o documento de uma rota, lendo-o
+    # do banco apenas na primeira vez.
+    def rota(self, codigo):
+        rota = self.rotas.get(codigo)
+        if rota is None:
+            rota = self.colecao_rotas.find_one({"_id": codigo})
+            if rota is None:
+                raise ValueError(f"Rota {codigo} não cadastrada")
+            self.rotas[codigo] = rota
+        return rota
+
+
+    # Define o método 'listar_rotas', que retorna os códigos de todas as
+    # rotas cadastradas (lidas do banco uma única vez).
+    def listar_rotas(self):
+        if not self.rotas_listadas:
+            for rota in self.colecao_rotas.find({}):
+                self.rotas[rota["_id"]] = rota
+            self.rotas_listadas = True
+        return sorted(self.rotas)
+
+
+    # Define o método 'horarios_rota', que retorna os horários de partida
+    # de uma rota.
+    def horarios_rota(self, rota):
+        return self.rota(rota)["horarios"]
+
+
+    # Define o método 'veiculo', que retorna o documento de um veículo
+    # (capacidade e número de colunas do mapa de assentos), lendo-o do
+    # banco apenas na primeira vez.
+    def veiculo(self, codigo):
+        veiculo = self.veiculos.get(codigo)
+        if veiculo is None:
+            veiculo = self.colecao_veiculos.find_one({"_id": codigo})
+            if veiculo is None:
+                raise ValueError(f"Veículo {codigo} não cadastrado")
+            self.veiculos[codigo] = veiculo
+        return veiculo
+
+
+    # Define o método 'veiculo_viagem', que retorna o veículo que faz uma
+    # viagem: o definido para o horário em 'veiculos_por_horario' da rota,
+    # ou o veículo padrão da rota.
+    def veiculo_viagem(self, rota, horario):
+        dados = self.rota(rota)
+        codigo = dados.get("veiculos_por_horario", {}).get(horario, dados["veiculo"])
+        return self.veiculo(codigo)
+
+
+    # Define o método 'capacidade_viagem', que retorna o número de lugares
+    # da viagem.
+    def capacidade_viagem(self, rota, horario):
+        return self.veiculo_viagem(rota, horario)["capacidade"]
+
+
+    # Define o método 'frota', que retorna todas as rotas com seus
+    # horários e o veículo de cada horário, no formato
+    # [{'codigo', 'horarios': [{'horario', 'veiculo'}]}].
+    def frota(self):
+        return [{"codigo": rota,
+                 "horarios": [{"horario": horario, "veiculo": self.veiculo_viagem(rota, horario)}
+                              for horario in self.horarios_rota(rota)]}
+                for rota in self.listar_rotas()]
+
+
+    # Define o método 'validar_reserva', que lança ValueError se a rota, a
+    # data, o horário ou o lugar de uma reserva forem inválidos.
+    def validar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        self.partida_viagem(dia, horario)
+        if not 1 <= lugar <= self.capacidade_viagem(rota, horario):
+            raise ValueError("Lugar inválido")
+
+
+    # Define o método 'verificar_conexao', que lança um erro do pymongo se o
+    # MongoDB não responder.
+    def verificar_conexao(self):
+        self.cliente.admin.command("ping")
+
+
+    # Define o método 'garantir_indices', que cria os índices declarados em
+    # INDICES_RESERVAS, INDICES_RESUMOS e INDICES_BLOQUEIOS que ainda não existem e
+    # depois remove os índices obsoletos. Pode ser chamado quantas vezes for
+    # necessário, inclusive por vários terminais ao mesmo tempo: índices já
+    # existentes não são recriados. Lança RuntimeError se um índice único
+    # não puder ser criado (veja 'erro_indice_unico').
+    def garantir_indices(self):
+
+        colecoes = [
+            (self.colecao_reservas, INDICES_RESERVAS, INDICES_OBSOLETOS),
+            (self.colecao_resumos, INDICES_RESUMOS, INDICES_RESUMOS_OBSOLETOS),
+            (self.colecao_bloqueios, INDICES_BLOQUEIOS, {}),
+        ]
+
+        for colecao, declarados, obsoletos in colecoes:
+
+            # Obtém os nomes dos índices que já existem na coleção.
+            existentes = set(colecao.index_information())
+
+            # Reservas gravadas antes da frota existir não têm 'viagem' e
+            # repetiriam a chave (None, lugar) do índice único: na primeira
+            # vez em que ele é criado, recebem a viagem da rota padrão.
+            if colecao is self.colecao_reservas and "reserva_viagem_lugar" not in existentes:
+                preenchidas = self.preencher_viagens()
+                if preenchidas:
+                    print(f"Reservas associadas à rota padrão: {preenchidas}. Execute "
+                          f"'python reserva_passagens.py --reconciliar-resumos' para "
+                          f"atualizar os resumos das viagens.")
+
+            # Cria os índices que estão faltando um a um, para que uma falha
+            # em um deles não impeça a criação dos demais.
+            for indice in declarados:
+                if indice["nome"] in existentes:
+                    continue
+                try:
+                    colecao.create_indexes([
+                        IndexModel(indice["chaves"], name=indice["nome"], **indice["opcoes"])
+                    ])
+                except OperationFailure as e:
+                    # Bases antigas podem já conter lugares vendidos em
+                    # duplicidade, o que impede a criação do índice único
+                    # até que sejam corrigidos.
+                    if indice["opcoes"].get("unique"):
+                        raise erro_indice_unico(indice["nome"], e)
+                    print(f"Não foi possível criar o índice {indice['nome']}: {e}")
+
+            # Remove os índices de versões anteriores apenas quando o
+            # substituto já existe, para que a coleção nunca fique sem a
+            # garantia de unicidade dos lugares. Outro terminal iniciado ao
+            # mesmo tempo pode já tê-los removido.
+            atuais = set(colecao.index_information())
+            for nome, substituto in obsoletos.items():
+                if nome in atuais and substituto in atuais:
+                    try:
+                        colecao.drop_index(nome)
+                    except OperationFailure:
+                        pass
+
+
+    # Define o método 'verificar_indices', que compara os índices existentes
+    # na coleção com os declarados e retorna um relatório com:
+    # - 'faltando': índices declarados que não existem na coleção;
+    # - 'nao_declarados': índices existentes que não foram declarados;
+    # - 'nao_utilizados': índices que não receberam nenhum acesso desde
+    #   que o servidor foi iniciado (segundo o estágio $indexStats).
+    def verificar_indices(self):
+
+        declarados = {indice["nome"] for indice in INDICES_RESERVAS}
+
+        # O índice '_id_' é criado automaticamente pelo MongoDB.
+        existentes = set(self.colecao_reservas.index_information()) - {"_id_"}
+
+        # Consulta as estatísticas de uso de cada índice.
+        try:
+            estatisticas = self.colecao_reservas.aggregate([{"$indexStats": {}}])
+            nao_utilizados = sorted(
+                e["name"] for e in estatisticas
+                if e["name"] != "_id_" and e["accesses"]["ops"] == 0
+            )
+        except OperationFailure:
+            # Servidores sem permissão para $indexStats não informam o uso.
+            nao_utilizados = []
+
+        return {
+            "faltando": sorted(declarados - existentes),
+            "nao_declarados": sorted(existentes - declarados),
+            "nao_utilizados": nao_utilizados,
+        }
 
 
     # Define o método 'carregar_reservas' que atualiza o status dos
     # lugares do ônibus com base nas reservas para uma data específica.
-    def carregar_reservas(self, data, horario):
+    def carregar_reservas(self, data, horario, rota=ROTA_PADRAO):
+        self.lugares = self.consultar_ocupacao(data, horario, rota)
+
+
+    # Define o método 'consultar_ocupacao', que retorna um novo MapaOcupacao
+    # com os lugares da viagem (rota, data e horário), sem alterar o
+    # estado do objeto. Por isso pode ser chamado de qualquer thread.
+    # Viagens consultadas recentemente são respondidas pelo cache, sem
+    # acessar o banco.
+    def consultar_ocupacao(self, data, horario, rota=ROTA_PADRAO):
+
+        viagem = self.id_viagem(rota, data, horario)
+        capacidade = self.capacidade_viagem(rota, horario)
 
-        # Cria ou reinicializa a lista 'lugares' com zeros, indicando que
+        lugares = self.cache_ocupacao.obter(viagem)
+        if lugares is not None:
+            return lugares
+
+        versao = self.cache_ocupacao.versao()
+
+        # Cria o mapa 'lugares' sem nenhum bit marcado, indicando que
         # todos os lugares estão disponíveis inicialmente.
-        # O uso de [0] * capacidade cria uma lista que contém o número zero
-        # repetido tantas vezes quanto o valor de 'capacidade'.
-        # Por exemplo, se capacidade é 20, isso resulta em [0, 0, 0, ..., 0] com 20 zeros.
-        self.lugares = [0] * self.capacidade
+        lugares = MapaOcupacao(capacidade)
 
         # Acessa a base de dados e utiliza o método 'find' para procurar todas as
-        # entradas (reservas) onde a chave 'dia' corresponde
-        # ao valor da variável 'data'. O resultado ('reservas') é um iterável que
+        # entradas (reservas) onde a chave 'viagem' corresponde
+        # ao identificador da viagem. O resultado ('reservas') é um iterável que
         # permite percorrer cada documento que representa
-        # uma reserva para esse dia.
-        reservas = self.colecao_reservas.find({"dia": data, "horario" : horario})
+        # uma reserva dessa viagem. Apenas o campo 'lugar' é trazido, e o
+        # MongoDB responde lendo somente o índice 'reserva_viagem_lugar'.
+        reservas = self.colecao_reservas.find({"viagem": viagem}, {"lugar": 1, "_id": 0})
 
         # Inicia um loop que irá percorrer cada documento encontrado na busca.
         for r in reservas:
@@ -138,89 +1241,2397 @@ class Onibus:
             # Verifica se o número do lugar reservado está dentro do
             # intervalo permitido (de 1 até 'capacidade').
             # A verificação assegura que não tentaremos acessar
-            # índices fora da lista 'lugares'.
-            if 1 <= num_lugar <= self.capacidade:
+            # bits fora do mapa 'lugares'.
+            if 1 <= num_lugar <= capacidade:
 
-                # Marca o lugar especificado como ocupado.
-                # Ajusta o índice para base zero (listas em Python
-                # começam em 0, não em 1), subtraindo 1 do número do lugar.
-                # Por exemplo, lugar 1 na reserva corresponde ao
-                # índice 0 na lista, lugar 2 ao índice 1, e assim por diante.
-                self.lugares[num_lugar - 1] = 1
+                # Marca o lugar especificado como ocupado, ligando o bit
+                # 'num_lugar - 1' do mapa (lugar 1 corresponde ao bit 0,
+                # lugar 2 ao bit 1, e assim por diante).
+                lugares.ocupar(num_lugar)
 
+        self.cache_ocupacao.guardar(viagem, lugares, versao)
 
-    # Define o método 'reservar_lugar' para reservar um lugar no ônibus,
-    # recebendo como parâmetros o número do lugar, nome do cliente, CPF e a data da reserva.
-    def reservar_lugar(self, num_lugar, nome, cpf, dia, horario):
+        return lugares
+
+
+    # Define o método 'ocupacao_dia', que retorna a ocupação de todas as
+    # viagens da frota em um dia (dd/mm/aaaa), como um dicionário
+    # {identificador da viagem: MapaOcupacao}, incluindo as viagens ainda
+    # vazias. Todas as reservas do dia são lidas em uma única consulta pelo
+    # índice da data de partida, trazendo apenas a viagem e o lugar.
+    def ocupacao_dia(self, dia):
+
+        ocupacao = {}
+        for rota in self.listar_rotas():
+            for horario in self.horarios_rota(rota):
+                ocupacao[self.id_viagem(rota, dia, horario)] = MapaOcupacao(
+                    self.capacidade_viagem(rota, horario))
+
+        reservas = self.colecao_reservas.find(self.montar_consulta({"dia": dia}),
+                                              {"viagem": 1, "lugar": 1, "_id": 0})
+        for r in reservas:
+            mapa = ocupacao.get(r["viagem"])
+            if mapa is not None:
+                mapa.ocupar(r["lugar"])
+
+        return ocupacao
+
+
+    # Define o método 'operacoes_resumo', que monta as atualizações dos
+    # resumos das viagens para um grupo de reservas gravadas ('ocupados'
+    # verdadeiro) ou removidas (falso). Cada viagem recebe uma única
+    # atualização atômica, que soma a quantidade com '$inc' e liga ou
+    # desliga os bits dos lugares com '$bit'; o resumo é criado na
+    # primeira reserva da viagem ('upsert'). Remoções não criam resumos: se
+    # o resumo da viagem não existir, não há o que descontar.
+    def operacoes_resumo(self, reservas, ocupados):
+
+        viagens = {}
+        for reserva in reservas:
+            viagem = viagens.setdefault(reserva["viagem"], {"reserva": reserva, "quantidade": 0,
+                                                            "palavras": {}})
+            indice = reserva["lugar"] - 1
+            palavra = str(indice // BITS_PALAVRA_RESUMO)
+            viagem["palavras"][palavra] = (viagem["palavras"].get(palavra, 0)
+                                           | 1 << (indice % BITS_PALAVRA_RESUMO))
+            viagem["quantidade"] += 1
+
+        operacoes = []
+        for codigo, viagem in viagens.items():
+            reserva = viagem["reserva"]
+
+            if ocupados:
+                bits = {f"ocupacao.{palavra}": {"or": Int64(mascara)}
+                        for palavra, mascara in viagem["palavras"].items()}
+            else:
+                bits = {f"ocupacao.{palavra}": {"and": Int64(~mascara)}
+                        for palavra, mascara in viagem["palavras"].items()}
+
+            try:
+                partida = self.partida_viagem(reserva["dia"], reserva["horario"])
+            except ValueError:
+                partida = None
+
+            operacoes.append(UpdateOne(
+                {"_id": codigo},
+                {"$inc": {"reservados": viagem["quantidade"] if ocupados else -viagem["quantidade"]},
+                 "$bit": bits,
+                 "$setOnInsert": {"rota": reserva["rota"], "dia": reserva["dia"],
+                                  "horario": reserva["horario"], "partida": partida}},
+                upsert=ocupados
+            ))
+
+        return operacoes
+
+
+    # Define o método 'reconciliar_resumos', que reconstrói os resumos das
+    # viagens a partir das próprias reservas, corrigindo qualquer diferença
+    # (por exemplo, um terminal que caiu entre gravar a reserva e o resumo).
+    # 'viagens' é uma lista de identificadores de viagens, ou None para
+    # reconstruir todos os resumos. As reservas são lidas ordenadas pela
+    # viagem, trazendo apenas a viagem e o lugar, o que o MongoDB responde
+    # lendo somente o índice 'reserva_viagem_lugar', e os resumos são
+    # regravados em lotes. Resumos de viagens sem nenhuma reserva são
+    # removidos. Deve ser executado com os terminais parados quando
+    # reconstrói todos os resumos, pois uma reserva gravada durante a
+    # reconstrução pode ser sobrescrita. Retorna quantos resumos foram gravados.
+    def reconciliar_resumos(self, viagens=None):
+
+        consulta = {} if viagens is None else {"viagem": {"$in": list(viagens)}}
+        reservas = (self.colecao_reservas.find(consulta, {"viagem": 1, "lugar": 1, "_id": 0})
+                    .sort([("viagem", ASCENDING), ("lugar", ASCENDING)])
+                    .batch_size(TAMANHO_LOTE_RESUMOS))
+
+        inicio = datetime.now()
+        gravados = set()
+        lote = []
+
+        for codigo, lugares in self.agrupar_lugares(reservas):
+            lote.append(self.regravacao_resumo(codigo, lugares, inicio))
+            gravados.add(codigo)
+
+            if len(lote) >= TAMANHO_LOTE_RESUMOS:
+                self.colecao_resumos.bulk_write(lote, ordered=False)
+                lote.clear()
+
+        if lote:
+            self.colecao_resumos.bulk_write(lote, ordered=False)
+
+        # Remove os resumos das viagens que ficaram sem reservas.
+        if viagens is None:
+            self.colecao_resumos.delete_many({"$or": [
+                {"reconciliado_em": {"$lt": inicio}},
+                {"reconciliado_em": {"$exists": False}},
+            ]})
+        else:
+            vazias = [codigo for codigo in viagens if codigo not in gravados]
+            if vazias:
+                self.colecao_resumos.delete_many({"_id": {"$in": vazias}})
+
+        return len(gravados)
+
+
+    # Define o método 'agrupar_lugares', que percorre reservas ordenadas
+    # pela viagem e gera, para cada viagem, a tupla (viagem, lugares).
+    # Também usado pelo 'OnibusAssincrono'.
+    def agrupar_lugares(self, reservas):
+        atual = None
+        lugares = []
+        for reserva in reservas:
+            if reserva["viagem"] != atual:
+                if atual is not None:
+                    yield atual, lugares
+                atual = reserva["viagem"]
+                lugares = []
+            lugares.append(reserva["lugar"])
+
+        if atual is not None:
+            yield atual, lugares
+
+
+    # Define o método 'regravacao_resumo', que monta a operação que regrava
+    # o resumo de uma viagem com os lugares reservados.
+    def regravacao_resumo(self, codigo, lugares, inicio):
+        return ReplaceOne({"_id": codigo}, self.documento_resumo(codigo, lugares, inicio),
+                          upsert=True)
+
+
+    # Define o método 'ocupacao_mes', que retorna quantos lugares estão
+    # reservados em cada dia de um mês de uma rota, somando todos os
+    # horários. Usa uma única agregação sobre os resumos das viagens do mês
+    # (pelo índice 'viagem_rota_partida_reservados', que já contém todos
+    # os campos usados, sem ler os resumos), agrupada por dia e horário.
+    # Retorna um dicionário {dia: (reservados, capacidade do dia)}; dias sem
+    # reservas não aparecem.
+    def ocupacao_mes(self, ano, mes, rota=ROTA_PADRAO):
+
+        inicio = datetime(ano, mes, 1)
+        fim = datetime(ano + mes // 12, mes % 12 + 1, 1)
+
+        grupos = self.colecao_resumos.aggregate([
+            {"$match": {"rota": rota, "partida": {"$gte": inicio, "$lt": fim}}},
+            {"$group": {"_id": {"dia": "$dia", "horario": "$horario"},
+                        "reservados": {"$sum": "$reservados"}}},
+        ])
+
+        capacidade = sum(self.capacidade_viagem(rota, horario)
+                         for horario in self.horarios_rota(rota))
+
+        reservados = {}
+        for grupo in grupos:
+            dia = grupo["_id"]["dia"]
+            reservados[dia] = reservados.get(dia, 0) + grupo["reservados"]
+
+        return {dia: (quantidade, capacidade)
+                for dia, quantidade in reservados.items() if quantidade > 0}
+
+
+    # Define o método 'documento_resumo', que monta o resumo completo de uma
+    # viagem a partir dos números dos lugares reservados.
+    def documento_resumo(self, codigo, lugares, reconciliado_em):
+        rota, dia, horario = codigo.split("|")
+        try:
+            partida = self.partida_viagem(dia, horario)
+        except ValueError:
+            partida = None
+
+        palavras = {}
+        for lugar in lugares:
+            indice = lugar - 1
+            palavra = str(indice // BITS_PALAVRA_RESUMO)
+            palavras[palavra] = palavras.get(palavra, 0) | 1 << (indice % BITS_PALAVRA_RESUMO)
+
+        return {
+            "rota": rota, "dia": dia, "horario": horario, "partida": partida,
+            "reservados": len(lugares),
+            "ocupacao": {palavra: Int64(bits) for palavra, bits in palavras.items()},
+            "reconciliado_em": reconciliado_em,
+        }
+
+
+    # Define o método 'bits_resumo', que converte o mapa de ocupação gravado
+    # em um resumo de volta no mapa de bits de um MapaOcupacao.
+    def bits_resumo(self, resumo):
+        bits = 0
+        for palavra, valor in resumo.get("ocupacao", {}).items():
+            bits |= int(valor) << (int(palavra) * BITS_PALAVRA_RESUMO)
+        return bits
+
+
+    # Define o método 'resumos_periodo', que retorna a ocupação das viagens
+    # de uma rota entre duas datas (objetos date, inclusive), lida dos
+    # resumos em uma única consulta pelo índice 'viagem_rota_partida_reservados'.
+    # Retorna um dicionário {(dia, horario): MapaOcupacao}; viagens sem
+    # nenhuma reserva não aparecem.
+    def resumos_periodo(self, inicio, fim, rota=ROTA_PADRAO):
+
+        resumos = self.colecao_resumos.find({
+            "rota": rota,
+            "partida": {"$gte": datetime.combine(inicio, datetime.min.time()),
+                        "$lt": datetime.combine(fim + timedelta(days=1), datetime.min.time())},
+        }, {"dia": 1, "horario": 1, "ocupacao": 1, "_id": 0})
+
+        ocupacao = {}
+        for resumo in resumos:
+            try:
+                capacidade = self.capacidade_viagem(rota, resumo["horario"])
+            except ValueError:
+                continue
+            ocupacao[(resumo["dia"], resumo["horario"])] = MapaOcupacao(capacidade,
+                                                                       self.bits_resumo(resumo))
+
+        return ocupacao
+
+
+    # Define o método 'bloquear_lugar', que marca um lugar livre como em
+    # atendimento neste terminal por DURACAO_BLOQUEIO segundos, enquanto o
+    # atendente digita os dados do passageiro. Os outros terminais mostram
+    # o lugar com outra cor e não conseguem reservá-lo. Chamado de novo
+    # pelo mesmo terminal, renova o bloqueio. Retorna False se o lugar já
+    # está reservado ou em atendimento em outro guichê.
+    def bloquear_lugar(self, lugar, dia, horario, rota=ROTA_PADRAO):
+
+        viagem = self.id_viagem(rota, dia, horario)
+        agora = datetime.now(timezone.utc)
+        expira_em = agora + timedelta(seconds=DURACAO_BLOQUEIO)
+
+        # O '_id' do bloqueio é o próprio lugar da viagem, então dois
+        # terminais nunca bloqueiam o mesmo lugar ao mesmo tempo.
+        try:
+            self.colecao_bloqueios.insert_one({
+                "_id": f"{viagem}|{lugar}",
+                "viagem": viagem,
+                "lugar": lugar,
+                "terminal": self.terminal,
+                "expira_em": expira_em,
+            })
+
+        except DuplicateKeyError:
+
+            # Renova o bloqueio deste terminal ou assume um bloqueio vencido
+            # que o índice TTL ainda não removeu.
+            resultado = self.colecao_bloqueios.update_one(
+                {"_id": f"{viagem}|{lugar}",
+                 "$or": [{"terminal": self.terminal}, {"expira_em": {"$lte": agora}}]},
+                {"$set": {"terminal": self.terminal, "expira_em": expira_em}}
+            )
+            if not resultado.matched_count:
+                return False
+
+        self.bloqueios_terminal.add(f"{viagem}|{lugar}")
+
+        # Um lugar já reservado não fica bloqueado. A consulta é feita
+        # depois de gravar o bloqueio, mas não fecha todas as corridas: uma
+        # reserva de outro terminal que conferiu os bloqueios antes deste
+        # ser gravado e é inserida logo depois desta consulta passa, e o
+        # bloqueio fica num lugar já vendido. O índice único (viagem, lugar)
+        # continua impedindo a venda dupla; o bloqueio que sobrou é
+        # desfeito na próxima renovação (veja 'JanelaCadastro'), que repete
+        # esta consulta e encontra a reserva.
+        if self.colecao_reservas.find_one({"viagem": viagem, "lugar": lugar},
+                                          {"lugar": 1, "_id": 0}):
+            self.liberar_lugar(lugar, dia, horario, rota)
+            return False
+
+        return True
+
+
+    # Define o método 'liberar_lugar', que desfaz o bloqueio de um lugar
+    # feito por este terminal (ao fechar a janela de cadastro).
+    def liberar_lugar(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        codigo = f"{self.id_viagem(rota, dia, horario)}|{lugar}"
+        self.bloqueios_terminal.discard(codigo)
+        self.colecao_bloqueios.delete_one({"_id": codigo, "terminal": self.terminal})
+
+
+    # Define o método 'lugares_bloqueados', que retorna o conjunto dos
+    # lugares de uma viagem em atendimento em outros terminais.
+    def lugares_bloqueados(self, dia, horario, rota=ROTA_PADRAO):
+        bloqueios = self.colecao_bloqueios.find(
+            {"viagem": self.id_viagem(rota, dia, horario),
+             "expira_em": {"$gt": datetime.now(timezone.utc)},
+             "terminal": {"$ne": self.terminal}},
+            {"lugar": 1, "_id": 0}
+        )
+        return {bloqueio["lugar"] for bloqueio in bloqueios}
+
+
+    # Define o método 'lugar_em_atendimento', que informa se um lugar de uma
+    # viagem está em atendimento em outro terminal, lendo apenas o
+    # bloqueio do próprio lugar pelo '_id'.
+    def lugar_em_atendimento(self, lugar, viagem):
+        return self.colecao_bloqueios.find_one(
+            {"_id": f"{viagem}|{lugar}",
+             "terminal": {"$ne": self.terminal},
+             "expira_em": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 1}
+        ) is not None
+
+
+    # Define o método 'concluir_bloqueios', que remove os bloqueios deste
+    # terminal dos lugares que acabaram de ser reservados. Sem bloqueios
+    # deste terminal nesses lugares, não acessa o banco.
+    def concluir_bloqueios(self, docs):
+        codigos = [f"{doc['viagem']}|{doc['lugar']}" for doc in docs]
+        codigos = [codigo for codigo in codigos if codigo in self.bloqueios_terminal]
+        if not codigos:
+            return
+
+        self.bloqueios_terminal.difference_update(codigos)
+        self.colecao_bloqueios.delete_many({"_id": {"$in": codigos}, "terminal": self.terminal})
+
+
+    # Define o método 'montar_reserva', que confere o lugar e a data de uma
+    # reserva em uma viagem de 'capacidade' lugares e monta o documento a
+    # gravar. Retorna (documento, None), ou (None, mensagem) se a reserva
+    # for inválida. Não acessa o banco, então é usado também pelo
+    # 'OnibusAssincrono'.
+    def montar_reserva(self, num_lugar, nome, cpf, dia, horario, rota, capacidade):
 
         # Verifica se o número do lugar é válido, ou seja, deve estar
-        # dentro do intervalo de 1 até a capacidade máxima do ônibus.
-        if num_lugar < 1 or num_lugar > self.capacidade:
+        # dentro do intervalo de 1 até a capacidade do veículo da viagem.
+        if num_lugar < 1 or num_lugar > capacidade:
 
             # Retorna uma mensagem indicando que o número do lugar é
             # inválido se estiver fora do intervalo.
-            return "Lugar inválido"
+            return None, MENSAGEM_LUGAR_INVALIDO
 
-        # Chama o método 'carregar_reservas' para atualizar o estado
-        # atual dos lugares para a data especificada.
-        self.carregar_reservas(dia, horario)
-
-        # Verifica se o lugar especificado está disponível (0 indica disponível).
-        if self.lugares[num_lugar - 1] == 0:
-
-            # Se disponível, marca o lugar como reservado (atribuindo 1).
-            self.lugares[num_lugar - 1] = 1
+        try:
+            partida = self.partida_viagem(dia, horario)
+        except ValueError:
+            return None, MENSAGEM_DATA_INVALIDA.format(dia=dia, horario=horario)
+
+        # Cria um dicionário contendo os detalhes da reserva.
+        return {
+            "lugar": num_lugar,  # Número do lugar.
+            "nome": nome,  # Nome do cliente.
+            "nome_busca": nome.lower(),  # Nome em minúsculas, usado na pesquisa.
+            "cpf": cpf,  # CPF do cliente.
+            "dia": dia, # Data da reserva.
+            "horario": horario,
+            "partida": partida,  # Data e hora da partida, para consultas por período.
+            "rota": rota,
+            "viagem": self.id_viagem(rota, dia, horario)  # Chave da viagem.
+        }, None
 
-            # Cria um dicionário contendo os detalhes da reserva.
-            doc = {
-                "lugar": num_lugar,  # Número do lugar.
-                "nome": nome,  # Nome do cliente.
-                "cpf": cpf,  # CPF do cliente.
-                "dia": dia, # Data da reserva.
-                "horario": horario
-            }
 
-            # Insere o documento da reserva na coleção de reservas
-            # no banco de dados MongoDB.
+    # Define o método 'reservar_lugar' para reservar um lugar no ônibus,
+    # recebendo como parâmetros o número do lugar, nome do cliente, CPF, a data,
+    # o horário e a rota da viagem.
+    def reservar_lugar(self, num_lugar, nome, cpf, dia, horario, rota=ROTA_PADRAO):
+
+        doc, erro = self.montar_reserva(num_lugar, nome, cpf, dia, horario, rota,
+                                        self.capacidade_viagem(rota, horario))
+        if erro is not None:
+            return erro
+
+        # Um lugar em atendimento em outro guichê não pode ser reservado
+        # até que o bloqueio seja desfeito ou vença. Um bloqueio gravado
+        # depois desta consulta não é visto aqui: se ele também não vir
+        # esta reserva, os dois seguem, e só a renovação do bloqueio o
+        # desfaz (veja 'bloquear_lugar'). O índice único (viagem, lugar)
+        # garante que o lugar não é vendido duas vezes.
+        if self.lugar_em_atendimento(num_lugar, doc["viagem"]):
+            return f"Lugar {num_lugar} em atendimento em outro guichê para {horario}"
+
+        # Tenta inserir a reserva diretamente, em uma única escrita.
+        # O índice único (viagem, lugar) faz o próprio MongoDB
+        # recusar a inserção se o lugar já estiver ocupado, sem precisar
+        # carregar as reservas da viagem antes.
+        try:
             self.colecao_reservas.insert_one(doc)
 
-            # Retorna uma mensagem de sucesso, indicando que o
-            # lugar foi reservado com sucesso.
-            return f"Lugar {num_lugar} reservado com sucesso para {horario}"
+        except DuplicateKeyError:
 
-        else:
+            # O cache mostrava o lugar como livre, mas outro terminal já o
+            # reservou: descarta a ocupação guardada para esta viagem.
+            self.cache_ocupacao.invalidar(doc["viagem"])
 
             # Se o lugar já está ocupado, retorna uma mensagem
             # indicando que o lugar está indisponível.
             return f"Lugar {num_lugar} indisponível para {horario}"
 
+        self.cache_ocupacao.invalidar(doc["viagem"])
+
+        # Soma o lugar ao resumo da viagem. Só chega aqui quem realmente
+        # gravou a reserva, então o resumo nunca conta um lugar duas vezes.
+        self.colecao_resumos.bulk_write(self.operacoes_resumo([doc], True))
+        self.concluir_bloqueios([doc])
+
+        # Retorna uma mensagem de sucesso, indicando que o
+        # lugar foi reservado com sucesso.
+        return MENSAGEM_RESERVADO.format(lugar=num_lugar, horario=horario)
+
+
+    # Define o método 'reservar_lugares', que reserva vários lugares de uma
+    # vez (grupos e fretamentos), possivelmente em viagens diferentes.
+    # 'entradas' é uma lista de tuplas (lugar, nome, cpf, dia, horario) ou
+    # (lugar, nome, cpf, dia, horario, rota); sem a rota, usa ROTA_PADRAO.
+    # Cada viagem tem sua ocupação consultada uma única vez e as reservas
+    # válidas são gravadas com um único 'insert_many'.
+    # Com 'tudo_ou_nada', nenhuma reserva é gravada se alguma delas não puder
+    # ser feita, e a gravação ocorre em uma transação (requer replica set).
+    # Retorna, na mesma ordem das entradas, uma lista de tuplas
+    # (reservado, mensagem).
+    def reservar_lugares(self, entradas, tudo_ou_nada=False):
+
+        entradas = self.normalizar_entradas(entradas)
+
+        capacidades = {}
+        for _, _, _, _, horario, rota in entradas:
+            if (rota, horario) not in capacidades:
+                try:
+                    capacidades[(rota, horario)] = self.capacidade_viagem(rota, horario)
+                except ValueError as e:
+                    capacidades[(rota, horario)] = e
+        resultados, candidatos = self.validar_entradas(entradas, capacidades)
+
+        # Ocupação de cada viagem envolvida, incluindo os lugares já
+        # escolhidos por entradas anteriores do próprio lote, e lugares
+        # em atendimento em outros guichês.
+        ocupacao = {}
+        bloqueados = {}
+        for _, doc in candidatos:
+            viagem = doc["viagem"]
+            if viagem not in ocupacao:
+                ocupacao[viagem] = self.lugares_ocupados(doc["dia"], doc["horario"], doc["rota"])
+                bloqueados[viagem] = self.lugares_bloqueados(doc["dia"], doc["horario"], doc["rota"])
+
+        docs, posicoes = self.escolher_lugares(entradas, resultados, candidatos,
+                                               ocupacao, bloqueados)
+
+        if tudo_ou_nada and len(posicoes) < len(entradas):
+            return self.recusar_grupo(entradas, resultados, posicoes,
+                                      "há outros lugares do grupo indisponíveis")
+
+        if not docs:
+            return resultados
+
+        # Lugares que o MongoDB recusou por já terem sido reservados por
+        # outro terminal depois da consulta da ocupação.
+        recusados = set()
 
-    # Define o método 'cancelar_reserva' para cancelar uma reserva de um
-    # lugar específico em uma data específica.
-    def cancelar_reserva(self, lugar, dia, horario):
+        try:
+            if tudo_ou_nada:
+                # As reservas e os resumos das viagens são gravados juntos.
+                def gravar(s):
+                    self.colecao_reservas.insert_many(docs, session=s)
+                    self.colecao_resumos.bulk_write(self.operacoes_resumo(docs, True), session=s)
+
+                with self.cliente.start_session() as sessao:
+                    sessao.with_transaction(gravar)
+            else:
+                # Com 'ordered=False', um lugar recusado não impede a
+                # gravação dos demais.
+                self.colecao_reservas.insert_many(docs, ordered=False)
+
+        except BulkWriteError as e:
+            if tudo_ou_nada:
+                return self.recusar_grupo(entradas, resultados, posicoes,
+                                          "lugar reservado por outro terminal")
+            recusados = {erro["index"] for erro in e.details["writeErrors"]}
+
+        except DuplicateKeyError:
+            # Em transações o conflito é informado como um erro único.
+            return self.recusar_grupo(entradas, resultados, posicoes,
+                                      "lugar reservado por outro terminal")
+
+        finally:
+            for viagem in ocupacao:
+                self.cache_ocupacao.invalidar(viagem)
+
+        # Soma aos resumos das viagens apenas os lugares que foram gravados.
+        gravados = [doc for j, doc in enumerate(docs) if j not in recusados]
+        if not tudo_ou_nada and gravados:
+            self.colecao_resumos.bulk_write(self.operacoes_resumo(gravados, True))
+        if gravados:
+            self.concluir_bloqueios(gravados)
+
+        return self.concluir_resultados(entradas, resultados, posicoes, recusados)
+
+
+    # Define o método 'normalizar_entradas', que completa com ROTA_PADRAO
+    # as entradas de 'reservar_lugares' informadas sem a rota.
+    def normalizar_entradas(self, entradas):
+        return [tuple(entrada) if len(entrada) == 6 else (*entrada, ROTA_PADRAO)
+                for entrada in entradas]
+
+
+    # Os métodos a seguir são as etapas de 'reservar_lugares' que não
+    # acessam o banco, usadas também pelo 'OnibusAssincrono': cada classe
+    # faz apenas as consultas e as gravações entre elas.
+
+    # Define o método 'validar_entradas', que confere as entradas com a
+    # capacidade de cada viagem ('capacidades', {(rota, horario):
+    # capacidade}, ou o ValueError da rota não cadastrada). Retorna a lista
+    # de resultados, preenchida para as entradas inválidas, e a lista de
+    # (posição, documento) das demais.
+    def validar_entradas(self, entradas, capacidades):
+        resultados = [None] * len(entradas)
+        candidatos = []
+
+        for i, (num_lugar, nome, cpf, dia, horario, rota) in enumerate(entradas):
+            capacidade = capacidades[(rota, horario)]
+            if isinstance(capacidade, ValueError):
+                resultados[i] = (False, str(capacidade))
+                continue
+
+            doc, erro = self.montar_reserva(num_lugar, nome, cpf, dia, horario, rota, capacidade)
+            if erro is not None:
+                resultados[i] = (False, erro)
+                continue
+
+            candidatos.append((i, doc))
+
+        return resultados, candidatos
+
+
+    # Define o método 'escolher_lugares', que separa dos candidatos os
+    # lugares livres, conferindo-os com a ocupação ('ocupacao') e os
+    # bloqueios ('bloqueados') de cada viagem; os lugares escolhidos são
+    # somados à ocupação, para que duas entradas do lote não fiquem com o
+    # mesmo lugar. Retorna os documentos a gravar e a posição de cada um na
+    # lista de entradas.
+    def escolher_lugares(self, entradas, resultados, candidatos, ocupacao, bloqueados):
+        docs = []
+        posicoes = []
+
+        for i, doc in candidatos:
+            num_lugar, horario, viagem = doc["lugar"], doc["horario"], doc["viagem"]
+
+            if num_lugar in ocupacao[viagem]:
+                resultados[i] = (False, f"Lugar {num_lugar} indisponível para {horario}")
+                continue
+
+            if num_lugar in bloqueados[viagem]:
+                resultados[i] = (False, f"Lugar {num_lugar} em atendimento em outro guichê "
+                                        f"para {horario}")
+                continue
+
+            ocupacao[viagem].add(num_lugar)
+            docs.append(doc)
+            posicoes.append(i)
+
+        return docs, posicoes
+
+
+    # Define o método 'recusar_grupo', que marca como não reservadas as
+    # entradas escolhidas ('posicoes') quando o grupo não pode ser gravado
+    # inteiro (com 'tudo_ou_nada').
+    def recusar_grupo(self, entradas, resultados, posicoes, motivo):
+        for i in posicoes:
+            num_lugar, _, _, _, horario, _ = entradas[i]
+            resultados[i] = (False, f"Lugar {num_lugar} não reservado para {horario}: {motivo}")
+        return resultados
+
+
+    # Define o método 'concluir_resultados', que preenche os resultados
+    # das entradas gravadas; 'recusados' são os índices, na lista de
+    # documentos, dos lugares que o banco recusou.
+    def concluir_resultados(self, entradas, resultados, posicoes, recusados):
+        for j, i in enumerate(posicoes):
+            num_lugar, _, _, _, horario, _ = entradas[i]
+            if j in recusados:
+                resultados[i] = (False, f"Lugar {num_lugar} indisponível para {horario}")
+            else:
+                resultados[i] = (True, MENSAGEM_RESERVADO.format(lugar=num_lugar,
+                                                                 horario=horario))
+        return resultados
+
+
+    # Define o método 'importar_csv', que lê um arquivo CSV (veja
+    # 'ler_csv_reservas') e reserva as linhas válidas com
+    # 'reservar_lugares'. Retorna a lista de resultados, um por linha; as
+    # linhas recusadas na leitura recebem (False, mensagem), e com
+    # 'tudo_ou_nada' nenhuma linha é reservada se alguma foi recusada.
+    def importar_csv(self, caminho, tudo_ou_nada=False):
 
-        # Primeiro, carrega todas as reservas para a data especificada para
-        # atualizar o estado atual dos lugares.
-        self.carregar_reservas(dia, horario)
+        linhas = ler_csv_reservas(caminho)
+        entradas = [entrada for entrada, erro in linhas if erro is None]
+
+        if tudo_ou_nada and len(entradas) < len(linhas):
+            return [(False, erro) if erro is not None
+                    else (False, f"Lugar {entrada[0]} não reservado para {entrada[4]}: "
+                                 f"há linhas inválidas no arquivo")
+                    for entrada, erro in linhas]
+
+        resultados = iter(self.reservar_lugares(entradas, tudo_ou_nada) if entradas else [])
+        return [(False, erro) if erro is not None else next(resultados)
+                for entrada, erro in linhas]
 
-        # Verifica se o número do lugar está dentro da capacidade do ônibus e se o
-        # lugar está atualmente reservado ('1' indica reservado).
-        if 1 <= lugar <= self.capacidade and self.lugares[lugar - 1] == 1:
 
-            # Se o lugar está reservado, executa a operação de remoção da
-            # reserva no banco de dados.
-            # O método 'delete_one' remove um documento específico da coleção,
-            # neste caso, onde 'lugar' e 'dia' correspondem aos fornecidos.
-            self.colecao_reservas.delete_one({"lugar": lugar, "dia": dia,"horario": horario})
+    # Define o método 'cancelar_reserva' para cancelar uma reserva de um
+    # lugar específico em uma viagem (data, horário e rota) específica.
+    def cancelar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+
+        if self.remover_reserva(lugar, dia, horario, rota):
 
             # Retorna uma mensagem informando que a reserva foi cancelada com sucesso.
             return f"Lugar {lugar} reserva cancelada para {horario}"
 
+        # Se o lugar não está reservado, retorna uma mensagem
+        # indicando que não há reserva para cancelar.
+        return f"Lugar {lugar} não está reservado para {horario}"
+
+
+    # Define o método 'remover_reserva', que remove a reserva de um lugar
+    # em uma viagem e retorna True, ou False se o lugar não estava reservado.
+    def remover_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+
+        # Verifica se o número do lugar está dentro da capacidade do veículo.
+        if 1 <= lugar <= self.capacidade_viagem(rota, horario):
+
+            viagem = self.id_viagem(rota, dia, horario)
+
+            # Remove a reserva diretamente. O método 'delete_one' remove um
+            # documento específico da coleção, onde 'viagem' e 'lugar'
+            # correspondem aos fornecidos, e informa quantos foram removidos,
+            # o que dispensa carregar as reservas da viagem antes.
+            resultado = self.colecao_reservas.delete_one({"viagem": viagem, "lugar": lugar})
+
+            self.cache_ocupacao.invalidar(viagem)
+
+            if resultado.deleted_count:
+
+                # Retira o lugar do resumo da viagem.
+                self.colecao_resumos.bulk_write(self.operacoes_resumo(
+                    [{"lugar": lugar, "dia": dia, "horario": horario,
+                      "rota": rota, "viagem": viagem}], False))
+
+                return True
+
+        return False
+
+
+    # Define o método 'cancelar_reservas', que cancela de uma só vez todas as
+    # reservas que atendem aos filtros (os mesmos de 'montar_consulta'), por
+    # exemplo uma viagem inteira ({'viagem'}), um período
+    # ({'data_inicial', 'data_final'}) ou um CPF ({'cpf'}).
+    # As reservas são removidas em lotes de TAMANHO_LOTE_CANCELAMENTO: os
+    # identificadores do lote são lidos e apenas essas reservas são
+    # removidas (e, com 'arquivar', antes copiadas no servidor para a
+    # coleção 'reservas_canceladas'), de modo que uma reserva gravada por
+    # outro terminal durante o cancelamento nunca é removida sem ter sido
+    # arquivada; se atender aos filtros, entra no lote seguinte. Os
+    # lugares removidos são descontados dos resumos das viagens, como em
+    # 'remover_reserva', sem sobrescrever as reservas feitas por outros
+    # terminais. Retorna quantas reservas foram removidas.
+    def cancelar_reservas(self, filtros, arquivar=False):
+
+        consulta = self.consulta_cancelamento(filtros)
+
+        removidas = 0
+        try:
+            while True:
+                lote = list(self.colecao_reservas.find(consulta, CAMPOS_RESUMO_RESERVA)
+                            .limit(TAMANHO_LOTE_CANCELAMENTO))
+                if not lote:
+                    break
+                ids = {"_id": {"$in": [reserva["_id"] for reserva in lote]}}
+
+                if arquivar:
+                    self.colecao_reservas.aggregate(self.arquivamento(ids))
+
+                quantidade = self.colecao_reservas.delete_many(ids).deleted_count
+                removidas += quantidade
+
+                operacoes, reconciliar = self.resumo_cancelamento(lote, quantidade)
+                if operacoes:
+                    self.colecao_resumos.bulk_write(operacoes)
+                if reconciliar:
+                    self.reconciliar_resumos(reconciliar)
+        finally:
+            # As viagens afetadas podem ser muitas: descarta todo o cache.
+            self.cache_ocupacao.invalidar()
+
+        return removidas
+
+
+    # Os métodos a seguir são as etapas de 'cancelar_reservas' que não
+    # acessam o banco, usadas também pelo 'OnibusAssincrono'.
+
+    # Define o método 'consulta_cancelamento', que monta a consulta do
+    # cancelamento em lote. Lança ValueError sem nenhum filtro, para evitar
+    # apagar todas as reservas por engano.
+    def consulta_cancelamento(self, filtros):
+        consulta = self.montar_consulta(filtros)
+        if not consulta:
+            raise ValueError("Informe ao menos um filtro para cancelar reservas em lote.")
+        return consulta
+
+    # Define o método 'arquivamento', que monta a agregação que copia as
+    # reservas de um lote ('ids') para a coleção 'reservas_canceladas'.
+    def arquivamento(self, ids):
+        return [
+            {"$match": ids},
+            {"$set": {"cancelada_em": datetime.now()}},
+            {"$merge": {"into": "reservas_canceladas", "whenMatched": "replace"}},
+        ]
+
+    # Define o método 'resumo_cancelamento', que escolhe como atualizar os
+    # resumos depois de remover 'quantidade' reservas de um lote. Retorna
+    # as operações que descontam os lugares e as viagens cujos resumos
+    # devem ser refeitos: se outro terminal cancelou parte do lote ao mesmo
+    # tempo (e já a descontou), não se sabe quais, então os resumos dessas
+    # viagens são refeitos em vez de descontados.
+    def resumo_cancelamento(self, lote, quantidade):
+        if quantidade == len(lote):
+            return self.operacoes_resumo(lote, False), set()
+        return [], {reserva["viagem"] for reserva in lote}
+
+
+    # Define o método 'observar_alteracoes', que acompanha em uma thread
+    # separada as alterações da coleção de reservas (change stream) e
+    # descarta do cache as viagens alteradas por outros terminais. Enquanto
+    # a observação está ativa, as entradas do cache não expiram.
+    def observar_alteracoes(self):
+
+        def observar():
+            try:
+                # 'whenAvailable' traz o documento removido quando o MongoDB
+                # guarda as imagens anteriores da coleção (versão 6.0 ou superior).
+                with self.colecao_reservas.watch(full_document_before_change="whenAvailable") as fluxo:
+                    self.cache_ocupacao.validade = None
+
+                    for alteracao in fluxo:
+                        doc = (alteracao.get("fullDocument")
+                               or alteracao.get("fullDocumentBeforeChange"))
+
+                        # Sem o documento (por exemplo, em remoções sem imagem
+                        # anterior) não é possível saber a viagem: descarta tudo.
+                        if doc and "viagem" in doc:
+                            self.cache_ocupacao.invalidar(doc["viagem"])
+                        else:
+                            self.cache_ocupacao.invalidar()
+
+            except PyMongoError as e:
+                print(f"Não foi possível observar as alterações das reservas: {e}")
+
+            # Sem observação, o cache volta a expirar e é descartado por segurança.
+            self.cache_ocupacao.validade = VALIDADE_CACHE_OCUPACAO
+            self.cache_ocupacao.invalidar()
+
+        threading.Thread(target=observar, name="observar-reservas", daemon=True).start()
+
+
+    # Define o método 'lugares_ocupados', que retorna o conjunto dos números
+    # dos lugares reservados em uma viagem. A consulta traz apenas o campo
+    # 'lugar', que já está no índice 'reserva_viagem_lugar', então o MongoDB
+    # responde lendo somente o índice.
+    def lugares_ocupados(self, dia, horario, rota=ROTA_PADRAO):
+        reservas = self.colecao_reservas.find({"viagem": self.id_viagem(rota, dia, horario)},
+                                              {"lugar": 1, "_id": 0})
+        return {r["lugar"] for r in reservas}
+
+
+    # Define o método 'habilitar_imagens_anteriores', que pede ao MongoDB
+    # (6.0 ou superior) para guardar o conteúdo dos documentos removidos,
+    # permitindo que o change stream informe qual lugar foi liberado.
+    # Servidores sem suporte ou sem permissão apenas ignoram o pedido.
+    def habilitar_imagens_anteriores(self):
+        try:
+            if "reservas" not in self.bd.list_collection_names():
+                self.bd.create_collection("reservas")
+            self.bd.command("collMod", "reservas",
+                            changeStreamPreAndPostImages={"enabled": True})
+        except PyMongoError:
+            pass
+
+
+    # Define o método 'fluxo_viagem', que abre um change stream com as
+    # alterações das reservas de uma viagem (identificador de 'id_viagem').
+    # Remoções sem o documento anterior (servidores sem imagens anteriores)
+    # e outros eventos sem documento também são entregues, pois não é
+    # possível saber a viagem. O fluxo começa em 'inicio' (veja
+    # 'instante_alteracoes') ou, ao reconectar, logo após o ponto
+    # 'retomar' (o 'resume_token' do fluxo anterior); sem nenhum dos dois,
+    # começa no momento em que é aberto. Lança OperationFailure se o
+    # servidor não oferecer change streams (fora de replica set).
+    def fluxo_viagem(self, viagem, inicio=None, retomar=None):
+
+        pipeline = [{"$match": {"$or": [
+            {"fullDocument.viagem": viagem},
+            {"fullDocumentBeforeChange.viagem": viagem},
+            {"fullDocument": None, "fullDocumentBeforeChange": None},
+        ]}}]
+
+        if not self.imagens_habilitadas:
+            self.habilitar_imagens_anteriores()
+            self.imagens_habilitadas = True
+
+        return self.colecao_reservas.watch(pipeline,
+                                           full_document="updateLookup",
+                                           full_document_before_change="whenAvailable",
+                                           max_await_time_ms=1000,
+                                           resume_after=retomar,
+                                           start_at_operation_time=None if retomar else inicio)
+
+
+    # Define o método 'instante_alteracoes', que retorna o instante da
+    # última gravação do servidor (o Timestamp do oplog). Lido antes de
+    # carregar o mapa de uma viagem e passado como 'inicio' a
+    # 'fluxo_viagem', faz o change stream entregar também as reservas
+    # gravadas entre a leitura do mapa e a abertura do fluxo. Retorna None
+    # fora de replica set.
+    def instante_alteracoes(self):
+        return self.cliente.admin.command("hello").get("lastWrite", {}).get("opTime", {}).get("ts")
+
+
+    # Define o método 'buscar_reserva', que retorna os campos de
+    # CAMPOS_RESERVA da reserva de um lugar em uma viagem, ou None se o
+    # lugar estiver livre.
+    def buscar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        return self.colecao_reservas.find_one({"viagem": self.id_viagem(rota, dia, horario),
+                                               "lugar": lugar},
+                                              {**dict.fromkeys(CAMPOS_RESERVA, 1), "_id": 0})
+
+
+    # Define o método 'montar_consulta', que converte os filtros usados na
+    # pesquisa e no cancelamento em lote em uma consulta do MongoDB.
+    # 'lugar', 'cpf', 'horario', 'rota' e 'viagem' são comparados
+    # exatamente; 'nome' é
+    # um prefixo, sem diferenciar maiúsculas de minúsculas; 'dia'
+    # (dd/mm/aaaa) seleciona um dia e 'data_inicial' e 'data_final' (objetos
+    # date) delimitam um período de dias. Lança ValueError se 'dia' for
+    # uma data inválida.
+    def montar_consulta(self, filtros):
+
+        consulta = {}
+
+        for campo in ("lugar", "cpf", "horario", "rota", "viagem"):
+            if campo in filtros:
+                consulta[campo] = filtros[campo]
+
+        # A busca pelo nome é um prefixo ancorado sobre o campo em minúsculas,
+        # o que permite ao MongoDB percorrer apenas o trecho do índice
+        # 'reserva_nome_busca' que começa com o texto digitado.
+        if "nome" in filtros:
+            consulta["nome_busca"] = {"$regex": "^" + re.escape(filtros["nome"].lower())}
+
+        # O dia e o período viram um único intervalo sobre a data de
+        # partida, percorrido pelo índice 'reserva_partida'.
+        intervalo = intervalo_partida(filtros)
+        if intervalo:
+            consulta["partida"] = {"$gte": intervalo[0], "$lt": intervalo[1]}
+
+        return consulta
+
+
+    # Define o método 'pesquisar_reservas', que busca uma página de reservas
+    # que atendem aos filtros informados, com a filtragem feita pelo MongoDB.
+    # 'filtros' é um dicionário com as chaves opcionais 'lugar', 'cpf',
+    # 'horario' e 'rota' (comparação exata), 'nome' (prefixo, sem diferenciar
+    # maiúsculas de minúsculas) e 'dia' ou 'data_inicial'/'data_final'
+    # (intervalo de datas de partida).
+    # 'cursor' é o valor retornado pela página anterior (ou None para a
+    # primeira página). A paginação é feita por intervalo de chaves: cada
+    # página começa logo após a última reserva da página anterior, então o
+    # custo de cada página não cresce com o número de páginas já lidas.
+    # Retorna uma tupla (reservas, cursor_da_proxima_pagina); o cursor é
+    # None quando não há mais páginas.
+    def pesquisar_reservas(self, filtros, cursor=None, limite=TAMANHO_PAGINA):
+
+        validar_limite(limite)
+        consulta, ordenacao = self.montar_pagina(filtros, cursor)
+
+        # Busca uma reserva a mais que o limite apenas para saber se
+        # existe uma próxima página, trazendo só os campos exibidos e os
+        # da ordenação, usados pelo cursor da próxima página.
+        reservas = list(self.colecao_reservas.find(consulta, self.campos_pagina(ordenacao))
+                        .sort(ordenacao)
+                        .limit(limite + 1))
+
+        return self.dividir_pagina(reservas, ordenacao, limite)
+
+
+    # Define o método 'montar_pagina', que retorna a consulta e a ordenação
+    # de uma página da pesquisa (veja 'pesquisar_reservas').
+    def montar_pagina(self, filtros, cursor):
+
+        consulta = self.montar_consulta(filtros)
+
+        # Ordena pelo índice que atende ao filtro: pelo nome, pela data de
+        # partida (em ordem cronológica) ou pela ordem de gravação.
+        if "nome" in filtros:
+            ordenacao = [("nome_busca", ASCENDING), ("_id", ASCENDING)]
+        elif "partida" in consulta:
+            ordenacao = [("partida", ASCENDING), ("_id", ASCENDING)]
+        else:
+            ordenacao = [("_id", ASCENDING)]
+
+        # Restringe a busca às reservas posteriores à última da página anterior,
+        # seguindo a mesma ordenação: (a > x) ou (a == x e b > y) ...
+        if cursor is not None:
+            condicoes = []
+            for i, (campo, _) in enumerate(ordenacao):
+                condicao = {anterior: cursor[anterior] for anterior, _ in ordenacao[:i]}
+                condicao[campo] = {"$gt": cursor[campo]}
+                condicoes.append(condicao)
+            consulta = {"$and": [consulta, {"$or": condicoes}]}
+
+        return consulta, ordenacao
+
+
+    # Define o método 'campos_pagina', que retorna a projeção de uma página
+    # da pesquisa: os campos de CAMPOS_RESERVA e os da ordenação.
+    def campos_pagina(self, ordenacao):
+        return dict.fromkeys(CAMPOS_RESERVA + [campo for campo, _ in ordenacao], 1)
+
+
+    # Define o método 'dividir_pagina', que recebe até 'limite + 1' reservas
+    # lidas na ordenação da página e retorna a tupla (reservas, cursor).
+    def dividir_pagina(self, reservas, ordenacao, limite):
+
+        if len(reservas) <= limite:
+            return reservas, None
+
+        reservas = reservas[:limite]
+        ultima = reservas[-1]
+        return reservas, {campo: ultima.get(campo) for campo, _ in ordenacao}
+
+
+    # Define o método 'interpretar_data', que converte o campo 'dia' de uma
+    # reserva antiga em um objeto date, tentando cada formato de
+    # FORMATOS_DATA_ANTIGOS. Retorna None se nenhum deles servir.
+    def interpretar_data(self, texto):
+        for formato in FORMATOS_DATA_ANTIGOS:
+            try:
+                return datetime.strptime(texto.strip(), formato).date()
+            except (ValueError, AttributeError):
+                continue
+        return None
+
+
+    # Define o método 'migrar_campos', que preenche nas reservas gravadas
+    # por versões anteriores os campos que elas ainda não possuem: associa
+    # à rota padrão as reservas gravadas antes da frota existir ('rota' e
+    # 'viagem') e grava o nome em minúsculas usado pela pesquisa por nome
+    # ('nome_busca'). As atualizações são feitas inteiramente no servidor e
+    # percorrem a coleção, por isso não são feitas ao conectar (exceto a
+    # 'viagem', preenchida uma única vez antes de criar o índice único, veja
+    # 'garantir_indices'). Pode ser executado novamente: reservas já
+    # migradas não são alteradas. Retorna quantas reservas foram alteradas
+    # em cada campo.
+    def migrar_campos(self):
+
+        resumo = {"viagem": self.preencher_viagens()}
+
+        resultado = self.colecao_reservas.update_many(
+            {"nome_busca": {"$exists": False}, "nome": {"$type": "string"}},
+            [{"$set": {"nome_busca": {"$toLower": "$nome"}}}]
+        )
+        resumo["nome_busca"] = resultado.modified_count
+
+        self.cache_ocupacao.invalidar()
+        if resumo["viagem"]:
+            self.reconciliar_resumos()
+
+        return resumo
+
+
+    # Define o método 'preencher_viagens', que associa à rota padrão as
+    # reservas sem 'viagem' (veja 'migrar_campos'). Retorna quantas foram
+    # alteradas.
+    def preencher_viagens(self):
+        return self.colecao_reservas.update_many(
+            {"viagem": {"$exists": False}},
+            [{"$set": {
+                "rota": ROTA_PADRAO,
+                "viagem": {"$concat": [ROTA_PADRAO, "|", "$dia", "|", "$horario"]},
+            }}]
+        ).modified_count
+
+
+    # Define o método 'migrar_datas', que grava a data de partida nas
+    # reservas que ainda não a possuem e padroniza o campo 'dia' (e, com
+    # ele, a chave da viagem) no formato dd/mm/aaaa. As reservas são lidas
+    # em sequência por um único cursor e regravadas em lotes de
+    # 'tamanho_lote', sem carregar a coleção inteira na memória. Pode ser
+    # interrompido e executado novamente: reservas já migradas são ignoradas.
+    # Retorna um dicionário com a quantidade de reservas migradas, com data
+    # inválida (mantidas como estão) e em conflito (o mesmo lugar da mesma
+    # viagem gravado em dois formatos de data; a segunda é mantida como está).
+    def migrar_datas(self, tamanho_lote=TAMANHO_LOTE_MIGRACAO):
+
+        resumo = {"migradas": 0, "invalidas": 0, "conflitos": 0}
+
+        reservas = self.colecao_reservas.find(
+            {"partida": {"$exists": False}},
+            {"dia": 1, "horario": 1, "rota": 1}
+        ).batch_size(tamanho_lote)
+
+        lote = []
+
+        def gravar():
+            try:
+                resultado = self.colecao_reservas.bulk_write(lote, ordered=False)
+                resumo["migradas"] += resultado.modified_count
+            except BulkWriteError as e:
+                resumo["migradas"] += e.details["nModified"]
+                resumo["conflitos"] += len(e.details["writeErrors"])
+            lote.clear()
+
+        for reserva in reservas:
+
+            data = self.interpretar_data(reserva.get("dia"))
+            try:
+                hora = datetime.strptime(reserva.get("horario", ""), "%H:%M").time()
+            except (TypeError, ValueError):
+                data = None
+
+            if data is None:
+                resumo["invalidas"] += 1
+                continue
+
+            dia = data.strftime(FORMATO_DATA)
+            rota = reserva.get("rota", ROTA_PADRAO)
+            lote.append(UpdateOne({"_id": reserva["_id"]}, {"$set": {
+                "dia": dia,
+                "partida": datetime.combine(data, hora),
+                "viagem": self.id_viagem(rota, dia, reserva["horario"]),
+            }}))
+
+            if len(lote) >= tamanho_lote:
+                gravar()
+
+        if lote:
+            gravar()
+
+        # As chaves das viagens podem ter mudado: descarta todo o cache e
+        # refaz os resumos.
+        self.cache_ocupacao.invalidar()
+        if resumo["migradas"]:
+            self.reconciliar_resumos()
+
+        return resumo
+
+
+# Define a função 'espera_conexao', que retorna quantos segundos esperar
+# antes da próxima tentativa de conexão após 'falhas' tentativas sem
+# sucesso. A espera dobra a cada falha, até ESPERA_MAXIMA_CONEXAO, e é
+# sorteada entre a metade e o valor cheio, para que vários terminais
+# reiniciados juntos não tentem todos no mesmo instante.
+def espera_conexao(falhas):
+    espera = min(ESPERA_MAXIMA_CONEXAO, ESPERA_INICIAL_CONEXAO * 2 ** (falhas - 1))
+    return espera * random.uniform(0.5, 1)
+
+
+# Define a função 'conectar_banco', usada pelas ferramentas de linha de
+# comando e pelo serviço: chama 'fabrica()' (por padrão, cria um 'Onibus')
+# até conseguir, esperando entre as tentativas conforme 'espera_conexao'.
+# Lança o último erro após 'tentativas' falhas.
+def conectar_banco(fabrica=None, tentativas=TENTATIVAS_CONEXAO):
+    fabrica = fabrica or Onibus
+
+    for tentativa in range(1, tentativas + 1):
+        try:
+            return fabrica()
+        except (PyMongoError, OSError) as e:
+            if tentativa == tentativas:
+                raise
+            espera = espera_conexao(tentativa)
+            print(f"Tentativa {tentativa} de {tentativas} falhou ({e}). "
+                  f"Tentando novamente em {espera:.0f} segundos...")
+            time.sleep(espera)
+
+
+# Define a classe 'ClienteServico', que oferece à interface as mesmas
+# operações de 'Onibus', mas realizadas pelo serviço HTTP de reservas
+# (servico_reservas.py) em vez de acessar o MongoDB diretamente. É usada
+# quando a variável de ambiente SERVICO_RESERVAS informa o endereço do
+# serviço; o token do serviço, quando exigido, é lido de TOKEN_SERVICO.
+# As chamadas bloqueiam até a resposta, então devem ser feitas
+# pelo ExecutorBanco, como as do 'Onibus'. Erros de validação do serviço
+# são lançados como ValueError e falhas de comunicação como OSError.
+class ClienteServico:
+
+    def __init__(self, url, tempo_limite=10, token=None):
+        self.url = url.rstrip("/")
+        self.tempo_limite = tempo_limite
+        self.token = token or os.getenv('TOKEN_SERVICO')
+
+        # Horários de cada rota e veículo de cada horário, lidos do serviço
+        # uma única vez: {rota: {horario: veiculo}}.
+        self.rotas = None
+
+        # Cache da ocupação das viagens consultadas recentemente.
+        self.cache_ocupacao = CacheOcupacao()
+
+    # Envia uma requisição ao serviço e retorna o corpo da resposta (JSON).
+    def requisitar(self, metodo, caminho, parametros=None, corpo=None):
+        url = self.url + caminho
+        if parametros:
+            url += "?" + urllib.parse.urlencode(
+                {chave: valor for chave, valor in parametros.items() if valor is not None})
+
+        dados = None
+        cabecalhos = {"Accept": "application/json"}
+        if self.token:
+            cabecalhos["Authorization"] = f"Bearer {self.token}"
+        if corpo is not None:
+            dados = json.dumps(corpo).encode("utf-8")
+            cabecalhos["Content-Type"] = "application/json"
+
+        requisicao = urllib.request.Request(url, data=dados, headers=cabecalhos, method=metodo)
+        try:
+            with urllib.request.urlopen(requisicao, timeout=self.tempo_limite) as resposta:
+                return json.load(resposta)
+
+        except urllib.error.HTTPError as e:
+            # Respostas de erro do serviço trazem o motivo em 'erro'; as
+            # demais (por exemplo, lugar indisponível) trazem o resultado.
+            # Só as respostas 502, 503 e 504 (o balanceador ou o banco de
+            # dados do serviço fora do ar) são tratadas como falta de
+            # conexão ('OSError'); outros erros do servidor viram
+            # 'RuntimeError', para não deixar o guichê "sem conexão".
+            try:
+                resposta = json.load(e)
+            except ValueError:
+                if e.code in ERROS_HTTP_CONEXAO:
+                    raise e
+                raise RuntimeError(f"Erro {e.code} do serviço de reservas: {e.reason}")
+            if "erro" in resposta:
+                if e.code in ERROS_HTTP_CONEXAO:
+                    raise OSError(resposta["erro"])
+                if e.code >= 500:
+                    raise RuntimeError(resposta["erro"])
+                raise ValueError(resposta["erro"])
+            return resposta
+
+    def id_viagem(self, rota, dia, horario):
+        return f"{rota}|{dia}|{horario}"
+
+    def verificar_conexao(self):
+        self.requisitar("GET", "/saude")
+
+    def carregar_rotas(self):
+        if self.rotas is None:
+            self.rotas = {
+                rota["codigo"]: {h["horario"]: h["veiculo"] for h in rota["horarios"]}
+                for rota in self.requisitar("GET", "/rotas")["rotas"]
+            }
+        return self.rotas
+
+    def listar_rotas(self):
+        return sorted(self.carregar_rotas())
+
+    def horarios_rota(self, rota):
+        if rota not in self.carregar_rotas():
+            raise ValueError(f"Rota {rota} não cadastrada")
+        return list(self.rotas[rota])
+
+    def veiculo_viagem(self, rota, horario):
+        veiculo = self.carregar_rotas().get(rota, {}).get(horario)
+        if veiculo is None:
+            raise ValueError(f"Rota {rota} não tem partida às {horario}")
+        return veiculo
+
+    def capacidade_viagem(self, rota, horario):
+        return self.veiculo_viagem(rota, horario)["capacidade"]
+
+    def consultar_ocupacao(self, data, horario, rota=ROTA_PADRAO):
+        viagem = self.id_viagem(rota, data, horario)
+        lugares = self.cache_ocupacao.obter(viagem)
+        if lugares is not None:
+            return lugares
+
+        versao = self.cache_ocupacao.versao()
+        resposta = self.requisitar("GET", "/ocupacao",
+                                   {"rota": rota, "dia": data, "horario": horario})
+        lugares = MapaOcupacao.de_lugares(resposta["capacidade"], resposta["ocupados"])
+        self.cache_ocupacao.guardar(viagem, lugares, versao)
+        return lugares
+
+    def lugares_ocupados(self, dia, horario, rota=ROTA_PADRAO):
+        resposta = self.requisitar("GET", "/ocupacao",
+                                   {"rota": rota, "dia": dia, "horario": horario})
+        return set(resposta["ocupados"])
+
+    def reservar_lugar(self, num_lugar, nome, cpf, dia, horario, rota=ROTA_PADRAO):
+        resposta = self.requisitar("POST", "/reservas", corpo={
+            "lugar": num_lugar, "nome": nome, "cpf": cpf,
+            "dia": dia, "horario": horario, "rota": rota,
+        })
+        self.cache_ocupacao.invalidar(self.id_viagem(rota, dia, horario))
+        return resposta["mensagem"]
+
+    def reservar_lugares(self, entradas, tudo_ou_nada=False):
+        resposta = self.requisitar("POST", "/reservas/lote", corpo={
+            "reservas": [dict(zip(("lugar", "nome", "cpf", "dia", "horario", "rota"), entrada))
+                         for entrada in entradas],
+            "tudo_ou_nada": tudo_ou_nada,
+        })
+        self.cache_ocupacao.invalidar()
+        return [(r["reservado"], r["mensagem"]) for r in resposta["resultados"]]
+
+    importar_csv = Onibus.importar_csv
+
+    def cancelar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        resposta = self.requisitar("DELETE", "/reservas", {
+            "rota": rota, "dia": dia, "horario": horario, "lugar": lugar,
+        })
+        self.cache_ocupacao.invalidar(self.id_viagem(rota, dia, horario))
+        return resposta["mensagem"]
+
+    def cancelar_reservas(self, filtros, arquivar=False):
+        resposta = self.requisitar("POST", "/reservas/cancelamento", corpo={
+            "filtros": filtros_json(filtros), "arquivar": arquivar,
+        })
+        self.cache_ocupacao.invalidar()
+        return resposta["cancelados"]
+
+    def buscar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        return self.requisitar("GET", "/reserva", {
+            "rota": rota, "dia": dia, "horario": horario, "lugar": lugar,
+        })["reserva"]
+
+    def pesquisar_reservas(self, filtros, cursor=None, limite=TAMANHO_PAGINA):
+        parametros = filtros_json(filtros)
+        parametros["cursor"] = cursor
+        parametros["limite"] = limite
+        resposta = self.requisitar("GET", "/reservas", parametros)
+        return resposta["reservas"], resposta["cursor"]
+
+    def resumos_periodo(self, inicio, fim, rota=ROTA_PADRAO):
+        resposta = self.requisitar("GET", "/resumos", {
+            "rota": rota, "inicio": inicio.isoformat(), "fim": fim.isoformat(),
+        })
+        return {(r["dia"], r["horario"]): MapaOcupacao.de_lugares(r["capacidade"], r["ocupados"])
+                for r in resposta["resumos"]}
+
+    def ocupacao_mes(self, ano, mes, rota=ROTA_PADRAO):
+        resposta = self.requisitar("GET", "/calendario", {"rota": rota, "ano": ano, "mes": mes})
+        return {d["dia"]: (d["reservados"], d["capacidade"]) for d in resposta["dias"]}
+
+
+# Define a função 'filtros_json', que converte os filtros de pesquisa e
+# de cancelamento em lote em valores que podem ser enviados ao serviço
+# (as datas do período viram texto no formato aaaa-mm-dd).
+def filtros_json(filtros):
+    return {campo: valor.isoformat() if hasattr(valor, "isoformat") else valor
+            for campo, valor in filtros.items()}
+
+
+# Define a classe 'OnibusLocal', que oferece à interface as mesmas
+# operações de 'Onibus', com as reservas e a frota gravadas em um arquivo
+# SQLite no próprio computador, sem servidor. É usada quando a variável de
+# ambiente BANCO_LOCAL informa o caminho do arquivo, em guichês isolados.
+# O arquivo usa o modo WAL, em que as consultas não esperam pelas
+# gravações, e cada thread tem sua própria conexão. As gravações são feitas
+# em transações que reservam o arquivo para escrita ('BEGIN IMMEDIATE'),
+# então uma verificação seguida de gravação não é intercalada com a de
+# outra thread ou de outro processo.
+class OnibusLocal:
+
+    # Métodos que não dependem do banco são os mesmos do 'Onibus'.
+    id_viagem = Onibus.id_viagem
+    partida_viagem = Onibus.partida_viagem
+    horarios_rota = Onibus.horarios_rota
+    veiculo_viagem = Onibus.veiculo_viagem
+    capacidade_viagem = Onibus.capacidade_viagem
+    frota = Onibus.frota
+    validar_reserva = Onibus.validar_reserva
+    carregar_reservas = Onibus.carregar_reservas
+    importar_csv = Onibus.importar_csv
+    cancelar_reserva = Onibus.cancelar_reserva
+
+    # Método construtor da classe. Cria o arquivo 'caminho' e suas tabelas
+    # se ainda não existirem e cadastra a frota padrão quando ela está vazia.
+    def __init__(self, caminho, capacidade_padrao=20):
+        self.caminho = caminho
+
+        # Conexão de cada thread com o arquivo (veja 'conexao').
+        self.local = threading.local()
+
+        # Mapa de ocupação (MapaOcupacao) da última viagem carregada por
+        # 'carregar_reservas'.
+        self.lugares = MapaOcupacao(0)
+
+        # Rotas e veículos já lidos do arquivo, carregados sob demanda.
+        self.rotas = {}
+        self.veiculos = {}
+        self.rotas_listadas = False
+
+        # Cache da ocupação das viagens consultadas recentemente.
+        self.cache_ocupacao = CacheOcupacao()
+
+        conexao = self.conexao()
+
+        # O modo WAL fica gravado no próprio arquivo.
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.executescript(ESQUEMA_LOCAL)
+
+        with self.transacao() as conexao:
+            conexao.execute(
+                "INSERT OR IGNORE INTO veiculos (codigo, descricao, capacidade, colunas) "
+                "VALUES (?, ?, ?, ?)",
+                (VEICULO_PADRAO, "Ônibus convencional", capacidade_padrao, 2))
+            conexao.execute(
+                "INSERT OR IGNORE INTO rotas (codigo, nome, veiculo, horarios) "
+                "VALUES (?, ?, ?, ?)",
+                (ROTA_PADRAO, "Rota Padrão", VEICULO_PADRAO, json.dumps(HORARIOS_PADRAO)))
+
+    # Define o método 'conexao', que retorna a conexão da thread atual com o
+    # arquivo, abrindo-a na primeira vez. As transações são abertas
+    # explicitamente (veja 'transacao'); fora delas, cada comando é gravado
+    # imediatamente.
+    def conexao(self):
+        conexao = getattr(self.local, "conexao", None)
+        if conexao is None:
+            conexao = sqlite3.connect(self.caminho, timeout=ESPERA_BANCO_LOCAL,
+                                      isolation_level=None)
+            conexao.row_factory = sqlite3.Row
+
+            # No modo WAL, 'NORMAL' só sincroniza o disco nos checkpoints,
+            # sem risco de corromper o arquivo.
+            conexao.execute("PRAGMA synchronous=NORMAL")
+            self.local.conexao = conexao
+        return conexao
+
+    # Define o método 'transacao', usado com 'with', que executa o bloco em
+    # uma transação de escrita: confirmada ao final do bloco ou desfeita se
+    # ocorrer um erro. O bloco pode desfazê-la antes com 'ROLLBACK'.
+    @contextmanager
+    def transacao(self):
+        conexao = self.conexao()
+        conexao.execute("BEGIN IMMEDIATE")
+        try:
+            yield conexao
+        except BaseException:
+            if conexao.in_transaction:
+                conexao.execute("ROLLBACK")
+            raise
+        if conexao.in_transaction:
+            conexao.execute("COMMIT")
+
+    def verificar_conexao(self):
+        self.conexao().execute("SELECT 1")
+
+    def rota(self, codigo):
+        rota = self.rotas.get(codigo)
+        if rota is None:
+            linha = self.conexao().execute("SELECT * FROM rotas WHERE codigo = ?",
+                                           (codigo,)).fetchone()
+            if linha is None:
+                raise ValueError(f"Rota {codigo} não cadastrada")
+            rota = self.documento_rota(linha)
+            self.rotas[codigo] = rota
+        return rota
+
+    def listar_rotas(self):
+        if not self.rotas_listadas:
+            for linha in self.conexao().execute("SELECT * FROM rotas"):
+                self.rotas[linha["codigo"]] = self.documento_rota(linha)
+            self.rotas_listadas = True
+        return sorted(self.rotas)
+
+    # Converte uma linha da tabela 'rotas' no mesmo formato dos documentos
+    # de rota do MongoDB.
+    def documento_rota(self, linha):
+        return {"_id": linha["codigo"],
+                "nome": linha["nome"],
+                "veiculo": linha["veiculo"],
+                "horarios": json.loads(linha["horarios"]),
+                "veiculos_por_horario": json.loads(linha["veiculos_por_horario"])}
+
+    def veiculo(self, codigo):
+        veiculo = self.veiculos.get(codigo)
+        if veiculo is None:
+            linha = self.conexao().execute("SELECT * FROM veiculos WHERE codigo = ?",
+                                           (codigo,)).fetchone()
+            if linha is None:
+                raise ValueError(f"Veículo {codigo} não cadastrado")
+            veiculo = {"_id": linha["codigo"], "descricao": linha["descricao"],
+                       "capacidade": linha["capacidade"], "colunas": linha["colunas"]}
+            self.veiculos[codigo] = veiculo
+        return veiculo
+
+    def consultar_ocupacao(self, data, horario, rota=ROTA_PADRAO):
+        viagem = self.id_viagem(rota, data, horario)
+        capacidade = self.capacidade_viagem(rota, horario)
+
+        lugares = self.cache_ocupacao.obter(viagem)
+        if lugares is not None:
+            return lugares
+
+        versao = self.cache_ocupacao.versao()
+        lugares = MapaOcupacao.de_lugares(capacidade, self.lugares_ocupados(data, horario, rota))
+        self.cache_ocupacao.guardar(viagem, lugares, versao)
+        return lugares
+
+    # A consulta é respondida pelo índice único (viagem, lugar).
+    def lugares_ocupados(self, dia, horario, rota=ROTA_PADRAO):
+        linhas = self.conexao().execute("SELECT lugar FROM reservas WHERE viagem = ?",
+                                        (self.id_viagem(rota, dia, horario),))
+        return {linha["lugar"] for linha in linhas}
+
+    def reservar_lugar(self, num_lugar, nome, cpf, dia, horario, rota=ROTA_PADRAO):
+        return self.reservar_lugares([(num_lugar, nome, cpf, dia, horario, rota)])[0][1]
+
+    # Define o método 'reservar_lugares', com os mesmos parâmetros e
+    # resultados de 'Onibus.reservar_lugares'. Todas as entradas são
+    # gravadas em uma única transação; com 'tudo_ou_nada', ela é desfeita
+    # se alguma entrada não puder ser reservada.
+    def reservar_lugares(self, entradas, tudo_ou_nada=False):
+
+        entradas = [tuple(entrada) if len(entrada) == 6 else (*entrada, ROTA_PADRAO)
+                    for entrada in entradas]
+        resultados = []
+        viagens = set()
+
+        try:
+            with self.transacao() as conexao:
+                for num_lugar, nome, cpf, dia, horario, rota in entradas:
+                    viagens.add(self.id_viagem(rota, dia, horario))
+                    resultados.append(self.gravar_reserva(conexao, num_lugar, nome, cpf,
+                                                          dia, horario, rota))
+
+                if tudo_ou_nada and not all(reservado for reservado, _ in resultados):
+                    conexao.execute("ROLLBACK")
+                    for i, (num_lugar, _, _, _, horario, _) in enumerate(entradas):
+                        if resultados[i][0]:
+                            resultados[i] = (False, f"Lugar {num_lugar} não reservado para "
+                                                    f"{horario}: há outros lugares do grupo "
+                                                    f"indisponíveis")
+        finally:
+            for viagem in viagens:
+                self.cache_ocupacao.invalidar(viagem)
+
+        return resultados
+
+    # Grava uma reserva na transação aberta em 'conexao' e retorna a tupla
+    # (reservado, mensagem). O índice único (viagem, lugar) recusa lugares
+    # já reservados.
+    def gravar_reserva(self, conexao, num_lugar, nome, cpf, dia, horario, rota):
+        try:
+            capacidade = self.capacidade_viagem(rota, horario)
+        except ValueError as e:
+            return False, str(e)
+
+        if num_lugar < 1 or num_lugar > capacidade:
+            return False, MENSAGEM_LUGAR_INVALIDO
+
+        try:
+            partida = self.partida_viagem(dia, horario)
+        except ValueError:
+            return False, MENSAGEM_DATA_INVALIDA.format(dia=dia, horario=horario)
+
+        try:
+            conexao.execute(
+                "INSERT INTO reservas (viagem, lugar, nome, nome_busca, cpf, dia, horario, "
+                "partida, rota) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.id_viagem(rota, dia, horario), num_lugar, nome, nome.lower(), cpf,
+                 dia, horario, partida.isoformat(" "), rota))
+        except sqlite3.IntegrityError:
+            return False, f"Lugar {num_lugar} indisponível para {horario}"
+
+        return True, MENSAGEM_RESERVADO.format(lugar=num_lugar, horario=horario)
+
+    def remover_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        if not 1 <= lugar <= self.capacidade_viagem(rota, horario):
+            return False
+
+        viagem = self.id_viagem(rota, dia, horario)
+        cursor = self.conexao().execute("DELETE FROM reservas WHERE viagem = ? AND lugar = ?",
+                                        (viagem, lugar))
+        self.cache_ocupacao.invalidar(viagem)
+        return cursor.rowcount > 0
+
+    # Define o método 'cancelar_reservas', com os mesmos filtros e
+    # resultado de 'Onibus.cancelar_reservas'. Com 'arquivar', as reservas
+    # são copiadas para a tabela 'reservas_canceladas' na mesma transação.
+    def cancelar_reservas(self, filtros, arquivar=False):
+
+        condicoes, parametros = self.montar_condicoes(filtros)
+        if not condicoes:
+            raise ValueError("Informe ao menos um filtro para cancelar reservas em lote.")
+        where = " AND ".join(condicoes)
+
+        try:
+            with self.transacao() as conexao:
+                if arquivar:
+                    conexao.execute(
+                        f"INSERT OR REPLACE INTO reservas_canceladas "
+                        f"SELECT *, ? FROM reservas WHERE {where}",
+                        [datetime.now().isoformat(" ")] + parametros)
+                cursor = conexao.execute(f"DELETE FROM reservas WHERE {where}", parametros)
+        finally:
+            self.cache_ocupacao.invalidar()
+
+        return cursor.rowcount
+
+    def buscar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        linha = self.conexao().execute(
+            f"SELECT {', '.join(CAMPOS_RESERVA)} FROM reservas WHERE viagem = ? AND lugar = ?",
+            (self.id_viagem(rota, dia, horario), lugar)).fetchone()
+        return None if linha is None else self.documento_reserva(linha)
+
+    # Converte uma linha da tabela 'reservas' no mesmo formato dos
+    # documentos de reserva do MongoDB.
+    def documento_reserva(self, linha):
+        reserva = dict(linha)
+        if reserva.get("partida") is not None:
+            reserva["partida"] = datetime.fromisoformat(reserva["partida"])
+        return reserva
+
+    # Define o método 'montar_condicoes', que converte os filtros de
+    # 'Onibus.montar_consulta' em condições SQL e seus parâmetros. O prefixo
+    # do nome vira um intervalo sobre 'nome_busca', para que a consulta
+    # percorra apenas o trecho do índice que começa com o texto digitado.
+    def montar_condicoes(self, filtros):
+
+        condicoes = []
+        parametros = []
+
+        for campo in ("lugar", "cpf", "horario", "rota", "viagem"):
+            if campo in filtros:
+                condicoes.append(f"{campo} = ?")
+                parametros.append(filtros[campo])
+
+        if "nome" in filtros:
+            prefixo = filtros["nome"].lower()
+            condicoes.append("nome_busca >= ? AND nome_busca < ?")
+            parametros += [prefixo, prefixo + "\U0010ffff"]
+
+        intervalo = intervalo_partida(filtros)
+        if intervalo:
+            condicoes.append("partida >= ? AND partida < ?")
+            parametros += [intervalo[0].isoformat(" "), intervalo[1].isoformat(" ")]
+
+        return condicoes, parametros
+
+    # Define o método 'pesquisar_reservas', com os mesmos filtros, cursor e
+    # resultado de 'Onibus.pesquisar_reservas' (paginação por intervalo de
+    # chaves, na ordem do índice que atende ao filtro).
+    def pesquisar_reservas(self, filtros, cursor=None, limite=TAMANHO_PAGINA):
+
+        validar_limite(limite)
+        condicoes, parametros = self.montar_condicoes(filtros)
+
+        if "nome" in filtros:
+            ordenacao = ["nome_busca", "_id"]
+        elif intervalo_partida(filtros):
+            ordenacao = ["partida", "_id"]
+        else:
+            ordenacao = ["_id"]
+
+        if cursor is not None:
+            condicoes.append(f"({', '.join(ordenacao)}) > ({', '.join('?' * len(ordenacao))})")
+            parametros += [cursor[campo].isoformat(" ") if isinstance(cursor[campo], datetime)
+                           else cursor[campo] for campo in ordenacao]
+
+        campos = CAMPOS_RESERVA + [campo for campo in ordenacao if campo not in CAMPOS_RESERVA]
+        linhas = self.conexao().execute(
+            f"SELECT {', '.join(campos)} FROM reservas {'WHERE ' + ' AND '.join(condicoes) if condicoes else ''} "
+            f"ORDER BY {', '.join(ordenacao)} LIMIT ?",
+            parametros + [limite + 1]).fetchall()
+
+        reservas = [self.documento_reserva(linha) for linha in linhas]
+        return Onibus.dividir_pagina(self, reservas, [(campo, ASCENDING) for campo in ordenacao],
+                                     limite)
+
+    # A consulta percorre o índice (rota, partida) e o mapa de cada viagem
+    # é montado a partir dos lugares reservados.
+    def resumos_periodo(self, inicio, fim, rota=ROTA_PADRAO):
+
+        lugares = {}
+        for linha in self.conexao().execute(
+                "SELECT dia, horario, lugar FROM reservas "
+                "WHERE rota = ? AND partida >= ? AND partida < ?",
+                (rota, datetime.combine(inicio, datetime.min.time()).isoformat(" "),
+                 datetime.combine(fim + timedelta(days=1), datetime.min.time()).isoformat(" "))):
+            lugares.setdefault((linha["dia"], linha["horario"]), []).append(linha["lugar"])
+
+        ocupacao = {}
+        for (dia, horario), ocupados in lugares.items():
+            try:
+                capacidade = self.capacidade_viagem(rota, horario)
+            except ValueError:
+                continue
+            ocupacao[(dia, horario)] = MapaOcupacao.de_lugares(capacidade, ocupados)
+
+        return ocupacao
+
+    def ocupacao_mes(self, ano, mes, rota=ROTA_PADRAO):
+
+        inicio = datetime(ano, mes, 1)
+        fim = datetime(ano + mes // 12, mes % 12 + 1, 1)
+
+        linhas = self.conexao().execute(
+            "SELECT dia, COUNT(*) AS reservados FROM reservas "
+            "WHERE rota = ? AND partida >= ? AND partida < ? GROUP BY dia",
+            (rota, inicio.isoformat(" "), fim.isoformat(" ")))
+
+        capacidade = sum(self.capacidade_viagem(rota, horario)
+                         for horario in self.horarios_rota(rota))
+
+        return {linha["dia"]: (linha["reservados"], capacidade) for linha in linhas}
+
+
+# Define a classe 'DiarioReservas', que guarda em um arquivo SQLite local
+# as reservas e os cancelamentos ainda não enviados ao servidor (o diário),
+# na ordem em que foram feitos, e a última ocupação lida do servidor para
+# cada viagem consultada (a cópia local). Cada operação é gravada no disco
+# antes de ser confirmada ao usuário ('synchronous=FULL'), então o diário
+# sobrevive a uma queda do computador.
+class DiarioReservas:
+
+    transacao = OnibusLocal.transacao
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+
+        # Conexão de cada thread com o arquivo (veja 'conexao').
+        self.local = threading.local()
+
+        conexao = self.conexao()
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.executescript(ESQUEMA_DIARIO)
+
+    # Retorna a conexão da thread atual com o arquivo, abrindo-a na
+    # primeira vez (veja 'OnibusLocal.conexao').
+    def conexao(self):
+        conexao = getattr(self.local, "conexao", None)
+        if conexao is None:
+            conexao = sqlite3.connect(self.caminho, timeout=ESPERA_BANCO_LOCAL,
+                                      isolation_level=None)
+            conexao.row_factory = sqlite3.Row
+            conexao.execute("PRAGMA synchronous=FULL")
+            self.local.conexao = conexao
+        return conexao
+
+    # Guarda os lugares reservados de uma viagem, lidos do servidor.
+    def guardar_ocupacao(self, viagem, rota, dia, horario, lugares):
+        self.conexao().execute(
+            "INSERT OR REPLACE INTO ocupacao (viagem, rota, dia, horario, lugares, atualizada_em) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (viagem, rota, dia, horario, json.dumps(sorted(lugares)),
+             datetime.now().isoformat(" ")))
+        self.conexao().execute(
+            f"DELETE FROM passageiros WHERE viagem = ? "
+            f"AND lugar NOT IN ({', '.join('?' * len(lugares))})",
+            (viagem, *lugares))
+
+    # Guarda o passageiro de um lugar, lido do servidor, para que o
+    # cancelamento feito sem conexão saiba de quem é a reserva.
+    def guardar_passageiro(self, viagem, lugar, nome, cpf):
+        self.conexao().execute(
+            "INSERT OR REPLACE INTO passageiros (viagem, lugar, nome, cpf) VALUES (?, ?, ?, ?)",
+            (viagem, lugar, nome, cpf))
+
+    def esquecer_passageiro(self, viagem, lugar):
+        self.conexao().execute("DELETE FROM passageiros WHERE viagem = ? AND lugar = ?",
+                               (viagem, lugar))
+
+    # Retorna o último passageiro lido do servidor para um lugar, ou None.
+    def passageiro(self, viagem, lugar):
+        return self.conexao().execute(
+            "SELECT nome, cpf FROM passageiros WHERE viagem = ? AND lugar = ?",
+            (viagem, lugar)).fetchone()
+
+    # Retorna os lugares reservados de uma viagem segundo a cópia local,
+    # com as operações pendentes do diário aplicadas.
+    def lugares_ocupados(self, viagem):
+        linha = self.conexao().execute("SELECT lugares FROM ocupacao WHERE viagem = ?",
+                                       (viagem,)).fetchone()
+        lugares = set(json.loads(linha["lugares"])) if linha else set()
+        return self.aplicar_pendentes(viagem, lugares)
+
+    # Aplica ao conjunto 'lugares' de uma viagem as reservas e os
+    # cancelamentos pendentes, na ordem em que foram feitos.
+    def aplicar_pendentes(self, viagem, lugares):
+        for operacao in self.conexao().execute(
+                "SELECT operacao, lugar FROM diario "
+                "WHERE viagem = ? AND situacao = 'pendente' ORDER BY _id", (viagem,)):
+            if operacao["operacao"] == "reserva":
+                lugares.add(operacao["lugar"])
+            else:
+                lugares.discard(operacao["lugar"])
+        return lugares
+
+    # Retorna as viagens de uma rota com operações pendentes e, com
+    # 'copiadas', também as que estão na cópia local, como linhas com
+    # 'viagem', 'dia' e 'horario'.
+    def viagens_rota(self, rota, copiadas):
+        consulta = ("SELECT viagem, dia, horario FROM diario "
+                    "WHERE rota = ? AND situacao = 'pendente'")
+        parametros = [rota]
+        if copiadas:
+            consulta += " UNION SELECT viagem, dia, horario FROM ocupacao WHERE rota = ?"
+            parametros.append(rota)
+        return self.conexao().execute(consulta, parametros).fetchall()
+
+    # Registra no diário uma operação ('reserva' ou 'cancelamento'), na
+    # transação aberta em 'conexao'.
+    def registrar(self, conexao, operacao, viagem, lugar, nome, cpf, dia, horario, rota):
+        conexao.execute(
+            "INSERT INTO diario (operacao, viagem, lugar, nome, cpf, dia, horario, rota, "
+            "registrada_em) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (operacao, viagem, lugar, nome, cpf, dia, horario, rota,
+             datetime.now().isoformat(" ")))
+
+    # Retorna a última operação pendente de um lugar, ou None.
+    def ultima_pendente(self, viagem, lugar):
+        return self.conexao().execute(
+            "SELECT * FROM diario WHERE viagem = ? AND lugar = ? AND situacao = 'pendente' "
+            "ORDER BY _id DESC LIMIT 1", (viagem, lugar)).fetchone()
+
+    # Retorna as primeiras 'limite' operações pendentes, na ordem em que
+    # foram feitas.
+    def pendentes(self, limite):
+        return self.conexao().execute(
+            "SELECT * FROM diario WHERE situacao = 'pendente' ORDER BY _id LIMIT ?",
+            (limite,)).fetchall()
+
+    def tem_pendentes(self):
+        return self.conexao().execute(
+            "SELECT 1 FROM diario WHERE situacao = 'pendente' LIMIT 1").fetchone() is not None
+
+    # Remove do diário uma operação já enviada ao servidor.
+    def concluir(self, codigo):
+        self.conexao().execute("DELETE FROM diario WHERE _id = ?", (codigo,))
+
+    # Marca uma operação recusada pelo servidor, guardando o motivo.
+    def marcar_conflito(self, codigo, mensagem):
+        self.conexao().execute(
+            "UPDATE diario SET situacao = 'conflito', mensagem = ? WHERE _id = ?",
+            (mensagem, codigo))
+
+    def conflitos(self):
+        return [dict(linha) for linha in self.conexao().execute(
+            "SELECT * FROM diario WHERE situacao = 'conflito' ORDER BY _id")]
+
+    def descartar_conflitos(self):
+        return self.conexao().execute("DELETE FROM diario WHERE situacao = 'conflito'").rowcount
+
+    # Retorna a quantidade de operações pendentes e em conflito.
+    def contar(self):
+        contagem = dict(self.conexao().execute(
+            "SELECT situacao, COUNT(*) FROM diario GROUP BY situacao").fetchall())
+        return contagem.get("pendente", 0), contagem.get("conflito", 0)
+
+
+# Define a classe 'OnibusSincronizado', que envolve o acesso ao servidor
+# ('Onibus' ou 'ClienteServico') para que o guichê continue vendendo quando
+# a conexão cai. Enquanto há conexão e o diário está vazio, as operações
+# vão direto ao servidor, e a ocupação de cada viagem consultada é copiada
+# para o 'DiarioReservas'. Sem conexão, o mapa é montado pela cópia local e
+# as reservas e os cancelamentos são gravados no diário. Uma thread envia o
+# diário ao servidor, em lotes e na ordem em que as operações foram feitas,
+# assim que a conexão volta. Uma reserva recusada pelo servidor (o lugar
+# foi vendido por outro guichê nesse meio tempo), ou um cancelamento de
+# um lugar que agora é de outro passageiro, fica marcado como conflito no
+# diário até ser resolvido no guichê.
+class OnibusSincronizado:
+
+    partida_viagem = Onibus.partida_viagem
+
+    def __init__(self, remoto, caminho, intervalo=INTERVALO_SINCRONIZACAO):
+        self.remoto = remoto
+        self.diario = DiarioReservas(caminho)
+        self.intervalo = intervalo
+
+        # Passa a False quando uma operação falha por falta de conexão e
+        # volta a True quando a thread de sincronização consegue conectar.
+        self.conectado = True
+
+        # O cache de ocupação, a frota e as consultas que exigem o servidor
+        # são os do próprio servidor.
+        self.cache_ocupacao = remoto.cache_ocupacao
+        self.id_viagem = remoto.id_viagem
+        self.listar_rotas = remoto.listar_rotas
+        self.horarios_rota = remoto.horarios_rota
+        self.veiculo_viagem = remoto.veiculo_viagem
+        self.capacidade_viagem = remoto.capacidade_viagem
+        self.ocupacao_mes = remoto.ocupacao_mes
+        self.pesquisar_reservas = remoto.pesquisar_reservas
+
+        # Com o MongoDB, as alterações de outros terminais continuam sendo
+        # recebidas pelo change stream (veja 'AssinaturaViagem').
+        if hasattr(remoto, "fluxo_viagem"):
+            self.fluxo_viagem = remoto.fluxo_viagem
+            self.instante_alteracoes = remoto.instante_alteracoes
+
+        # A frota é lida enquanto há conexão, para que o mapa de assentos
+        # possa ser montado sem ela.
+        for rota in remoto.listar_rotas():
+            for horario in remoto.horarios_rota(rota):
+                remoto.veiculo_viagem(rota, horario)
+
+        threading.Thread(target=self.sincronizar_periodicamente, name="sincronizar-diario",
+                         daemon=True).start()
+
+    # Define o método 'usar_servidor', que informa se a próxima operação
+    # deve ir direto ao servidor. Com operações pendentes no diário, as
+    # novas também vão para o diário, para chegarem ao servidor na ordem
+    # em que foram feitas.
+    def usar_servidor(self):
+        return self.conectado and not self.diario.tem_pendentes()
+
+    def desconectar(self, erro):
+        if self.conectado:
+            print(f"Sem conexão com o servidor; as operações serão gravadas no diário local: {erro}")
+        self.conectado = False
+
+    def consultar_ocupacao(self, data, horario, rota=ROTA_PADRAO):
+        return MapaOcupacao.de_lugares(self.capacidade_viagem(rota, horario),
+                                       self.lugares_ocupados(data, horario, rota))
+
+    # Define o método 'lugares_ocupados', que lê a ocupação da viagem do
+    # servidor, copiando-a para o diário, ou, sem conexão, da cópia local.
+    # As operações pendentes do diário são sempre aplicadas.
+    def lugares_ocupados(self, dia, horario, rota=ROTA_PADRAO):
+        viagem = self.id_viagem(rota, dia, horario)
+
+        if self.conectado:
+            try:
+                lugares = self.remoto.consultar_ocupacao(dia, horario, rota).ocupados()
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+            else:
+                self.diario.guardar_ocupacao(viagem, rota, dia, horario, lugares)
+                return self.diario.aplicar_pendentes(viagem, set(lugares))
+
+        return self.diario.lugares_ocupados(viagem)
+
+    # Define o método 'resumos_periodo', que lê os resumos do servidor e
+    # aplica as operações pendentes do diário às viagens do período. Sem
+    # conexão, usa as viagens da cópia local.
+    def resumos_periodo(self, inicio, fim, rota=ROTA_PADRAO):
+
+        ocupacao = None
+        if self.conectado:
+            try:
+                ocupacao = self.remoto.resumos_periodo(inicio, fim, rota)
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+
+        resultado = dict(ocupacao or {})
+        for linha in self.diario.viagens_rota(rota, copiadas=ocupacao is None):
+            if not inicio <= datetime.strptime(linha["dia"], FORMATO_DATA).date() <= fim:
+                continue
+            try:
+                capacidade = self.capacidade_viagem(rota, linha["horario"])
+            except ValueError:
+                continue
+
+            chave = (linha["dia"], linha["horario"])
+            if ocupacao is None:
+                lugares = self.diario.lugares_ocupados(linha["viagem"])
+            else:
+                lugares = set(ocupacao[chave].ocupados()) if chave in ocupacao else set()
+                lugares = self.diario.aplicar_pendentes(linha["viagem"], lugares)
+            resultado[chave] = MapaOcupacao.de_lugares(capacidade, lugares)
+
+        return resultado
+
+    # Define os métodos de bloqueio dos lugares em atendimento (veja
+    # 'Onibus.bloquear_lugar'). Os bloqueios só existem no servidor: sem
+    # conexão, ou com um servidor que não os oferece, o lugar é tratado
+    # como livre para atendimento e o conflito, se houver, aparece na
+    # sincronização do diário.
+    def bloquear_lugar(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        if self.conectado and hasattr(self.remoto, "bloquear_lugar"):
+            try:
+                return self.remoto.bloquear_lugar(lugar, dia, horario, rota)
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+        return True
+
+    def liberar_lugar(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        if self.conectado and hasattr(self.remoto, "liberar_lugar"):
+            try:
+                self.remoto.liberar_lugar(lugar, dia, horario, rota)
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+
+    def lugares_bloqueados(self, dia, horario, rota=ROTA_PADRAO):
+        if self.conectado and hasattr(self.remoto, "lugares_bloqueados"):
+            try:
+                return self.remoto.lugares_bloqueados(dia, horario, rota)
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+        return set()
+
+    def reservar_lugar(self, num_lugar, nome, cpf, dia, horario, rota=ROTA_PADRAO):
+        return self.reservar_lugares([(num_lugar, nome, cpf, dia, horario, rota)])[0][1]
+
+    # Define o método 'reservar_lugares', com os mesmos parâmetros e
+    # resultados de 'Onibus.reservar_lugares'. Sem conexão, as reservas são
+    # conferidas com a cópia local e gravadas no diário em uma única
+    # transação; com 'tudo_ou_nada', ela é desfeita se alguma entrada não
+    # puder ser reservada.
+    def reservar_lugares(self, entradas, tudo_ou_nada=False):
+
+        entradas = [tuple(entrada) if len(entrada) == 6 else (*entrada, ROTA_PADRAO)
+                    for entrada in entradas]
+
+        if self.usar_servidor():
+            try:
+                return self.remoto.reservar_lugares(entradas, tudo_ou_nada)
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+
+        resultados = []
+        ocupacao = {}
+
+        try:
+            with self.diario.transacao() as conexao:
+                for num_lugar, nome, cpf, dia, horario, rota in entradas:
+
+                    try:
+                        capacidade = self.capacidade_viagem(rota, horario)
+                    except ValueError as e:
+                        resultados.append((False, str(e)))
+                        continue
+
+                    if num_lugar < 1 or num_lugar > capacidade:
+                        resultados.append((False, MENSAGEM_LUGAR_INVALIDO))
+                        continue
+
+                    try:
+                        self.partida_viagem(dia, horario)
+                    except ValueError:
+                        resultados.append((False, MENSAGEM_DATA_INVALIDA.format(dia=dia,
+                                                                                horario=horario)))
+                        continue
+
+                    viagem = self.id_viagem(rota, dia, horario)
+                    if viagem not in ocupacao:
+                        ocupacao[viagem] = self.diario.lugares_ocupados(viagem)
+
+                    if num_lugar in ocupacao[viagem]:
+                        resultados.append((False, f"Lugar {num_lugar} indisponível para {horario}"))
+                        continue
+
+                    ocupacao[viagem].add(num_lugar)
+                    self.diario.registrar(conexao, "reserva", viagem, num_lugar, nome, cpf,
+                                          dia, horario, rota)
+                    resultados.append((True, MENSAGEM_RESERVADO.format(lugar=num_lugar,
+                                                                       horario=horario)
+                                             + " (aguardando envio ao servidor)"))
+
+                if tudo_ou_nada and not all(reservado for reservado, _ in resultados):
+                    conexao.execute("ROLLBACK")
+                    for i, (num_lugar, _, _, _, horario, _) in enumerate(entradas):
+                        if resultados[i][0]:
+                            resultados[i] = (False, f"Lugar {num_lugar} não reservado para "
+                                                    f"{horario}: há outros lugares do grupo "
+                                                    f"indisponíveis")
+        finally:
+            for viagem in ocupacao:
+                self.cache_ocupacao.invalidar(viagem)
+
+        return resultados
+
+    importar_csv = Onibus.importar_csv
+
+    # Define o método 'cancelar_reserva', que cancela no servidor ou, sem
+    # conexão, registra o cancelamento no diário, com o passageiro lido do
+    # servidor para o lugar (veja 'enviar_cancelamento'). Uma reserva que
+    # ainda estava no diário é apenas retirada dele.
+    def cancelar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+
+        if self.usar_servidor():
+            try:
+                return self.remoto.cancelar_reserva(lugar, dia, horario, rota)
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+
+        viagem = self.id_viagem(rota, dia, horario)
+        try:
+            with self.diario.transacao() as conexao:
+                pendente = self.diario.ultima_pendente(viagem, lugar)
+                if pendente is not None and pendente["operacao"] == "reserva":
+                    self.diario.concluir(pendente["_id"])
+                    return f"Lugar {lugar} reserva cancelada para {horario}"
+
+                if lugar not in self.diario.lugares_ocupados(viagem):
+                    return f"Lugar {lugar} não está reservado para {horario}"
+
+                passageiro = self.diario.passageiro(viagem, lugar)
+                nome, cpf = (passageiro["nome"], passageiro["cpf"]) if passageiro else (None, None)
+                self.diario.registrar(conexao, "cancelamento", viagem, lugar, nome, cpf,
+                                      dia, horario, rota)
+                return (f"Lugar {lugar} reserva cancelada para {horario} "
+                        f"(aguardando envio ao servidor)")
+        finally:
+            self.cache_ocupacao.invalidar(viagem)
+
+    # O cancelamento em lote é feito apenas no servidor, depois que o
+    # diário foi enviado.
+    def cancelar_reservas(self, filtros, arquivar=False):
+        if not self.usar_servidor():
+            raise ValueError("O cancelamento em lote exige conexão com o servidor e "
+                             "que todas as operações do diário já tenham sido enviadas.")
+        return self.remoto.cancelar_reservas(filtros, arquivar)
+
+    # Define o método 'buscar_reserva', que retorna a reserva pendente do
+    # lugar, se houver, ou a do servidor, guardando o passageiro no diário.
+    # Sem conexão, um lugar reservado pela cópia local é retornado com o
+    # último passageiro lido do servidor, se houver.
+    def buscar_reserva(self, lugar, dia, horario, rota=ROTA_PADRAO):
+        viagem = self.id_viagem(rota, dia, horario)
+
+        pendente = self.diario.ultima_pendente(viagem, lugar)
+        if pendente is not None:
+            if pendente["operacao"] == "cancelamento":
+                return None
+            return {campo: pendente[campo]
+                    for campo in ("lugar", "nome", "cpf", "dia", "horario", "rota", "viagem")}
+
+        if self.conectado:
+            try:
+                reserva = self.remoto.buscar_reserva(lugar, dia, horario, rota)
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+            else:
+                if reserva is None:
+                    self.diario.esquecer_passageiro(viagem, lugar)
+                else:
+                    self.diario.guardar_passageiro(viagem, lugar, reserva["nome"], reserva["cpf"])
+                return reserva
+
+        if lugar not in self.diario.lugares_ocupados(viagem):
+            return None
+        passageiro = self.diario.passageiro(viagem, lugar)
+        if passageiro is None:
+            passageiro = {"nome": "(indisponível sem conexão)",
+                          "cpf": "(indisponível sem conexão)"}
+        return {"lugar": lugar, "nome": passageiro["nome"], "cpf": passageiro["cpf"],
+                "dia": dia, "horario": horario, "rota": rota, "viagem": viagem}
+
+    # Define o método 'sincronizar_periodicamente', executado pela thread
+    # de sincronização: a cada 'intervalo' segundos, se estiver sem conexão
+    # ou com operações pendentes, tenta conectar e enviar o diário.
+    def sincronizar_periodicamente(self):
+        while True:
+            time.sleep(self.intervalo)
+            if self.conectado and not self.diario.tem_pendentes():
+                continue
+
+            try:
+                self.remoto.verificar_conexao()
+                if not self.conectado:
+                    print("Conexão com o servidor restabelecida; enviando o diário local.")
+                self.conectado = True
+                self.enviar_diario()
+
+            except ERROS_CONEXAO as e:
+                self.desconectar(e)
+
+            except Exception as e:
+                print(f"Falha ao enviar o diário local: {e}")
+
+    # Define o método 'enviar_diario', que envia as operações pendentes ao
+    # servidor em lotes de TAMANHO_LOTE_SINCRONIZACAO, na ordem em que
+    # foram feitas. Reservas seguidas são enviadas juntas, com um único
+    # 'reservar_lugares'. Cada operação sai do diário assim que o servidor
+    # a confirma, então uma queda no meio do envio não perde nem repete
+    # operações. Uma operação que o servidor recusa com outro erro que não
+    # a falta de conexão (por exemplo, uma rota retirada) vira conflito,
+    # para não travar o envio das seguintes.
+    def enviar_diario(self):
+        while True:
+            operacoes = self.diario.pendentes(TAMANHO_LOTE_SINCRONIZACAO)
+            if not operacoes:
+                return
+
+            inicio = 0
+            while inicio < len(operacoes):
+                fim = inicio
+                while (fim < len(operacoes)
+                       and operacoes[fim]["operacao"] == operacoes[inicio]["operacao"]):
+                    fim += 1
+
+                if operacoes[inicio]["operacao"] == "reserva":
+                    self.enviar_reservas(operacoes[inicio:fim])
+                else:
+                    for operacao in operacoes[inicio:fim]:
+                        try:
+                            self.enviar_cancelamento(operacao)
+                        except ERROS_CONEXAO:
+                            raise
+                        except Exception as e:
+                            self.diario.marcar_conflito(operacao["_id"], str(e))
+
+                inicio = fim
+
+    # Envia um grupo de reservas do diário. Uma reserva recusada porque o
+    # próprio guichê já a havia enviado (o programa caiu antes de retirá-la
+    # do diário) é considerada enviada; as demais recusas viram conflitos.
+    # Se o servidor recusa o grupo inteiro, as reservas são reenviadas uma
+    # a uma, para que só a recusada vire conflito.
+    def enviar_reservas(self, operacoes):
+        try:
+            resultados = self.remoto.reservar_lugares([
+                (operacao["lugar"], operacao["nome"], operacao["cpf"],
+                 operacao["dia"], operacao["horario"], operacao["rota"])
+                for operacao in operacoes
+            ])
+        except ERROS_CONEXAO:
+            raise
+        except Exception as e:
+            if len(operacoes) == 1:
+                self.diario.marcar_conflito(operacoes[0]["_id"], str(e))
+            else:
+                for operacao in operacoes:
+                    self.enviar_reservas([operacao])
+            return
+
+        for operacao, (reservado, mensagem) in zip(operacoes, resultados):
+            if not reservado:
+                existente = self.remoto.buscar_reserva(operacao["lugar"], operacao["dia"],
+                                                       operacao["horario"], operacao["rota"])
+                reservado = (existente is not None
+                             and existente.get("cpf") == operacao["cpf"]
+                             and existente.get("nome") == operacao["nome"])
+
+            if reservado:
+                self.diario.concluir(operacao["_id"])
+            else:
+                self.diario.marcar_conflito(operacao["_id"], mensagem)
+
+    # Envia um cancelamento do diário. A reserva só é cancelada no servidor
+    # se ainda for do passageiro registrado no diário: se o lugar foi
+    # cancelado e vendido a outro passageiro por outro guichê nesse meio
+    # tempo, ou se o passageiro não era conhecido, o cancelamento vira
+    # conflito. Um lugar que já está livre dá o cancelamento por enviado.
+    def enviar_cancelamento(self, operacao):
+        lugar, horario = operacao["lugar"], operacao["horario"]
+        existente = self.remoto.buscar_reserva(lugar, operacao["dia"], horario, operacao["rota"])
+
+        if existente is None:
+            self.diario.concluir(operacao["_id"])
+        elif (operacao["cpf"] is not None
+              and existente.get("cpf") == operacao["cpf"]
+              and existente.get("nome") == operacao["nome"]):
+            self.remoto.cancelar_reserva(lugar, operacao["dia"], horario, operacao["rota"])
+            self.diario.concluir(operacao["_id"])
+        elif operacao["cpf"] is None:
+            self.diario.marcar_conflito(
+                operacao["_id"], f"Lugar {lugar} não cancelado para {horario}: o passageiro "
+                                 f"não era conhecido sem conexão; confirme o cancelamento")
         else:
+            self.diario.marcar_conflito(
+                operacao["_id"], f"Lugar {lugar} não cancelado para {horario}: a reserva "
+                                 f"agora é de outro passageiro")
+
+    # Define o método 'situacao_sincronizacao', que retorna um dicionário
+    # com 'conectado' e as quantidades de operações 'pendentes' e em
+    # 'conflitos', exibido pela JanelaPrincipal.
+    def situacao_sincronizacao(self):
+        pendentes, conflitos = self.diario.contar()
+        return {"conectado": self.conectado, "pendentes": pendentes, "conflitos": conflitos}
+
+    def conflitos(self):
+        return self.diario.conflitos()
+
+    # Descarta as reservas em conflito, depois que os passageiros foram
+    # remarcados no guichê. Retorna quantas foram descartadas.
+    def descartar_conflitos(self):
+        return self.diario.descartar_conflitos()
+
+
+# Define a classe 'AssinaturaViagem', que acompanha em uma thread separada
+# as reservas da viagem exibida no mapa e avisa quando outro terminal
+# reserva ou cancela um lugar, dispensando o botão "Atualizar Mapa".
+# Usa um change stream do MongoDB filtrado pela viagem. Se o servidor não
+# oferece change streams (não é um replica set), passa a consultar a viagem
+# a cada 'intervalo' segundos, avisando apenas os lugares que mudaram.
+# 'ao_alterar(viagem, alteracoes)' é chamado na thread da assinatura, com
+# 'viagem' sendo a tupla (dia, horário, rota) e 'alteracoes' sendo uma lista de (lugar, ocupado) ou None quando não é
+# possível saber o que mudou e a viagem deve ser recarregada.
+class AssinaturaViagem:
+
+    def __init__(self, onibus, ao_alterar, intervalo=INTERVALO_CONSULTA_MAPA):
+        self.onibus = onibus
+        self.ao_alterar = ao_alterar
+        self.intervalo = intervalo
+
+        # Viagem (dia, horário, rota) acompanhada e evento que sinaliza sua troca.
+        self.viagem = None
+        self.trocou = threading.Event()
+        self.parado = False
+
+        # Pontos de partida do change stream, cada um junto da viagem a que
+        # se refere: o instante em que o mapa da viagem foi lido ('inicio',
+        # veja 'Onibus.instante_alteracoes') e o último ponto já recebido do
+        # fluxo ('retomada'), usado ao reconectar sem perder alterações.
+        self.inicio = None
+        self.retomada = None
+
+        # Passa a False quando o servidor não oferece change streams. O
+        # cliente do serviço HTTP e o banco local não os oferecem e sempre
+        # consultam.
+        self.usar_change_stream = hasattr(onibus, "fluxo_viagem")
+
+        threading.Thread(target=self.executar, name="assinatura-viagem", daemon=True).start()
+
+    # Passa a acompanhar outra viagem. 'inicio' é o instante em que o mapa
+    # exibido foi lido, quando conhecido.
+    def trocar_viagem(self, dia, horario, rota=ROTA_PADRAO, inicio=None):
+        self.inicio = ((dia, horario, rota), inicio)
+        self.viagem = (dia, horario, rota)
+        self.trocou.set()
+
+    def parar(self):
+        self.parado = True
+        self.trocou.set()
+
+    def executar(self):
+        while True:
+            # Espera até que exista uma viagem para acompanhar.
+            self.trocou.wait()
+            self.trocou.clear()
+            if self.parado:
+                return
+
+            viagem = self.viagem
+
+            if self.usar_change_stream:
+                try:
+                    self.observar(viagem)
+
+                    # Se o change stream foi encerrado pelo servidor (e não
+                    # pela troca de viagem), abre outro para a mesma viagem.
+                    self.trocou.set()
+                    continue
+
+                except OperationFailure as e:
+                    # Servidor fora de replica set: usa consultas periódicas.
+                    print(f"Change streams indisponíveis, consultando a cada {self.intervalo}s: {e}")
+                    self.usar_change_stream = False
+
+                except PyMongoError as e:
+                    # Falha de conexão: tenta novamente após o intervalo.
+                    print(f"Falha ao acompanhar as reservas: {e}")
+                    if not self.trocou.wait(self.intervalo):
+                        self.trocou.set()
+                    continue
+
+            self.consultar_periodicamente(viagem)
+
+    # Acompanha a viagem pelo change stream até que ela seja trocada. Ao
+    # reconectar, retoma o fluxo do último ponto recebido; na primeira
+    # abertura, do instante em que o mapa foi lido.
+    def observar(self, viagem):
+        id_viagem = self.onibus.id_viagem(viagem[2], viagem[0], viagem[1])
+
+        retomar = self.retomada[1] if self.retomada and self.retomada[0] == viagem else None
+        inicio = self.inicio[1] if self.inicio and self.inicio[0] == viagem else None
+
+        with self.onibus.fluxo_viagem(id_viagem, inicio=inicio, retomar=retomar) as fluxo:
+
+            while fluxo.alive and not self.trocou.is_set():
+                alteracao = fluxo.try_next()
+                if fluxo.resume_token is not None:
+                    self.retomada = (viagem, fluxo.resume_token)
+                if alteracao is None:
+                    continue
+
+                if alteracao["operationType"] == "insert":
+                    alteracoes = [(alteracao["fullDocument"]["lugar"], True)]
+                elif alteracao["operationType"] == "delete" and alteracao.get("fullDocumentBeforeChange"):
+                    alteracoes = [(alteracao["fullDocumentBeforeChange"]["lugar"], False)]
+                else:
+                    alteracoes = None
 
-            # Se o lugar não está reservado, retorna uma mensagem
-            # indicando que não há reserva para cancelar.
-            return f"Lugar {lugar} não está reservado para {horario}"
+                self.onibus.cache_ocupacao.invalidar(id_viagem)
+                self.ao_alterar(viagem, alteracoes)
+
+    # Consulta a viagem periodicamente até que ela seja trocada, avisando
+    # apenas os lugares que mudaram desde a consulta anterior.
+    def consultar_periodicamente(self, viagem):
+        anterior = None
+        espera = 0
+
+        while not self.trocou.wait(espera):
+            espera = self.intervalo
+
+            try:
+                ocupados = self.onibus.lugares_ocupados(*viagem)
+            except (PyMongoError, OSError) as e:
+                print(f"Falha ao consultar as reservas: {e}")
+                continue
+
+            if anterior is not None and ocupados != anterior:
+                alteracoes = ([(lugar, True) for lugar in ocupados - anterior]
+                              + [(lugar, False) for lugar in anterior - ocupados])
+                self.onibus.cache_ocupacao.invalidar(self.onibus.id_viagem(viagem[2], viagem[0], viagem[1]))
+                self.ao_alterar(viagem, alteracoes)
+
+            anterior = ocupados
+
+
+# Define a classe 'ExecutorBanco', que executa as operações de banco de
+# dados em um conjunto de threads, para que uma consulta lenta não
+# congele a interface. O Tkinter só pode ser usado pela thread principal,
+# então as threads apenas colocam os resultados em uma fila, e a própria
+# janela os retira periodicamente (via 'after') e chama os callbacks.
+class ExecutorBanco:
+
+    def __init__(self, janela, trabalhadores=TRABALHADORES_BANCO):
+        self.janela = janela
+        self.pool = ThreadPoolExecutor(max_workers=trabalhadores,
+                                       thread_name_prefix="banco")
+
+        # Fila de respostas prontas, preenchida pelas threads do pool.
+        self.respostas = queue.SimpleQueue()
+
+        # Número da requisição mais recente de cada chave. Respostas de
+        # requisições mais antigas com a mesma chave são descartadas.
+        self.geracoes = {}
+
+        self.janela.after(INTERVALO_RESPOSTAS_MS, self.entregar_respostas)
+
+    # Executa 'funcao(*args)' em uma thread do pool. Ao terminar, chama
+    # 'ao_concluir(resultado)' ou 'ao_falhar(excecao)' na thread da interface.
+    # Quando 'chave' é informada, apenas a resposta da última chamada com
+    # essa chave é entregue (por exemplo, o mapa de um horário que o usuário
+    # já trocou por outro é ignorado).
+    def executar(self, funcao, *args, ao_concluir=None, ao_falhar=None, chave=None):
+
+        geracao = None
+        if chave is not None:
+            geracao = self.geracoes.get(chave, 0) + 1
+            self.geracoes[chave] = geracao
+
+        def tarefa():
+            try:
+                resultado = funcao(*args)
+            except Exception as e:
+                self.respostas.put((chave, geracao, ao_falhar, e, True))
+            else:
+                self.respostas.put((chave, geracao, ao_concluir, resultado, False))
+
+        self.pool.submit(tarefa)
+
+    # Agenda 'callback(valor)' para ser chamado na thread da interface.
+    # Pode ser chamado de qualquer thread.
+    def notificar(self, callback, valor):
+        self.respostas.put((None, None, callback, valor, False))
+
+    # Entrega as respostas prontas aos callbacks, na thread da interface.
+    def entregar_respostas(self):
+        try:
+            while True:
+                chave, geracao, callback, valor, erro = self.respostas.get_nowait()
+
+                # Descarta respostas que já foram substituídas por outra requisição.
+                if chave is not None and self.geracoes.get(chave) != geracao:
+                    continue
+
+                if callback is not None:
+                    callback(valor)
+                elif erro:
+                    messagebox.showerror("Erro", f"Falha ao acessar o banco de dados: {valor}")
+
+        except queue.Empty:
+            pass
+
+        finally:
+            self.janela.after(INTERVALO_RESPOSTAS_MS, self.entregar_respostas)
 
 
 # Define a classe 'JanelaCadastro', responsável por criar e gerenciar a
@@ -237,7 +3648,13 @@ class JanelaCadastro:
     # permitir chamadas de volta a métodos da janela principal.
     # data_inicial: data predefinida para facilitar o processo de cadastro,
     # geralmente a data atual selecionada na janela principal.
-    def __init__(self, janela_pai, onibus, janela_principal, data_inicial, lugar=None):
+    # rota: rota predefinida, geralmente a selecionada na janela principal.
+    # horario: horário predefinido, o do mapa em que o lugar foi clicado.
+    # bloqueado: indica que o lugar foi bloqueado pela janela principal
+    # (veja 'Onibus.bloquear_lugar'); a janela renova o bloqueio enquanto
+    # está aberta e o desfaz ao ser fechada.
+    def __init__(self, janela_pai, onibus, janela_principal, data_inicial, lugar=None,
+                 rota=ROTA_PADRAO, horario=None, bloqueado=False):
         # Primeiro, criamos a janela
         self.janela = tk.Toplevel(janela_pai)
         self.janela.title("Cadastrar Reserva")
@@ -257,6 +3674,7 @@ class JanelaCadastro:
         self.cpf_var = tk.StringVar(self.janela)
         self.lugar_var = tk.StringVar(self.janela, value=str(lugar) if lugar else "")
         self.horario_var = tk.StringVar(self.janela)
+        self.rota_var = tk.StringVar(self.janela, value=rota)
         
         # Armazena as referências
         self.janela_principal = janela_principal
@@ -328,27 +3746,46 @@ class JanelaCadastro:
         self.cal_cadastro.pack()
         self.cal_cadastro.selection_set(data_inicial)
         
+        # Rota
+        tk.Label(frame_form,
+                text="Rota:",
+                font=("Segoe UI", 14),
+                bg="white").grid(row=4, column=0, sticky='e', padx=5, pady=5)
+        
+        self.rota_combo = ttk.Combobox(frame_form,
+                                      textvariable=self.rota_var,
+                                      values=onibus.listar_rotas(),
+                                      font=("Segoe UI", 14),
+                                      state="readonly",
+                                      width=15)
+        self.rota_combo.grid(row=4, column=1, sticky='w', padx=5, pady=5)
+        
+        # Ao trocar a rota, mostra os horários da nova rota
+        self.rota_combo.bind('<<ComboboxSelected>>',
+                             lambda e: self.horario_combo.configure(
+                                 values=onibus.horarios_rota(self.rota_var.get())))
+        
         # Horário
         tk.Label(frame_form,
                 text="Horário:",
                 font=("Segoe UI", 14),
-                bg="white").grid(row=4, column=0, sticky='e', padx=5, pady=5)
+                bg="white").grid(row=5, column=0, sticky='e', padx=5, pady=5)
         
         self.horario_combo = ttk.Combobox(frame_form,
                                          textvariable=self.horario_var,
-                                         values=onibus.horarios,
+                                         values=onibus.horarios_rota(rota),
                                          font=("Segoe UI", 14),
                                          state="readonly",
                                          width=15)
-        self.horario_combo.grid(row=4, column=1, sticky='w', padx=5, pady=5)
+        self.horario_combo.grid(row=5, column=1, sticky='w', padx=5, pady=5)
         
         # Adiciona o placeholder
         self.horario_combo.set("Selecione o horário")
         
         # Adiciona evento para quando o combobox receber foco
         def on_focus_in(event):
-            if self.horario_var.get() == "Selecione o horário":
-                self.horario_combo.set(onibus.horarios[0])
+            if self.horario_var.get() not in self.horario_combo['values']:
+                self.horario_combo.set(self.horario_combo['values'][0])
         
         self.horario_combo.bind('<FocusIn>', on_focus_in)
         
@@ -357,18 +3794,68 @@ class JanelaCadastro:
         frame_botao.pack(fill='x', pady=20)
         
         # Botão de reservar
-        ttk.Button(frame_botao,
-                  text="Reservar",
-                  style='Success.TButton',
-                  command=self.reservar).pack(pady=10)
+        self.botao_reservar = ttk.Button(frame_botao,
+                                        text="Reservar",
+                                        style='Success.TButton',
+                                        command=self.reservar)
+        self.botao_reservar.pack(pady=10)
         
         # Configura o grid do frame_form
         frame_form.grid_columnconfigure(1, weight=1)
         
+        if horario in self.horario_combo['values']:
+            self.horario_combo.set(horario)
+
         # Centraliza a janela
         self.janela.transient(janela_pai)
         self.janela.grab_set()
 
+        # Viagem e lugar bloqueados para esta janela
+        self.bloqueio = (lugar, data_inicial, horario, rota) if bloqueado else None
+        self.reservando = False
+        if self.bloqueio:
+            self.janela.protocol("WM_DELETE_WINDOW", self.fechar)
+            self.janela.after(DURACAO_BLOQUEIO * 500, self.renovar_bloqueio)
+
+    # Renova o bloqueio do lugar na metade de sua duração, enquanto a
+    # janela estiver aberta. A renovação confere de novo se o lugar foi
+    # reservado (veja 'Onibus.bloquear_lugar').
+    def renovar_bloqueio(self):
+        if not self.bloqueio or not self.janela.winfo_exists():
+            return
+        self.janela_principal.executor.executar(self.onibus.bloquear_lugar, *self.bloqueio,
+                                                ao_concluir=self.bloqueio_renovado,
+                                                ao_falhar=lambda e: None)
+        self.janela.after(DURACAO_BLOQUEIO * 500, self.renovar_bloqueio)
+
+    # Chamado na thread da interface quando a renovação termina. Se o lugar
+    # foi vendido por outro guichê (ou o bloqueio venceu e foi assumido por
+    # outro), fecha a janela em vez de deixar o atendente terminar um
+    # cadastro que seria recusado. Com uma reserva desta janela em
+    # andamento, o resultado é ignorado: a reserva pode ser a própria.
+    def bloqueio_renovado(self, bloqueado):
+        if bloqueado or self.reservando or not self.bloqueio or not self.janela.winfo_exists():
+            return
+        lugar = self.bloqueio[0]
+        self.bloqueio = None
+        messagebox.showwarning("Lugar Indisponível",
+                               f"O lugar {lugar} foi reservado ou está em atendimento "
+                               f"em outro guichê.")
+        self.fechar()
+        self.janela_principal.atualizar_mapa()
+
+    # Desfaz o bloqueio do lugar. Se o lugar foi reservado, o bloqueio já
+    # foi removido pela própria reserva e nada é alterado.
+    def liberar_bloqueio(self):
+        if self.bloqueio:
+            self.janela_principal.executor.executar(self.onibus.liberar_lugar, *self.bloqueio,
+                                                    ao_falhar=lambda e: None)
+            self.bloqueio = None
+
+    def fechar(self):
+        self.liberar_bloqueio()
+        self.janela.destroy()
+
     # Define o método 'reservar' que é chamado ao clicar no
     # botão "Reservar" na janela de cadastro.
     def reservar(self):
@@ -376,6 +3863,7 @@ class JanelaCadastro:
         cpf = self.cpf_var.get().strip()
         dia = self.cal_cadastro.get_date()
         horario = self.horario_var.get()
+        rota = self.rota_var.get()
         
         try:
             lugar = int(self.lugar_var.get())
@@ -383,15 +3871,31 @@ class JanelaCadastro:
             messagebox.showwarning("Aviso", "Lugar inválido.")
             return
         
-        if not nome or not cpf or not dia or not horario:
+        if not nome or not cpf or not dia or horario not in self.horario_combo['values']:
             messagebox.showwarning("Aviso", "Preencha todos os campos.")
             return
         
-        res = self.onibus.reservar_lugar(lugar, nome, cpf, dia, horario)
+        # Evita reservas repetidas enquanto a anterior está em andamento
+        self.reservando = True
+        self.botao_reservar.configure(state=tk.DISABLED, text="Reservando...")
+        
+        self.janela_principal.executor.executar(self.onibus.reservar_lugar,
+                                                lugar, nome, cpf, dia, horario, rota,
+                                                ao_concluir=self.reserva_concluida,
+                                                ao_falhar=self.reserva_falhou)
+    
+    # Chamado na thread da interface quando a reserva termina
+    def reserva_concluida(self, res):
         messagebox.showinfo("Info", res)
         
-        self.janela.destroy()
+        self.fechar()
         self.janela_principal.atualizar_mapa()
+    
+    def reserva_falhou(self, erro):
+        self.reservando = False
+        messagebox.showerror("Erro", f"Falha ao reservar: {erro}")
+        if self.janela.winfo_exists():
+            self.botao_reservar.configure(state=tk.NORMAL, text="Reservar")
 
 
 # Define a classe 'JanelaPesquisa' para gerenciar a interface de
@@ -434,9 +3938,15 @@ class JanelaPesquisa:
         frame_filtros.pack(fill='x', pady=(0, 20))
         
         # Campos de filtro
-        self.rotulos_filtro = ["Lugar", "Nome", "CPF", "Data", "Horário"]
+        self.rotulos_filtro = ["Lugar", "Nome", "CPF", "Data", "Horário", "Rota"]
+        self.campos_consulta = ["lugar", "nome", "cpf", "dia", "horario", "rota"]
         self.campos_filtro = []
         
+        # Filtros aplicados e posição da próxima página
+        self.filtros = {}
+        self.cursor = None
+        self.carregando = False
+        
         # Cria os campos de filtro
         for i, rotulo in enumerate(self.rotulos_filtro):
             # Frame para cada campo
@@ -468,7 +3978,7 @@ class JanelaPesquisa:
         
         # Treeview
         self.treeview = ttk.Treeview(frame_tabela)
-        self.treeview["columns"] = ("Lugar", "Nome", "CPF", "Data", "Horário")
+        self.treeview["columns"] = ("Lugar", "Nome", "CPF", "Data", "Horário", "Rota")
         
         # Configuração das colunas
         self.treeview.column("#0", width=0, stretch=tk.NO)
@@ -477,6 +3987,7 @@ class JanelaPesquisa:
         self.treeview.column("CPF", width=150, anchor=tk.CENTER)
         self.treeview.column("Data", width=100, anchor=tk.CENTER)
         self.treeview.column("Horário", width=100, anchor=tk.CENTER)
+        self.treeview.column("Rota", width=150, anchor=tk.CENTER)
         
         # Configuração dos cabeçalhos
         self.treeview.heading("Lugar", text="Lugar", anchor=tk.CENTER)
@@ -484,16 +3995,33 @@ class JanelaPesquisa:
         self.treeview.heading("CPF", text="CPF", anchor=tk.CENTER)
         self.treeview.heading("Data", text="Data", anchor=tk.CENTER)
         self.treeview.heading("Horário", text="Horário", anchor=tk.CENTER)
+        self.treeview.heading("Rota", text="Rota", anchor=tk.CENTER)
         
-        # Scrollbar
-        scrollbar = ttk.Scrollbar(frame_tabela,
-                                 orient=tk.VERTICAL,
-                                 command=self.treeview.yview)
-        self.treeview.configure(yscrollcommand=scrollbar.set)
+        # Scrollbar. A tabela é virtual: apenas as linhas visíveis (e uma
+        # pequena margem) existem como itens do Treeview, então a barra
+        # de rolagem é controlada pela lista completa em 'self.linhas'
+        self.scrollbar = ttk.Scrollbar(frame_tabela,
+                                      orient=tk.VERTICAL,
+                                      command=self.rolar)
         
         # Empacotamento
         self.treeview.pack(side=tk.LEFT, fill='both', expand=True)
-        scrollbar.pack(side=tk.RIGHT, fill='y')
+        self.scrollbar.pack(side=tk.RIGHT, fill='y')
+        
+        # Rolagem pelo mouse (Windows/macOS e Linux)
+        self.treeview.bind('<MouseWheel>',
+                           lambda e: self.rolar_linhas(-3 if e.delta > 0 else 3))
+        self.treeview.bind('<Button-4>', lambda e: self.rolar_linhas(-3))
+        self.treeview.bind('<Button-5>', lambda e: self.rolar_linhas(3))
+        
+        # Recalcula as linhas visíveis quando a janela é redimensionada
+        self.treeview.bind('<Configure>', lambda e: self.renderizar())
+        
+        # Valores de todas as linhas carregadas, primeira linha visível
+        # e intervalo de linhas que existem no Treeview
+        self.linhas = []
+        self.topo = 0
+        self.bloco = (0, 0)
         
         # Frame para botões de ação
         frame_acoes = tk.Frame(frame_principal, bg="white")
@@ -505,72 +4033,201 @@ class JanelaPesquisa:
                   style='Warning.TButton',
                   command=self.cancelar_reserva).pack(side=tk.LEFT, padx=5)
         
+        # Botão de cancelar todas as reservas que atendem aos filtros
+        ttk.Button(frame_acoes,
+                  text="Cancelar Todas Filtradas",
+                  style='Warning.TButton',
+                  command=self.cancelar_filtradas).pack(side=tk.LEFT, padx=5)
+        
+        # Botão para buscar a próxima página de resultados
+        self.botao_mais = ttk.Button(frame_acoes,
+                                    text="Carregar Mais",
+                                    style='Primary.TButton',
+                                    command=self.carregar_proxima_pagina)
+        self.botao_mais.pack(side=tk.RIGHT, padx=5)
+        
         # Agora que tudo está configurado, carregamos as reservas
         self.carregar_reservas()
     
     def carregar_reservas(self):
         # Limpa o treeview
-        for item in self.treeview.get_children():
-            self.treeview.delete(item)
+        self.limpar_tabela()
+        self.linhas = []
+        self.topo = 0
+        
+        # Volta para a primeira página dos filtros atuais. Uma página
+        # ainda em andamento, de filtros anteriores, será descartada
+        self.cursor = None
+        self.carregando = False
+        self.carregar_proxima_pagina()
+    
+    def carregar_proxima_pagina(self):
+        # Não pede a mesma página duas vezes
+        if self.carregando:
+            return
+        self.carregando = True
+        self.botao_mais.configure(state=tk.DISABLED, text="Carregando...")
         
-        # Carrega todas as reservas
-        self.reservas = list(self.onibus.colecao_reservas.find({}))
+        # Busca no banco apenas a próxima página de reservas, fora da
+        # thread da interface
+        self.janela_principal.executor.executar(self.onibus.pesquisar_reservas,
+                                                self.filtros, self.cursor,
+                                                ao_concluir=self.exibir_pagina,
+                                                ao_falhar=self.falha_pagina,
+                                                chave=("pesquisa", id(self)))
+    
+    def falha_pagina(self, erro):
+        self.carregando = False
+        if self.janela.winfo_exists():
+            self.botao_mais.configure(state=tk.NORMAL, text="Carregar Mais")
+        messagebox.showerror("Erro", f"Falha ao pesquisar reservas: {erro}")
+    
+    @medir_operacao("interface.pesquisa_pagina")
+    def exibir_pagina(self, pagina):
+        self.carregando = False
+        
+        # A janela pode ter sido fechada enquanto a página era buscada
+        if not self.janela.winfo_exists():
+            return
+        
+        reservas, self.cursor = pagina
         
-        # Insere as reservas no treeview
-        for reserva in self.reservas:
+        # Guarda as reservas como tuplas de valores; os itens do
+        # treeview são criados apenas para as linhas visíveis
+        for reserva in reservas:
             # Obtém os valores com tratamento para campos ausentes
             lugar = reserva.get("lugar", "N/A")
             nome = reserva.get("nome", "N/A")
             cpf = reserva.get("cpf", "N/A")
             dia = reserva.get("dia", "N/A")
             horario = reserva.get("horario", "N/A")  # Usa "N/A" se o horário não existir
+            rota = reserva.get("rota", ROTA_PADRAO)
             
-            self.treeview.insert("",
-                                tk.END,
-                                values=(lugar, nome, cpf, dia, horario))
+            self.linhas.append((lugar, nome, cpf, dia, horario, rota))
+        
+        # Só permite carregar mais quando ainda existem páginas
+        self.botao_mais.configure(state=tk.NORMAL if self.cursor is not None else tk.DISABLED,
+                                  text="Carregar Mais")
+        
+        # Força a recriação dos itens com as novas linhas
+        self.bloco = (0, 0)
+        self.renderizar()
     
-    def filtrar_reservas(self):
-        # Limpa o treeview
-        for item in self.treeview.get_children():
-            self.treeview.delete(item)
+    def limpar_tabela(self):
+        # Remove todos os itens de uma só vez
+        self.treeview.delete(*self.treeview.get_children())
+        self.bloco = (0, 0)
+    
+    def linhas_visiveis(self):
+        # Quantidade de linhas que cabem na altura atual do treeview,
+        # descontando o cabeçalho
+        altura_linha = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        return max(1, self.treeview.winfo_height() // altura_linha - 1)
+    
+    @medir_operacao("interface.pesquisa_renderizar")
+    def renderizar(self):
+        total = len(self.linhas)
+        visiveis = self.linhas_visiveis()
+        self.topo = max(0, min(self.topo, total - visiveis))
+        
+        # Recria os itens apenas quando a parte visível sai do bloco atual
+        inicio, fim = self.bloco
+        if not (inicio <= self.topo and min(self.topo + visiveis, total) <= fim):
+            self.limpar_tabela()
+            inicio = max(0, self.topo - LINHAS_EXTRAS_PESQUISA)
+            fim = min(total, self.topo + visiveis + LINHAS_EXTRAS_PESQUISA)
+            for valores in self.linhas[inicio:fim]:
+                self.treeview.insert("", tk.END, values=valores)
+            self.bloco = (inicio, fim)
+        
+        # Posiciona o treeview na primeira linha visível dentro do bloco
+        if fim > inicio:
+            self.treeview.yview_moveto((self.topo - inicio) / (fim - inicio))
+        
+        # Atualiza a barra de rolagem em relação a todas as linhas carregadas
+        if total:
+            self.scrollbar.set(self.topo / total, min(self.topo + visiveis, total) / total)
+        else:
+            self.scrollbar.set(0, 1)
+    
+    def rolar_linhas(self, quantidade):
+        self.topo += quantidade
+        self.renderizar()
+        
+        # Ao chegar ao fim das linhas carregadas, busca a próxima página
+        if (self.cursor is not None
+                and self.topo + self.linhas_visiveis() >= len(self.linhas)):
+            self.carregar_proxima_pagina()
+        
+        # Impede a rolagem padrão do treeview
+        return "break"
+    
+    def rolar(self, acao, quantidade, unidade=None):
+        # Recebe os comandos da barra de rolagem: 'moveto fração' ou
+        # 'scroll n units/pages'
+        if acao == "moveto":
+            self.rolar_linhas(int(float(quantidade) * len(self.linhas)) - self.topo)
+        elif unidade == "pages":
+            self.rolar_linhas(int(quantidade) * self.linhas_visiveis())
+        else:
+            self.rolar_linhas(int(quantidade))
+    
+    def reservas_alteradas(self, viagem, alteracoes):
+        # Chamado pela janela principal quando outro terminal altera a
+        # viagem exibida no mapa
+        dia, horario, rota = viagem
+        
+        # Uma pesquisa restrita a essa viagem é recarregada por completo
+        if (self.filtros.get("dia") == dia and self.filtros.get("horario") == horario
+                and self.filtros.get("rota", rota) == rota):
+            self.carregar_reservas()
+            return
+        
+        if alteracoes is None:
+            return
         
-        # Cria o dicionário de filtros
+        # Nas demais, remove as linhas dos lugares que foram cancelados
+        liberados = {lugar for lugar, ocupado in alteracoes if not ocupado}
+        if liberados:
+            self.linhas = [linha for linha in self.linhas
+                           if not (linha[0] in liberados and linha[3:6] == (dia, horario, rota))]
+            self.bloco = (0, 0)
+            self.renderizar()
+    
+    def filtrar_reservas(self):
+        # Cria o dicionário de filtros, que será convertido em
+        # uma consulta do MongoDB por 'pesquisar_reservas'
         filtros = {}
-        for rotulo, campo in zip(self.rotulos_filtro, self.campos_filtro):
-            valor = campo.get().strip()
+        for campo, entrada in zip(self.campos_consulta, self.campos_filtro):
+            valor = entrada.get().strip()
             if valor:
-                filtros[rotulo] = valor.lower()
+                filtros[campo] = valor
         
-        # Filtra as reservas
-        for reserva in self.reservas:
-            corresponde = True
-            
-            # Obtém os valores com tratamento para campos ausentes
-            lugar = str(reserva.get("lugar", "N/A")).lower()
-            nome = reserva.get("nome", "N/A").lower()
-            cpf = reserva.get("cpf", "N/A").lower()
-            dia = reserva.get("dia", "N/A").lower()
-            horario = reserva.get("horario", "N/A").lower()
-            
-            if "Lugar" in filtros and filtros["Lugar"] != lugar:
-                corresponde = False
-            if "Nome" in filtros and filtros["Nome"] not in nome:
-                corresponde = False
-            if "CPF" in filtros and filtros["CPF"] != cpf:
-                corresponde = False
-            if "Data" in filtros and filtros["Data"] != dia:
-                corresponde = False
-            if "Horário" in filtros and filtros["Horário"] != horario:
-                corresponde = False
-            
-            if corresponde:
-                self.treeview.insert("",
-                                    tk.END,
-                                    values=(reserva.get("lugar", "N/A"),
-                                           reserva.get("nome", "N/A"),
-                                           reserva.get("cpf", "N/A"),
-                                           reserva.get("dia", "N/A"),
-                                           reserva.get("horario", "N/A")))
+        # O lugar é gravado como número no banco
+        if "lugar" in filtros:
+            try:
+                filtros["lugar"] = int(filtros["lugar"])
+            except ValueError:
+                messagebox.showwarning("Aviso", "Lugar inválido.")
+                return
+        
+        # A data pode ser um dia ou um período ('dd/mm/aaaa a dd/mm/aaaa'),
+        # pesquisados pelo intervalo de datas de partida
+        if "dia" in filtros:
+            partes = [parte.strip() for parte in filtros["dia"].split(" a ")]
+            try:
+                datas = [datetime.strptime(parte, FORMATO_DATA).date() for parte in partes]
+            except ValueError:
+                datas = []
+            if len(datas) not in (1, 2):
+                messagebox.showwarning("Aviso", "Data inválida. Use dd/mm/aaaa ou dd/mm/aaaa a dd/mm/aaaa.")
+                return
+            if len(datas) == 2:
+                del filtros["dia"]
+                filtros["data_inicial"], filtros["data_final"] = datas
+        
+        self.filtros = filtros
+        self.carregar_reservas()
     
     def cancelar_reserva(self):
         selecao = self.treeview.selection()
@@ -582,19 +4239,179 @@ class JanelaPesquisa:
         lugar = item["values"][0]
         dia = item["values"][3]
         horario = item["values"][4]
+        rota = str(item["values"][5])
         
         # Verifica se o horário é válido
         if horario == "N/A":
             messagebox.showwarning("Aviso", "Não é possível cancelar esta reserva: horário não disponível.")
             return
         
-        res = self.onibus.cancelar_reserva(lugar, dia, horario)
+        self.janela_principal.executor.executar(self.onibus.cancelar_reserva,
+                                                lugar, dia, horario, rota,
+                                                ao_concluir=self.cancelamento_concluido)
+    
+    def cancelar_filtradas(self):
+        # Cancela com uma única operação todas as reservas dos filtros
+        # aplicados, e não apenas as já carregadas na tabela
+        if not self.filtros:
+            messagebox.showwarning("Aviso", "Aplique ao menos um filtro para cancelar em lote.")
+            return
+        
+        if not messagebox.askyesno("Cancelar Reservas",
+                                   "Cancelar todas as reservas que atendem aos filtros?"):
+            return
+        
+        self.janela_principal.executor.executar(self.onibus.cancelar_reservas,
+                                                self.filtros, True,
+                                                ao_concluir=self.cancelamento_em_lote_concluido)
+    
+    def cancelamento_em_lote_concluido(self, quantidade):
+        self.cancelamento_concluido(f"{quantidade} reserva(s) cancelada(s).")
+    
+    def cancelamento_concluido(self, res):
         messagebox.showinfo("Info", res)
         
         # Atualiza a lista de reservas
-        self.carregar_reservas()
-        # Atualiza o mapa na janela principal
+        if self.janela.winfo_exists():
+            self.carregar_reservas()
+        # Atualiza o mapa e as cores do calendário na janela principal
         self.janela_principal.atualizar_mapa()
+        self.janela_principal.recarregar_calendario()
+
+
+# Define a função 'abrir_banco', que cria o acesso às reservas usado pela
+# interface: o serviço HTTP, quando SERVICO_RESERVAS informa o endereço, o
+# banco local, quando BANCO_LOCAL informa o caminho do arquivo, ou o
+# 'Onibus', que conecta ao MongoDB e cadastra a frota padrão se ela
+# ainda não existir. As rotas e seus horários, exibidos assim que a janela
+# principal é criada, já são lidos aqui. Com o servidor (MongoDB ou
+# serviço), as operações passam pelo diário local ('OnibusSincronizado').
+# Cada operação é medida por 'OnibusMedido' quando as métricas estão
+# habilitadas.
+def abrir_banco():
+    if os.getenv('BANCO_LOCAL'):
+        onibus = OnibusLocal(os.getenv('BANCO_LOCAL'))
+        onibus.listar_rotas()
+        return OnibusMedido(onibus)
+
+    if os.getenv('SERVICO_RESERVAS'):
+        onibus = ClienteServico(os.getenv('SERVICO_RESERVAS'))
+    else:
+        onibus = Onibus()
+    onibus.listar_rotas()
+
+    # O diário local mantém o guichê vendendo quando a conexão cai.
+    # DIARIO_RESERVAS vazio o desliga.
+    caminho_diario = os.getenv('DIARIO_RESERVAS', 'diario_reservas.db')
+    if caminho_diario:
+        onibus = OnibusSincronizado(onibus, caminho_diario)
+    return OnibusMedido(onibus)
+
+
+# Define a classe 'JanelaInicial', exibida enquanto o sistema se conecta ao
+# banco de dados. A conexão ('fabrica()', normalmente 'abrir_banco') é
+# feita pelo ExecutorBanco, fora da thread da interface, então a janela
+# aparece imediatamente e continua respondendo. Após cada falha, a próxima
+# tentativa é agendada conforme 'espera_conexao' e a situação é exibida na
+# janela; o botão "Tentar Agora" antecipa a tentativa. Ao conectar, a
+# janela dá lugar à JanelaPrincipal.
+class JanelaInicial:
+
+    def __init__(self, janela_sistema, fabrica):
+        self.janela_sistema = janela_sistema
+        self.fabrica = fabrica
+
+        # Executor das tentativas de conexão, usado depois pela JanelaPrincipal.
+        self.executor = ExecutorBanco(janela_sistema)
+
+        # Quantidade de tentativas que falharam e nova tentativa agendada.
+        self.falhas = 0
+        self.agendamento = None
+
+        # JanelaPrincipal criada após a conexão.
+        self.app = None
+
+        self.janela_sistema.title("Sistema de Reserva de Passagens")
+        self.janela_sistema.configure(bg="#f0f0f0")
+
+        self.frame = tk.Frame(self.janela_sistema,
+                              bg="white",
+                              relief="solid",
+                              borderwidth=1,
+                              padx=40,
+                              pady=30)
+        self.frame.pack(expand=True, padx=20, pady=20)
+
+        tk.Label(self.frame,
+                 text="Reserva de Passagens",
+                 font=("Segoe UI", 24, "bold"),
+                 bg="white",
+                 fg="#333333").pack(pady=(0, 20))
+
+        # Situação da conexão e motivo da última falha
+        self.status_label = tk.Label(self.frame,
+                                     text="",
+                                     font=("Segoe UI", 14),
+                                     bg="white",
+                                     fg="#333333")
+        self.status_label.pack(pady=5)
+
+        self.erro_label = tk.Label(self.frame,
+                                   text="",
+                                   font=("Segoe UI", 10),
+                                   bg="white",
+                                   fg="#777777",
+                                   wraplength=480,
+                                   justify="center")
+        self.erro_label.pack(pady=5)
+
+        self.botao_tentar = tk.Button(self.frame,
+                                      text="Tentar Agora",
+                                      font=("Segoe UI", 12),
+                                      state="disabled",
+                                      command=self.conectar)
+        self.botao_tentar.pack(pady=(20, 0))
+
+        self.conectar()
+
+    # Inicia uma tentativa de conexão, cancelando a que estava agendada.
+    def conectar(self):
+        if self.agendamento is not None:
+            self.janela_sistema.after_cancel(self.agendamento)
+            self.agendamento = None
+
+        self.botao_tentar.config(state="disabled")
+        if self.falhas:
+            self.status_label.config(
+                text=f"Conectando ao banco de dados (tentativa {self.falhas + 1})...")
+        else:
+            self.status_label.config(text="Conectando ao banco de dados...")
+
+        self.executor.executar(self.fabrica,
+                               ao_concluir=self.conectado,
+                               ao_falhar=self.falhou,
+                               chave="conexao")
+
+    def falhou(self, erro):
+        self.falhas += 1
+        self.erro_label.config(text=str(erro))
+        self.botao_tentar.config(state="normal")
+        self.aguardar(max(1, round(espera_conexao(self.falhas))))
+
+    # Mostra a contagem regressiva até a próxima tentativa.
+    def aguardar(self, segundos):
+        if segundos <= 0:
+            self.agendamento = None
+            self.conectar()
+            return
+
+        self.status_label.config(
+            text=f"Sem conexão com o banco de dados. Nova tentativa em {segundos} s.")
+        self.agendamento = self.janela_sistema.after(1000, self.aguardar, segundos - 1)
+
+    def conectado(self, onibus):
+        self.frame.destroy()
+        self.app = JanelaPrincipal(self.janela_sistema, onibus, self.executor)
 
 
 # Define a classe 'JanelaPrincipal' que gerencia a janela principal do
@@ -602,8 +4419,9 @@ class JanelaPesquisa:
 class JanelaPrincipal:
 
     # Método construtor que inicializa uma nova instância da JanelaPrincipal com a
-    # janela do sistema e uma instância do ônibus.
-    def __init__(self, janela_sistema, onibus):
+    # janela do sistema e uma instância do ônibus. 'executor' permite
+    # reaproveitar o ExecutorBanco já criado (pela JanelaInicial).
+    def __init__(self, janela_sistema, onibus, executor=None):
         # Armazena a referência da janela principal do sistema (tk.Tk())
         # passada como argumento.
         self.janela_sistema = janela_sistema
@@ -688,6 +4506,23 @@ class JanelaPrincipal:
                                 pady=10)
         frame_horario.pack(fill='x', pady=10)
         
+        # Adiciona label e combobox para seleção da rota
+        tk.Label(frame_esquerda,
+                text="Selecione a rota:",
+                font=("Segoe UI", 14),
+                bg="white").pack(pady=10)
+
+        self.rota_var = tk.StringVar(value=ROTA_PADRAO)
+        self.rota_combo = ttk.Combobox(frame_esquerda,
+                                      textvariable=self.rota_var,
+                                      values=onibus.listar_rotas(),
+                                      font=("Segoe UI", 12),
+                                      state="readonly")
+        self.rota_combo.pack(pady=10)
+
+        # Ao trocar a rota, mostra os horários da nova rota e atualiza o mapa
+        self.rota_combo.bind('<<ComboboxSelected>>', lambda e: self.trocar_rota())
+        
         # Adiciona label para horário
         tk.Label(frame_esquerda,
                 text="Selecione o horário:",
@@ -698,7 +4533,7 @@ class JanelaPrincipal:
         self.horario_var = tk.StringVar()
         self.horario_combo = ttk.Combobox(frame_esquerda,
                                          textvariable=self.horario_var,
-                                         values=onibus.horarios,
+                                         values=onibus.horarios_rota(ROTA_PADRAO),
                                          font=("Segoe UI", 12),
                                          state="readonly")
         self.horario_combo.pack(pady=10)
@@ -712,10 +4547,29 @@ class JanelaPrincipal:
         # Adiciona evento para quando o combobox receber foco
         def on_focus_in(event):
             if self.horario_var.get() == "Selecione o horário":
-                self.horario_combo.set(onibus.horarios[0])
+                self.horario_combo.set(self.horario_combo['values'][0])
 
         self.horario_combo.bind('<FocusIn>', on_focus_in)
         
+        # Label com os lugares livres em cada horário da data e rota
+        # selecionadas, lidos dos resumos das viagens
+        self.disponibilidade_label = tk.Label(frame_esquerda,
+                                              text="",
+                                              font=("Segoe UI", 11),
+                                              bg="white",
+                                              fg="#555555",
+                                              justify="left")
+        self.disponibilidade_label.pack(pady=5)
+        
+        # Ao escolher outra data, mostra a disponibilidade dos seus horários
+        self.cal.bind('<<CalendarSelected>>', lambda e: self.atualizar_disponibilidade())
+        
+        # Cores dos dias do calendário conforme a ocupação, e o mês exibido
+        # é pintado sempre que o usuário navega para outro mês
+        for _, etiqueta, cor in NIVEIS_CALENDARIO + [(None, *CALENDARIO_LOTADO)]:
+            self.cal.tag_config(etiqueta, background=cor, foreground="black")
+        self.cal.bind('<<CalendarMonthChanged>>', lambda e: self.carregar_calendario())
+        
         # Frame para botões
         frame_botoes = tk.Frame(frame_esquerda, bg="white")
         frame_botoes.pack(fill='x', pady=20)
@@ -736,6 +4590,32 @@ class JanelaPrincipal:
                   style='Primary.TButton',
                   command=self.abrir_pesquisa).pack(fill='x', pady=5)
 
+        ttk.Button(frame_botoes,
+                  text="Importar Reservas (CSV)",
+                  style='Primary.TButton',
+                  command=self.importar_reservas).pack(fill='x', pady=5)
+
+        ttk.Button(frame_botoes,
+                  text="Cancelar Viagem",
+                  style='Warning.TButton',
+                  command=self.cancelar_viagem).pack(fill='x', pady=5)
+
+        # Situação do envio do diário local ao servidor e botão para
+        # resolver as reservas recusadas (exibido apenas quando há conflitos)
+        self.sincronizacao_label = tk.Label(frame_botoes,
+                                            text="",
+                                            font=("Segoe UI", 10),
+                                            bg="white",
+                                            fg="#c62828",
+                                            wraplength=260,
+                                            justify="left")
+        self.sincronizacao_label.pack(fill='x', pady=5)
+
+        self.botao_conflitos = ttk.Button(frame_botoes,
+                                          text="Resolver Conflitos",
+                                          style='Warning.TButton',
+                                          command=self.resolver_conflitos)
+
         # Cria um frame que será usado para conter o mapa de assentos
         # na parte direita da janela principal.
         # 'frame_principal' é o contêiner pai onde este novo frame será inserido.
@@ -887,12 +4767,53 @@ class JanelaPrincipal:
                   # padding vertical de 10 pixels para separação.
                   command=self.abrir_pesquisa).pack(pady=10)
 
+        # Botões dos assentos do mapa (criados por 'construir_mapa') e a cor
+        # atualmente exibida em cada um deles
+        self.botoes_lugares = []
+        self.cores_lugares = []
+
+        # Ocupação, viagem (data, horário, rota) e número de colunas do
+        # layout atualmente exibidos no mapa
+        self.lugares = MapaOcupacao(0)
+        self.viagem_exibida = (None, None, None)
+        self.colunas_mapa = None
+
+        # Lugares da viagem exibida em atendimento em outros guichês
+        self.bloqueados = MapaOcupacao(0)
+
+        # Executor que realiza as consultas ao banco fora da thread da interface
+        self.executor = executor or ExecutorBanco(self.janela_sistema)
+
+        # Janelas de pesquisa abertas, avisadas das alterações da viagem exibida
+        self.janelas_pesquisa = []
+
+        # Ocupação dos dias de cada mês já exibido no calendário:
+        # (rota, ano, mês) -> {dia: (reservados, capacidade)}
+        self.meses_calendario = {}
+
+        # Acompanha as reservas feitas por outros terminais na viagem exibida,
+        # atualizando o mapa sem precisar clicar em "Atualizar Mapa".
+        # Pode ser desligado com MAPA_AO_VIVO=0.
+        self.assinatura = None
+        if os.getenv('MAPA_AO_VIVO', '1') == '1':
+            self.assinatura = AssinaturaViagem(self.onibus, self.notificar_alteracoes)
+
         # Seleciona a data atual no calendário e atualiza o mapa de assentos
         hoje = datetime.now().strftime("%d/%m/%Y")
         self.cal.selection_set(hoje)
         
         # Agora que horario_var já foi criado, podemos chamar atualizar_mapa
         self.atualizar_mapa()
+        self.carregar_calendario()
+
+        if hasattr(self.onibus, "situacao_sincronizacao"):
+            self.acompanhar_sincronizacao()
+
+        # Ctrl+M habilita e desabilita a coleta de métricas de desempenho
+        self.janela_sistema.bind('<Control-m>', lambda e: self.alternar_metricas())
+
+        if hasattr(self.onibus, "lugares_bloqueados"):
+            self.acompanhar_bloqueios()
 
 
     """
@@ -900,6 +4821,9 @@ class JanelaPrincipal:
                 barra de rolagem e largura expandida.
         Este método é responsável por mostrar visualmente o estado atual dos 
                 assentos (livres ou reservados) com base na data selecionada no calendário.
+        Os botões dos assentos são criados apenas uma vez por layout (ver
+                'construir_mapa'); a cada atualização somente a cor dos
+                assentos que mudaram de estado é alterada.
         """
 
     def atualizar_mapa(self):
@@ -911,113 +4835,395 @@ class JanelaPrincipal:
         data = self.cal.get_date()
 
         horario = self.horario_var.get()
+        rota = self.rota_var.get()
+
+        # Indica que o mapa está sendo carregado. O mapa anterior continua
+        # visível até a resposta chegar.
+        self.mapa_label.configure(text="Carregando...")
+        self.atualizar_disponibilidade()
+
+        # Após obter a data, o veículo da viagem (capacidade e layout) e o
+        # método 'consultar_ocupacao' do objeto 'onibus' são consultados em
+        # uma thread do executor, com a data, o horário e a rota.
+        # 'consultar_ocupacao' retorna um MapaOcupacao, que informa se cada
+        # assento está reservado ou não.
+        # Se o usuário escolher outra data, horário ou rota antes da resposta,
+        # a resposta antiga é descartada (mesma chave "mapa").
+        # Ao trocar de viagem com o change stream, anota antes da leitura o
+        # instante a partir do qual a assinatura deve receber as alterações
+        # e lê a ocupação do banco, não do cache, para que nenhuma reserva
+        # feita entre a leitura e a abertura do fluxo se perca.
+        nova_viagem = self.viagem_exibida != (data, horario, rota)
+
+        def consultar():
+            inicio = None
+            if (nova_viagem and self.assinatura is not None
+                    and hasattr(self.onibus, "instante_alteracoes")):
+                try:
+                    inicio = self.onibus.instante_alteracoes()
+                except (PyMongoError, OSError):
+                    inicio = None
+                if inicio is not None:
+                    self.onibus.cache_ocupacao.invalidar(self.onibus.id_viagem(rota, data, horario))
+            return (self.onibus.veiculo_viagem(rota, horario),
+                    self.onibus.consultar_ocupacao(data, horario, rota),
+                    inicio)
+
+        self.executor.executar(consultar,
+                               ao_concluir=lambda resposta: self.exibir_ocupacao(data, horario, rota, *resposta),
+                               ao_falhar=self.falha_mapa,
+                               chave="mapa")
+
+
+    # Define o método 'atualizar_disponibilidade', que consulta, em uma
+    # thread do executor, quantos lugares estão livres em cada horário da
+    # data e rota selecionadas. Todos os horários são lidos dos resumos das
+    # viagens em uma única consulta.
+    def atualizar_disponibilidade(self):
+
+        data = self.cal.get_date()
+        rota = self.rota_var.get()
+
+        def consultar():
+            dia = datetime.strptime(data, FORMATO_DATA).date()
+            ocupacao = self.onibus.resumos_periodo(dia, dia, rota)
+            disponibilidade = []
+            for horario in self.onibus.horarios_rota(rota):
+                capacidade = self.onibus.capacidade_viagem(rota, horario)
+                mapa = ocupacao.get((data, horario))
+                livres = mapa.contar_livres() if mapa is not None else capacidade
+                disponibilidade.append((horario, livres, capacidade))
+            return disponibilidade
+
+        self.executor.executar(consultar,
+                               ao_concluir=lambda d: self.exibir_disponibilidade(data, rota, d),
+                               ao_falhar=lambda e: self.disponibilidade_label.configure(text=""),
+                               chave="disponibilidade")
+
+
+    # Define o método 'exibir_disponibilidade', que mostra os lugares
+    # livres de cada horário abaixo da seleção de horário. Aproveita a
+    # consulta para atualizar a cor do dia no calendário, sem recarregar
+    # o mês inteiro.
+    @medir_operacao("interface.disponibilidade")
+    def exibir_disponibilidade(self, data, rota, disponibilidade):
+        linhas = []
+        for horario, livres, capacidade in disponibilidade:
+            if livres:
+                linhas.append(f"{horario}: {livres} de {capacidade} livres")
+            else:
+                linhas.append(f"{horario}: lotado")
+        self.disponibilidade_label.configure(text="\n".join(linhas))
+
+        dia = datetime.strptime(data, FORMATO_DATA).date()
+        ocupacao = self.meses_calendario.get((rota, dia.year, dia.month))
+        if ocupacao is None:
+            return
+
+        capacidade = sum(c for _, _, c in disponibilidade)
+        reservados = capacidade - sum(livres for _, livres, _ in disponibilidade)
+        if reservados:
+            ocupacao[data] = (reservados, capacidade)
+        else:
+            ocupacao.pop(data, None)
+
+        if rota == self.rota_var.get():
+            self.pintar_dia(data, ocupacao.get(data))
+
+
+    # Define o método 'alternar_metricas', que habilita ou desabilita a
+    # coleta de métricas (veja 'MetricasOperacoes'). Ao desabilitar, grava
+    # as métricas coletadas até então no arquivo de métricas.
+    def alternar_metricas(self):
+        METRICAS.habilitar(not METRICAS.habilitado)
+        caminho = os.getenv('METRICAS_ARQUIVO', ARQUIVO_METRICAS)
+        if METRICAS.habilitado:
+            messagebox.showinfo("Métricas",
+                                f"Coleta de métricas habilitada. As métricas serão gravadas "
+                                f"em {caminho} a cada {INTERVALO_METRICAS} segundos.")
+            return
+
+        try:
+            METRICAS.gravar(caminho)
+            messagebox.showinfo("Métricas", f"Coleta de métricas desabilitada. "
+                                            f"Métricas gravadas em {caminho}.")
+        except OSError as e:
+            messagebox.showerror("Métricas", f"Não foi possível gravar as métricas: {e}")
+
+    # Define o método 'acompanhar_sincronizacao', que consulta a situação
+    # do diário local a cada INTERVALO_SINCRONIZACAO segundos.
+    def acompanhar_sincronizacao(self):
+        self.consultar_sincronizacao()
+        self.janela_sistema.after(INTERVALO_SINCRONIZACAO * 1000, self.acompanhar_sincronizacao)
+
+    def consultar_sincronizacao(self):
+        self.executor.executar(self.onibus.situacao_sincronizacao,
+                               ao_concluir=self.exibir_sincronizacao,
+                               ao_falhar=lambda e: None,
+                               chave="sincronizacao")
+
+    # Mostra se o guichê está sem conexão, quantas operações aguardam envio
+    # e quantas reservas foram recusadas pelo servidor.
+    def exibir_sincronizacao(self, situacao):
+        linhas = []
+        if not situacao["conectado"]:
+            linhas.append("Sem conexão com o servidor.")
+        if situacao["pendentes"]:
+            linhas.append(f"{situacao['pendentes']} operação(ões) aguardando envio.")
+        if situacao["conflitos"]:
+            linhas.append(f"{situacao['conflitos']} reserva(s) recusada(s) pelo servidor.")
+            self.botao_conflitos.pack(fill='x', pady=5)
+        else:
+            self.botao_conflitos.pack_forget()
+        self.sincronizacao_label.configure(text="\n".join(linhas))
+
+    # Define o método 'acompanhar_bloqueios', que consulta a cada
+    # INTERVALO_BLOQUEIOS segundos os lugares da viagem exibida em
+    # atendimento em outros guichês.
+    def acompanhar_bloqueios(self):
+        self.consultar_bloqueios()
+        self.janela_sistema.after(INTERVALO_BLOQUEIOS * 1000, self.acompanhar_bloqueios)
+
+    def consultar_bloqueios(self):
+        viagem = self.viagem_exibida
+        if viagem[0] is None:
+            return
+        self.executor.executar(self.onibus.lugares_bloqueados, *viagem,
+                               ao_concluir=lambda lugares: self.exibir_bloqueios(viagem, lugares),
+                               ao_falhar=lambda e: None,
+                               chave="bloqueios")
+
+    # Colore os lugares em atendimento, se a viagem ainda é a exibida.
+    def exibir_bloqueios(self, viagem, lugares):
+        if viagem != self.viagem_exibida:
+            return
+        self.bloqueados = MapaOcupacao.de_lugares(len(self.lugares), lugares)
+        for i in range(len(self.botoes_lugares)):
+            self.colorir_lugar(i)
+
+    # Define o método 'resolver_conflitos', que mostra as reservas e os
+    # cancelamentos feitos sem conexão e recusados pelo servidor (o lugar
+    # foi vendido por outro guichê) e, após o atendente resolvê-los, os
+    # descarta.
+    def resolver_conflitos(self):
+        self.executor.executar(self.onibus.conflitos,
+                               ao_concluir=self.exibir_conflitos,
+                               chave="conflitos")
+
+    def exibir_conflitos(self, conflitos):
+        if not conflitos:
+            self.consultar_sincronizacao()
+            return
+
+        linhas = [f"{c['operacao'].capitalize()} do lugar {c['lugar']} - {c['dia']} "
+                  f"{c['horario']} ({c['rota']}): "
+                  f"{c['nome'] or 'passageiro desconhecido'}, CPF {c['cpf'] or '-'}"
+                  f"\n    {c['mensagem']}"
+                  for c in conflitos]
+        if messagebox.askyesno("Operações Recusadas",
+                               "\n".join(linhas)
+                               + "\n\nEstas operações não foram gravadas no servidor. "
+                                 "Após resolvê-las no guichê, deseja descartá-las?"):
+            self.executor.executar(self.onibus.descartar_conflitos,
+                                   ao_concluir=lambda quantidade: self.consultar_sincronizacao())
+
+
+    # Define o método 'carregar_calendario', que pinta os dias do mês
+    # exibido no calendário conforme a ocupação. Cada mês é consultado no
+    # banco apenas uma vez (por rota); depois é atualizado dia a dia por
+    # 'exibir_disponibilidade'.
+    def carregar_calendario(self):
+        mes, ano = self.cal.get_displayed_month()
+        rota = self.rota_var.get()
+        chave = (rota, ano, mes)
+
+        if chave in self.meses_calendario:
+            self.pintar_mes(chave)
+            return
 
-        # Após obter a data, o método 'carregar_reservas' do objeto 'onibus' é
-        # chamado com essa data como argumento.
-        # Este método é responsável por carregar o estado atual dos assentos (se
-        # estão reservados ou não) para a data especificada,
-        # atualizando o atributo 'lugares' do objeto 'onibus' que é uma lista onde
-        # cada posição representa um assento e o valor
-        # indica se o assento está reservado (1) ou não (0).
-        self.onibus.carregar_reservas(data, horario)
+        self.executor.executar(self.onibus.ocupacao_mes, ano, mes, rota,
+                               ao_concluir=lambda ocupacao: self.mes_carregado(chave, ocupacao),
+                               ao_falhar=lambda e: None,
+                               chave="calendario")
 
-        # A seguir, todos os widgets existentes no 'canvas_frame' são removidos.
+
+    # Guarda a ocupação do mês consultado e o pinta, se ainda for o mês exibido.
+    def mes_carregado(self, chave, ocupacao):
+        self.meses_calendario[chave] = ocupacao
+        mes, ano = self.cal.get_displayed_month()
+        if chave == (self.rota_var.get(), ano, mes):
+            self.pintar_mes(chave)
+
+
+    # Descarta a ocupação de todos os meses e recarrega o mês exibido. Usado
+    # após operações que podem alterar muitos dias, como a importação.
+    def recarregar_calendario(self):
+        self.meses_calendario.clear()
+        self.carregar_calendario()
+
+
+    # Define o método 'pintar_mes', que substitui as cores do calendário
+    # pelas do mês guardado em 'chave'.
+    @medir_operacao("interface.calendario")
+    def pintar_mes(self, chave):
+        self.cal.calevent_remove('all')
+        for data, ocupacao in self.meses_calendario[chave].items():
+            self.pintar_dia(data, ocupacao)
+
+
+    # Define o método 'pintar_dia', que colore um dia do calendário conforme
+    # a fração dos lugares reservados, ou remove a cor quando
+    # 'ocupacao' é None.
+    def pintar_dia(self, data, ocupacao):
+        dia = datetime.strptime(data, FORMATO_DATA).date()
+        self.cal.calevent_remove(date=dia)
+        if not ocupacao:
+            return
+
+        reservados, capacidade = ocupacao
+        etiqueta = CALENDARIO_LOTADO[0]
+        for limite, nivel, _ in NIVEIS_CALENDARIO:
+            if reservados < capacidade and reservados / capacidade < limite:
+                etiqueta = nivel
+                break
+
+        self.cal.calevent_create(dia, f"{reservados} de {capacidade} lugares reservados", etiqueta)
+
+
+    # Define o método 'trocar_rota', chamado quando outra rota é escolhida.
+    # Mostra os horários da nova rota e atualiza o mapa.
+    def trocar_rota(self):
+        horarios = self.onibus.horarios_rota(self.rota_var.get())
+        self.horario_combo.configure(values=horarios)
+
+        if self.horario_var.get() not in horarios:
+            self.horario_combo.set("Selecione o horário")
+
+        self.atualizar_mapa()
+        self.carregar_calendario()
+
+
+    # Define o método 'exibir_ocupacao', chamado na thread da interface
+    # quando a ocupação de uma viagem foi carregada.
+    @medir_operacao("interface.exibir_ocupacao")
+    def exibir_ocupacao(self, data, horario, rota, veiculo, lugares, inicio=None):
+
+        # Passa a acompanhar as reservas feitas por outros terminais na
+        # nova viagem exibida, a partir do instante em que ela foi lida.
+        trocou = self.viagem_exibida != (data, horario, rota)
+        if self.assinatura is not None and trocou:
+            self.assinatura.trocar_viagem(data, horario, rota, inicio)
+
+        # Os lugares em atendimento da viagem anterior não valem para a nova.
+        if trocou:
+            self.bloqueados = MapaOcupacao(len(lugares))
+
+        # Guarda a viagem exibida, usada quando um assento é clicado.
+        self.viagem_exibida = (data, horario, rota)
+        self.lugares = lugares
+        self.mapa_label.configure(text=f"Mapa de Assentos - {veiculo.get('descricao', veiculo['_id'])}")
+
+        # Recria os botões apenas se o layout (capacidade e colunas) mudou.
+        colunas = veiculo.get("colunas", 2)
+        if (len(self.botoes_lugares), self.colunas_mapa) != (len(lugares), colunas):
+            self.construir_mapa(colunas)
+
+        # Percorre os assentos atualizando somente os botões cuja cor mudou.
+        for i in range(len(self.botoes_lugares)):
+            self.colorir_lugar(i)
+
+        if trocou and hasattr(self.onibus, "lugares_bloqueados"):
+            self.consultar_bloqueios()
+
+
+    # Define o método 'colorir_lugar', que ajusta a cor do botão de um
+    # assento ao seu estado, apenas se ela mudou.
+    def colorir_lugar(self, i):
+
+        # Define a cor do botão baseado no status do assento: amarelo (#ffd700) se
+        # reservado, azul (#87cefa) se em atendimento em outro guichê, verde
+        # (#98fb98) se livre.
+        if self.lugares.ocupado(i + 1):
+            cor = "#ffd700"
+        elif self.bloqueados.ocupado(i + 1):
+            cor = "#87cefa"
+        else:
+            cor = "#98fb98"
+
+        if self.cores_lugares[i] != cor:
+            self.botoes_lugares[i].configure(bg=cor)
+            self.cores_lugares[i] = cor
+
+
+    # Define o método 'notificar_alteracoes', chamado pela assinatura (em
+    # outra thread) quando a viagem exibida é alterada por outro terminal.
+    def notificar_alteracoes(self, viagem, alteracoes):
+        self.executor.notificar(self.aplicar_alteracoes, (viagem, alteracoes))
+
+
+    # Define o método 'aplicar_alteracoes', que atualiza, na thread da
+    # interface, os assentos alterados por outros terminais no mapa e nas
+    # janelas de pesquisa abertas.
+    def aplicar_alteracoes(self, alteracao):
+        viagem, alteracoes = alteracao
+
+        # Repassa a alteração às janelas de pesquisa que ainda estão abertas.
+        self.janelas_pesquisa = [j for j in self.janelas_pesquisa if j.janela.winfo_exists()]
+        for janela in self.janelas_pesquisa:
+            janela.reservas_alteradas(viagem, alteracoes)
+
+        # Ignora alterações de uma viagem que já não está no mapa.
+        if viagem != self.viagem_exibida:
+            return
+
+        self.atualizar_disponibilidade()
+
+        # Sem saber quais lugares mudaram, recarrega a viagem inteira.
+        if alteracoes is None:
+            self.atualizar_mapa()
+            return
+
+        for lugar, ocupado in alteracoes:
+            if 1 <= lugar <= len(self.lugares):
+                if ocupado:
+                    self.lugares.ocupar(lugar)
+                else:
+                    self.lugares.liberar(lugar)
+                self.colorir_lugar(lugar - 1)
+
+
+    def falha_mapa(self, erro):
+        self.mapa_label.configure(text="Mapa de Assentos")
+        messagebox.showerror("Erro", f"Falha ao carregar o mapa de assentos: {erro}")
+
+
+    # Define o método 'construir_mapa', que cria os botões dos assentos de
+    # acordo com a capacidade e o número de colunas do veículo. Só é chamado
+    # quando o layout muda.
+    @medir_operacao("interface.construir_mapa")
+    def construir_mapa(self, colunas=2):
+
+        # Todos os widgets existentes no 'canvas_frame' são removidos.
         # 'canvas_frame' é um contêiner (frame) dentro de um objeto 'Canvas' que
         # contém botões representando os assentos do ônibus.
-        # O método 'winfo_children()' retorna uma lista de todos os widgets filhos (neste
-        # caso, botões de assento) contidos dentro de 'canvas_frame'.
         for widget in self.canvas_frame.winfo_children():
-
-            # Cada widget (botão de assento) é destruído iterativamente.
-            # O método 'destroy()' é usado para remover completamente um widget da
-            # interface gráfica e liberar todos os recursos de sistema relacionados.
             widget.destroy()
 
-        # Adiciona os botões no layout de duas colunas
-        for i in range(self.onibus.capacidade):
-
-            # Verifica se o assento atual (índice i) está reservado. A lista 'lugares'
-            # contém 1 para reservado e 0 para livre.
-            reservado = self.onibus.lugares[i] == 1
-
-            # Define a cor do botão baseado no status do assento: amarelo (#ffd700) se
-            # reservado, verde (#98fb98) se livre.
-            cor = "#ffd700" if reservado else "#98fb98"
-
-            # A função 'manipular_click' captura o valor atual de 'i' na variável 'indice'.
-            def manipular_click(indice=i):
-
-                # Verifica se o assento no índice especificado está reservado.
-                if self.onibus.lugares[indice] == 1:
-
-                    # Consulta no banco de dados MongoDB para encontrar uma reserva específica.
-                    # Usa 'find_one' para buscar um único documento que corresponde aos
-                    # critérios: número do lugar ('lugar') e data ('dia').
-                    # 'indice + 1' ajusta o índice base-0 para base-1, já que os
-                    # lugares no banco de dados começam em 1, não em 0.
-                    reserva = self.onibus.colecao_reservas.find_one({
-                        "lugar": indice + 1,
-                        "dia": data,
-                        "horario": horario
-                    })
-
-                    # Verifica se algum documento foi encontrado com os critérios especificados.
-                    # Se 'reserva' não é None, significa que uma reserva foi encontrada
-                    # para o assento e a data especificados.
-                    if reserva:
-
-                        # Constrói uma string que contém as informações da reserva encontrada.
-                        # Esta string inclui o número do lugar, o nome da pessoa que fez a
-                        # reserva, o CPF e a data da reserva.
-                        # Os dados são acessados diretamente do documento retornado do banco de dados.
-                        info_reserva = (
-                            f"Lugar: {reserva['lugar']}\n"
-                            f"Nome: {reserva['nome']}\n"
-                            f"CPF: {reserva['cpf']}\n"
-                            f"Data: {reserva['dia']}\n"
-                            f"Horário: {reserva['horario']}"
-                        )
-
-                        # Abre uma caixa de diálogo perguntando ao usuário se deseja
-                        # cancelar a reserva encontrada.
-                        # 'askyesno' cria uma janela de mensagem com botões 'Sim' e 'Não'.
-                        # O texto exibido inclui as informações da reserva e pergunta se o
-                        # usuário deseja cancelar essa reserva.
-                        confirmar = messagebox.askyesno("Reserva Encontrada",
-                                                        f"{info_reserva}\n\nDeseja cancelar esta reserva?")
-
-                        # Verifica se o usuário clicou no botão 'Sim' na caixa de diálogo.
-                        if confirmar:
-
-                            # Chama o método 'cancelar_reserva' do objeto 'onibus' para
-                            # cancelar a reserva no banco de dados.
-                            # Passa o índice do lugar (ajustado para base-1) e a data como
-                            # argumentos para identificar a reserva a ser cancelada.
-                            resultado = self.onibus.cancelar_reserva(indice + 1, data, horario)
-
-                            # Exibe uma mensagem informando o resultado do processo de cancelamento.
-                            # 'showinfo' cria uma janela de mensagem que mostra o texto do
-                            # resultado, que geralmente confirma o cancelamento.
-                            messagebox.showinfo("Reserva Cancelada", resultado)
-
-                            # Atualiza o mapa de assentos para refletir a mudança no estado
-                            # dos assentos após o cancelamento.
-                            # Isso garante que o mapa gráfico dos assentos mostre o assento
-                            # como disponível se o cancelamento foi bem-sucedido.
-                            self.atualizar_mapa()
-
+        self.botoes_lugares = []
+        self.cores_lugares = []
 
-                else:
+        # Desfaz a configuração das colunas do layout anterior.
+        for coluna in range(self.colunas_mapa or 0):
+            self.canvas_frame.grid_columnconfigure(coluna, weight=0)
+        self.colunas_mapa = colunas
 
-                    # Se o lugar está disponível, abre a janela de cadastro para fazer uma nova reserva.
-                    JanelaCadastro(self.janela_sistema, self.onibus, self, data, lugar=indice + 1)
+        # Adiciona os botões no layout com o número de colunas do veículo
+        for i in range(len(self.lugares)):
 
             # Cria um botão para cada assento. O botão é configurado
-            # com o texto do número do lugar,
-            # a cor determinada pelo status do assento (reservado ou livre), e uma
-            # ação associada ao clique que executa a função 'manipular_click'.
-            # Esta função manipula o comportamento do botão dependendo do
-            # estado do assento (reservado ou não).
+            # com o texto do número do lugar e uma ação associada ao clique.
+            # A cor é definida depois, por 'atualizar_mapa', conforme o
+            # estado do assento.
             botao = tk.Button(
 
                 # Especifica o frame dentro do canvas onde o botão será adicionado.
@@ -1027,13 +5233,9 @@ class JanelaPrincipal:
                 # incrementando i por 1 para corresponder à contagem humana.
                 text=f"Lugar {i + 1}",
 
-                # Define a cor de fundo do botão baseado na variável 'cor', que é
-                # amarela para assentos reservados e verde para livres.
-                bg=cor,
-
-                # Associa o botão à função 'manipular_click', que será chamada
-                # quando o botão for clicado.
-                command=manipular_click,
+                # Associa o botão ao método 'clicar_lugar', que será chamado
+                # com o índice do assento quando o botão for clicado.
+                command=lambda indice=i: self.clicar_lugar(indice),
 
                 # Define a fonte do texto do botão como Arial, tamanho 14, em negrito.
                 font=("Arial", 14, "bold"),
@@ -1041,70 +5243,146 @@ class JanelaPrincipal:
                 # Define a altura do botão como 1, adequado para a visualização do texto.
                 height=1,
 
-                # Define a largura do botão como 30, suficiente para exibir o
-                # texto do lugar confortavelmente.
-                width=30
+                # Define a largura do botão como 30 no layout de duas colunas,
+                # diminuindo nos veículos com mais colunas.
+                width=60 // max(colunas, 2)
 
             )
 
-            # Organiza os botões em um grid de duas colunas dentro do frame especificado.
-            # Isso permite uma apresentação organizada dos lugares em pares.
-            # A organização em grid é escolhida para simular a disposição física dos
-            # assentos em um ônibus, facilitando a visualização pelo usuário.
-            # Calcula a linha para o botão baseado no índice do assento.
-            # A divisão inteira por 2 agrupa os lugares em pares.
-            row = i // 2
-
-            # Calcula a coluna (0 ou 1) para alternar os botões entre esquerda e
-            # direita, mantendo a simetria do layout de assentos.
-            column = i % 2
-
-            # Posiciona o botão criado anteriormente dentro do grid layout do 'canvas_frame'.
-            # 'row=row' define em qual linha do grid o botão será colocado. O valor de 'row' é
-            # calculado com base no índice do assento,
-            # permitindo uma distribuição equilibrada dos botões em várias linhas,
-            # dependendo do número total de assentos.
-            # 'column=column' define em qual coluna do grid o botão será colocado.
-            # O valor de 'column' alterna entre 0 e 1,
-            # permitindo que os botões sejam organizados em duas colunas, o que ajuda a
-            # simular a disposição física dos assentos em um ônibus.
-            # 'padx=10' e 'pady=5' adicionam um espaçamento externo de 10 pixels na
-            # horizontal e 5 pixels na vertical entre o botão e outros elementos do grid.
-            # Isso ajuda a evitar que os botões fiquem visualmente amontoados e
-            # melhora a estética geral da interface.
-            # 'sticky="nsew"' é uma opção de configuração que faz o botão expandir
-            # para preencher todo o espaço disponível na célula do grid.
-            # As letras 'n', 's', 'e', 'w' representam norte, sul, leste e oeste,
-            # respectivamente, indicando que o botão deve se expandir
-            # em todas as direções para ocupar completamente sua célula no
-            # grid, assegurando que o layout seja responsivo e visualmente coerente.
-            botao.grid(row=row,
-                       column=column,
+            # Organiza os botões em um grid com o número de colunas do veículo.
+            # A divisão inteira pelo número de colunas agrupa os lugares em
+            # fileiras (linha) e o resto indica a coluna, simulando a
+            # disposição física dos assentos no veículo.
+            # 'sticky="nsew"' faz o botão expandir para preencher toda a célula do grid.
+            botao.grid(row=i // colunas,
+                       column=i % colunas,
                        padx=10,
                        pady=5,
                        sticky="nsew")  # Expande na horizontal
 
-            # Configura as propriedades de expansão das colunas dentro do frame 'canvas_frame'.
-            # Isso é necessário para garantir que ambos os lados do grid (esquerda e
-            # direita) expandam uniformemente ao redimensionar a janela.
-            self.canvas_frame.grid_columnconfigure(0, weight=1)  # Atribui um 'peso' de 1 à coluna da esquerda.
-            self.canvas_frame.grid_columnconfigure(1, weight=1)  # Atribui um 'peso' de 1 à coluna da direita.
+            self.botoes_lugares.append(botao)
+            self.cores_lugares.append(None)
+
+        # Configura as propriedades de expansão das colunas dentro do frame 'canvas_frame'.
+        # Isso é necessário para garantir que todas as colunas do grid
+        # expandam uniformemente ao redimensionar a janela.
+        for coluna in range(colunas):
+            self.canvas_frame.grid_columnconfigure(coluna, weight=1)
+
+        # Atualiza as tarefas pendentes de layout do Canvas uma única vez,
+        # depois que todos os botões foram posicionados.
+        self.canvas.update_idletasks()
+
+        # Configura a região de rolagem do Canvas para englobar toda a
+        # área onde os botões são desenhados.
+        # 'self.canvas.bbox("all")' calcula a caixa de delimitação que
+        # contém todos os elementos no Canvas,
+        # garantindo que a barra de rolagem permita visualizar todos os
+        # elementos ao mover-se verticalmente.
+        self.canvas.config(scrollregion=self.canvas.bbox("all"))
+
+
+    # Define o método 'clicar_lugar', chamado quando um assento do mapa é
+    # clicado. Usa a data e o horário do mapa exibido, pois os botões são
+    # reaproveitados entre datas e horários diferentes.
+    def clicar_lugar(self, indice):
+
+        data, horario, rota = self.viagem_exibida
+
+        # Verifica se o assento no índice especificado está reservado.
+        if self.lugares.ocupado(indice + 1):
+
+            # Consulta no banco de dados MongoDB, em uma thread do executor, a
+            # reserva do lugar ('indice + 1' ajusta o índice base-0 para base-1,
+            # já que os lugares no banco de dados começam em 1, não em 0).
+            self.executor.executar(self.onibus.buscar_reserva, indice + 1, data, horario, rota,
+                                   ao_concluir=self.exibir_reserva,
+                                   chave="reserva")
+
+        elif self.bloqueados.ocupado(indice + 1):
+
+            # Outro guichê está digitando os dados de um passageiro para este lugar.
+            messagebox.showinfo("Lugar em Atendimento",
+                                f"O lugar {indice + 1} está em atendimento em outro guichê.")
 
-            # Estas configurações asseguram que ambas as colunas tenham a mesma capacidade de
-            # expansão e que o layout responda bem a mudanças no tamanho da janela.
+        elif hasattr(self.onibus, "bloquear_lugar"):
 
-            # Atualiza as tarefas pendentes de layout do Canvas.
-            # Isso é importante para garantir que todos os elementos gráficos sejam
-            # corretamente dimensionados e posicionados antes de realizar mais configurações.
-            self.canvas.update_idletasks()
+            # Bloqueia o lugar antes de abrir a janela de cadastro, para que
+            # nenhum outro guichê o venda enquanto os dados são digitados.
+            self.executor.executar(self.onibus.bloquear_lugar, indice + 1, data, horario, rota,
+                                   ao_concluir=lambda bloqueado: self.lugar_bloqueado(
+                                       bloqueado, indice + 1, data, horario, rota),
+                                   chave="bloqueio")
+
+        else:
+
+            # Se o lugar está disponível, abre a janela de cadastro para fazer uma nova reserva.
+            JanelaCadastro(self.janela_sistema, self.onibus, self, data, lugar=indice + 1,
+                           rota=rota, horario=horario)
+
+
+    # Define o método 'lugar_bloqueado', chamado quando o bloqueio de um
+    # lugar clicado termina: abre a janela de cadastro com o lugar
+    # bloqueado ou avisa que ele acabou de ser reservado ou bloqueado
+    # por outro guichê.
+    def lugar_bloqueado(self, bloqueado, lugar, data, horario, rota):
+
+        if not bloqueado:
+            messagebox.showinfo("Lugar Indisponível",
+                                f"O lugar {lugar} acabou de ser reservado ou está em "
+                                f"atendimento em outro guichê.")
+            self.atualizar_mapa()
+            self.consultar_bloqueios()
+            return
+
+        JanelaCadastro(self.janela_sistema, self.onibus, self, data, lugar=lugar,
+                       rota=rota, horario=horario, bloqueado=True)
+
+
+    # Define o método 'exibir_reserva', que mostra os dados da reserva de um
+    # assento clicado e pergunta se ela deve ser cancelada.
+    def exibir_reserva(self, reserva):
+
+        # Se 'reserva' é None, o lugar foi liberado por outro guichê depois
+        # que o mapa foi carregado.
+        if not reserva:
+            self.atualizar_mapa()
+            return
 
-            # Configura a região de rolagem do Canvas para englobar toda a
-            # área onde os botões são desenhados.
-            # 'self.canvas.bbox("all")' calcula a caixa de delimitação que
-            # contém todos os elementos no Canvas,
-            # garantindo que a barra de rolagem permita visualizar todos os
-            # elementos ao mover-se verticalmente.
-            self.canvas.config(scrollregion=self.canvas.bbox("all"))
+        # Constrói uma string que contém as informações da reserva encontrada.
+        # Esta string inclui o número do lugar, o nome da pessoa que fez a
+        # reserva, o CPF e a data da reserva.
+        info_reserva = (
+            f"Lugar: {reserva['lugar']}\n"
+            f"Nome: {reserva['nome']}\n"
+            f"CPF: {reserva['cpf']}\n"
+            f"Data: {reserva['dia']}\n"
+            f"Horário: {reserva['horario']}\n"
+            f"Rota: {reserva.get('rota', ROTA_PADRAO)}"
+        )
+
+        # Abre uma caixa de diálogo perguntando ao usuário se deseja
+        # cancelar a reserva encontrada.
+        # 'askyesno' cria uma janela de mensagem com botões 'Sim' e 'Não'.
+        confirmar = messagebox.askyesno("Reserva Encontrada",
+                                        f"{info_reserva}\n\nDeseja cancelar esta reserva?")
+
+        # Verifica se o usuário clicou no botão 'Sim' na caixa de diálogo.
+        if confirmar:
+
+            # Chama o método 'cancelar_reserva' do objeto 'onibus' para
+            # cancelar a reserva no banco de dados.
+            self.executor.executar(self.onibus.cancelar_reserva,
+                                   reserva["lugar"], reserva["dia"], reserva["horario"],
+                                   reserva.get("rota", ROTA_PADRAO),
+                                   ao_concluir=self.cancelamento_concluido)
+
+
+    # Exibe o resultado do cancelamento e atualiza o mapa de assentos para
+    # mostrar o assento como disponível.
+    def cancelamento_concluido(self, resultado):
+        messagebox.showinfo("Reserva Cancelada", resultado)
+        self.atualizar_mapa()
 
 
     # Define o método 'abrir_cadastro' usado para abrir uma janela de
@@ -1128,7 +5406,8 @@ class JanelaPrincipal:
         JanelaCadastro(self.janela_sistema,
                        self.onibus,
                        self,
-                       data_selecionada)
+                       data_selecionada,
+                       rota=self.rota_var.get())
 
     # Define o método 'abrir_pesquisa' usado para abrir uma janela de
     # pesquisa de reservas históricas.
@@ -1136,29 +5415,113 @@ class JanelaPrincipal:
         """
         Abre a janela de pesquisa de reservas.
         """
-        # Cria uma nova instância da janela de pesquisa
-        JanelaPesquisa(self.janela_sistema, self.onibus, self)
-
-
-# 'tk.Tk()' inicializa a janela principal da interface gráfica.
-# Cria a janela principal da aplicação usando Tkinter.
-janela_sistema = tk.Tk()
-
-# Cria uma instância da classe 'Onibus', que gerencia os dados
-        # relacionados ao ônibus e suas reservas.
-# 'Onibus(20)' inicializa o objeto do ônibus com uma
-        # capacidade de 20 lugares.
-onibus = Onibus(20)
-
-# Cria a interface principal da aplicação, associando a janela do
-        # sistema e o objeto do ônibus.
-# 'JanelaPrincipal(janela_sistema, onibus)' cria a interface
-        # gráfica principal da aplicação.
-# Passa a janela Tk ('janela_sistema') para exibir a interface e o
-        # objeto 'onibus' para gerenciar as operações relacionadas às reservas.
-app = JanelaPrincipal(janela_sistema, onibus)
-
-# Inicia o loop principal da interface gráfica.
-# 'mainloop()' é um método Tkinter que entra em um loop
-        # contínuo para processar eventos.
-janela_sistema.mainloop()
\ No newline at end of file
+        # Cria uma nova instância da janela de pesquisa, que também recebe
+        # as alterações feitas por outros terminais
+        self.janelas_pesquisa.append(JanelaPesquisa(self.janela_sistema, self.onibus, self))
+
+
+    # Define o método 'importar_reservas', que reserva em lote os lugares
+    # listados em um arquivo CSV (colunas lugar, nome, cpf, dia, horario).
+    def importar_reservas(self):
+
+        caminho = filedialog.askopenfilename(title="Importar Reservas",
+                                             filetypes=[("Arquivos CSV", "*.csv")])
+        if not caminho:
+            return
+
+        # Pergunta se o grupo deve ser reservado por inteiro ou não ser reservado.
+        tudo_ou_nada = messagebox.askyesno("Importar Reservas",
+                                           "Reservar apenas se todos os lugares estiverem disponíveis?")
+
+        self.executor.executar(self.onibus.importar_csv, caminho, tudo_ou_nada,
+                               ao_concluir=self.importacao_concluida,
+                               ao_falhar=lambda e: messagebox.showerror("Erro", f"Falha ao importar: {e}"))
+
+
+    # Exibe um resumo da importação, com as primeiras falhas.
+    def importacao_concluida(self, resultados):
+
+        falhas = [mensagem for reservado, mensagem in resultados if not reservado]
+        resumo = f"{len(resultados) - len(falhas)} de {len(resultados)} lugares reservados."
+        if falhas:
+            resumo += "\n\n" + "\n".join(falhas[:10])
+            if len(falhas) > 10:
+                resumo += f"\n... e mais {len(falhas) - 10}"
+
+        messagebox.showinfo("Importar Reservas", resumo)
+        self.atualizar_mapa()
+        self.recarregar_calendario()
+
+
+    # Define o método 'cancelar_viagem', que cancela todas as reservas da
+    # viagem exibida no mapa (por exemplo, quando a partida é cancelada),
+    # arquivando-as em 'reservas_canceladas'.
+    def cancelar_viagem(self):
+
+        data, horario, rota = self.viagem_exibida
+        if data is None:
+            return
+
+        if not messagebox.askyesno("Cancelar Viagem",
+                                   f"Cancelar todas as reservas da rota {rota} "
+                                   f"de {data} às {horario}?"):
+            return
+
+        self.executor.executar(self.onibus.cancelar_reservas,
+                               {"viagem": self.onibus.id_viagem(rota, data, horario)}, True,
+                               ao_concluir=self.cancelamento_em_lote_concluido)
+
+
+    # Informa quantas reservas foram canceladas em lote e atualiza o mapa.
+    def cancelamento_em_lote_concluido(self, quantidade):
+        messagebox.showinfo("Reservas Canceladas", f"{quantidade} reserva(s) cancelada(s).")
+        self.atualizar_mapa()
+
+
+# O programa só é iniciado quando executado diretamente, para que as
+# classes possam ser importadas por outras ferramentas sem abrir a janela.
+if __name__ == "__main__":
+
+    # 'python reserva_passagens.py --migrar-datas' apenas migra as datas das
+    # reservas antigas (veja 'Onibus.migrar_datas') e termina.
+    if "--migrar-datas" in sys.argv:
+        resumo = conectar_banco().migrar_datas()
+        print(f"Reservas migradas: {resumo['migradas']}; "
+              f"com data inválida: {resumo['invalidas']}; "
+              f"em conflito: {resumo['conflitos']}")
+        sys.exit()
+
+    # 'python reserva_passagens.py --migrar-campos' apenas preenche os
+    # campos que faltam nas reservas antigas (veja 'Onibus.migrar_campos')
+    # e termina.
+    if "--migrar-campos" in sys.argv:
+        resumo = conectar_banco().migrar_campos()
+        print("; ".join(f"Reservas migradas ({campo}): {quantidade}"
+                        for campo, quantidade in resumo.items()))
+        sys.exit()
+
+    # 'python reserva_passagens.py --reconciliar-resumos' reconstrói os
+    # resumos de todas as viagens a partir das reservas (veja
+    # 'Onibus.reconciliar_resumos') e termina.
+    if "--reconciliar-resumos" in sys.argv:
+        print(f"Resumos gravados: {conectar_banco().reconciliar_resumos()}")
+        sys.exit()
+
+    # 'tk.Tk()' inicializa a janela principal da interface gráfica.
+    # Cria a janela principal da aplicação usando Tkinter.
+    janela_sistema = tk.Tk()
+
+    # As métricas (habilitadas com METRICAS=1 ou Ctrl+M) são gravadas
+    # periodicamente no arquivo METRICAS_ARQUIVO.
+    METRICAS.gravar_periodicamente(os.getenv('METRICAS_ARQUIVO', ARQUIVO_METRICAS))
+
+    # A janela aparece imediatamente, enquanto a conexão com o banco (ou
+            # com o serviço, com SERVICO_RESERVAS) é feita em segundo plano
+            # por 'abrir_banco'. Conectado, a 'JanelaInicial' cria a
+            # 'JanelaPrincipal' com o objeto 'onibus' que gerencia as reservas.
+    app = JanelaInicial(janela_sistema, abrir_banco)
+
+    # Inicia o loop principal da interface gráfica.
+    # 'mainloop()' é um método Tkinter que entra em um loop
+            # contínuo para processar eventos.
+    janela_sistema.mainloop()
@@ -0,0 +1,419 @@
+# Serviço HTTP/JSON de reservas de passagens.
+#
+# Expõe as operações da classe 'Onibus' (disponibilidade, reserva,
+# cancelamento e pesquisa) para outros canais, como o site, e para a
+# interface Tkinter quando ela é iniciada com SERVICO_RESERVAS. Não abre
+# nenhuma janela, então pode rodar em servidores sem display.
+#
+# Cada processo mantém uma única conexão com o MongoDB (o MongoClient já
+# mantém um conjunto de conexões compartilhado pelas requisições) e não
+# guarda estado entre requisições além do cache de ocupação, então várias
+# instâncias podem rodar atrás de um balanceador de carga. A unicidade dos
+# lugares é garantida pelo índice único do MongoDB, não pelo processo.
+#
+# Para rodar:
+#     python servico_reservas.py
+# As variáveis HOST e PORTA definem o endereço (padrão 127.0.0.1:8080) e
+# MONGO_URI o banco, como na interface. Com TOKEN_SERVICO, todas as rotas
+# (exceto /saude) exigem o cabeçalho 'Authorization: Bearer <token>', e o
+# serviço passa a escutar em todas as interfaces (0.0.0.0) por padrão. Com BANCO_ASSINCRONO=1, o banco é
+# acessado pelo 'OnibusAssincrono' (driver motor), sem ocupar uma thread
+# por consulta; caso contrário, pelo 'Onibus', em um conjunto de threads.
+
+import asyncio
+import base64
+import hmac
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import partial
+
+from aiohttp import web
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+
+from reserva_passagens import (MENSAGEM_DATA_INVALIDA, MENSAGEM_LUGAR_INVALIDO,
+                               MENSAGEM_RESERVADO, METRICAS, ROTA_PADRAO, TAMANHO_PAGINA,
+                               TENTATIVAS_CONEXAO, OnibusMedido, conectar_banco,
+                               espera_conexao)
+
+# Quantidade de threads que executam as operações do 'Onibus' (que usam o
+# pymongo, bloqueante) sem bloquear o laço de eventos do serviço.
+TRABALHADORES_SERVICO = 16
+
+# Quantidade máxima de reservas devolvidas por página na pesquisa.
+LIMITE_PAGINA_SERVICO = 1000
+
+rotas = web.RouteTableDef()
+
+
+# Converte para JSON os valores que o módulo json não conhece: os
+# identificadores do MongoDB viram texto e as datas, texto ISO 8601.
+def valor_json(valor):
+    if isinstance(valor, ObjectId):
+        return str(valor)
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    raise TypeError(f"Valor não serializável: {valor!r}")
+
+
+def resposta_json(dados, status=200):
+    return web.json_response(dados, status=status,
+                             dumps=partial(json.dumps, default=valor_json, ensure_ascii=False))
+
+
+# Executa uma operação do banco de dados e aguarda o resultado sem
+# bloquear as demais requisições. As operações do 'OnibusAssincrono' são
+# aguardadas diretamente; as do 'Onibus' rodam em uma thread do serviço.
+async def executar(request, funcao, *args):
+    if request.app["assincrono"]:
+        return await funcao(*args)
+    laco = asyncio.get_running_loop()
+    return await laco.run_in_executor(request.app["executor"], partial(funcao, *args))
+
+
+# Lê um parâmetro obrigatório da URL.
+def parametro(request, nome):
+    valor = request.query.get(nome)
+    if not valor:
+        raise ValueError(f"Parâmetro '{nome}' não informado")
+    return valor
+
+
+def parametro_inteiro(request, nome):
+    try:
+        return int(parametro(request, nome))
+    except ValueError:
+        raise ValueError(f"Parâmetro '{nome}' deve ser um número inteiro")
+
+
+# Lê o corpo JSON da requisição, que deve ser um objeto.
+async def ler_corpo(request):
+    dados = await request.json()
+    if not isinstance(dados, dict):
+        raise ValueError("O corpo da requisição deve ser um objeto JSON")
+    return dados
+
+
+# Converte os filtros recebidos (parâmetros da URL ou corpo JSON) nos
+# filtros de 'Onibus.montar_consulta'.
+def ler_filtros(dados):
+    if not isinstance(dados, dict):
+        raise ValueError("Os filtros devem ser um objeto JSON")
+    filtros = {campo: dados[campo]
+               for campo in ("lugar", "nome", "cpf", "dia", "horario", "rota", "viagem")
+               if dados.get(campo) not in (None, "")}
+    if "lugar" in filtros:
+        try:
+            filtros["lugar"] = int(filtros["lugar"])
+        except ValueError:
+            raise ValueError("Lugar inválido")
+    for campo in ("data_inicial", "data_final"):
+        if dados.get(campo):
+            try:
+                filtros[campo] = date.fromisoformat(dados[campo])
+            except ValueError:
+                raise ValueError(f"Data inválida em '{campo}' (use aaaa-mm-dd)")
+    return filtros
+
+
+# O cursor da pesquisa contém identificadores e datas do MongoDB; é
+# devolvido ao cliente como um texto opaco.
+def codificar_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json_util.dumps(cursor).encode("utf-8")).decode("ascii")
+
+
+def decodificar_cursor(texto):
+    if not texto:
+        return None
+    try:
+        return json_util.loads(base64.urlsafe_b64decode(texto.encode("ascii")))
+    except ValueError:
+        raise ValueError("Cursor inválido")
+
+
+# Converte os erros das operações em respostas JSON: dados inválidos
+# viram 400 e falhas do banco, 503, para que o balanceador possa tentar
+# outra instância.
+@web.middleware
+async def tratar_erros(request, handler):
+    try:
+        return await handler(request)
+    except ValueError as e:
+        return resposta_json({"erro": str(e)}, status=400)
+    except PyMongoError as e:
+        return resposta_json({"erro": f"Falha ao acessar o banco de dados: {e}"}, status=503)
+
+
+# Rotas que não exigem o token: a verificação de saúde do balanceador.
+ROTAS_PUBLICAS = {"/saude"}
+
+
+# Recusa com 401 as requisições sem o token do serviço (TOKEN_SERVICO),
+# pois as rotas expõem nomes e CPFs e permitem cancelar viagens inteiras.
+# Sem token configurado, o serviço só escuta na própria máquina.
+@web.middleware
+async def exigir_token(request, handler):
+    token = request.app.get("token")
+    if token and request.path not in ROTAS_PUBLICAS:
+        autorizacao = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(autorizacao.encode("utf-8"),
+                                   f"Bearer {token}".encode("utf-8")):
+            return resposta_json({"erro": "Token do serviço inválido ou não informado"},
+                                 status=401)
+    return await handler(request)
+
+
+# Verificação de saúde usada pelo balanceador de carga.
+@rotas.get("/saude")
+async def saude(request):
+    onibus = request.app["onibus"]
+    await executar(request, onibus.verificar_conexao)
+    return resposta_json({"status": "ok"})
+
+
+# Métricas das operações no formato de texto do Prometheus.
+@rotas.get("/metricas")
+async def metricas(request):
+    return web.Response(body=METRICAS.exportar_prometheus().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# Habilita ou desabilita a coleta de métricas e, opcionalmente, zera as
+# já coletadas: {"habilitado": true, "limpar": false}
+@rotas.post("/metricas")
+async def configurar_metricas(request):
+    dados = await ler_corpo(request)
+    if "habilitado" in dados:
+        METRICAS.habilitar(bool(dados["habilitado"]))
+    if dados.get("limpar"):
+        METRICAS.limpar()
+    return resposta_json({"habilitado": METRICAS.habilitado})
+
+
+# Rotas cadastradas, com os horários e o veículo de cada horário.
+@rotas.get("/rotas")
+async def listar_rotas(request):
+    onibus = request.app["onibus"]
+    return resposta_json({"rotas": await executar(request, onibus.frota)})
+
+
+# Ocupação de uma viagem: ?rota=&dia=dd/mm/aaaa&horario=hh:mm
+@rotas.get("/ocupacao")
+async def ocupacao(request):
+    onibus = request.app["onibus"]
+    rota = request.query.get("rota", ROTA_PADRAO)
+    dia = parametro(request, "dia")
+    horario = parametro(request, "horario")
+
+    mapa = await executar(request, onibus.consultar_ocupacao, dia, horario, rota)
+    return resposta_json({
+        "viagem": onibus.id_viagem(rota, dia, horario),
+        "capacidade": len(mapa),
+        "ocupados": mapa.ocupados(),
+        "livres": mapa.contar_livres(),
+    })
+
+
+# Ocupação das viagens de uma rota em um período, lida dos resumos:
+# ?rota=&inicio=aaaa-mm-dd&fim=aaaa-mm-dd
+@rotas.get("/resumos")
+async def resumos(request):
+    onibus = request.app["onibus"]
+    rota = request.query.get("rota", ROTA_PADRAO)
+    try:
+        inicio = date.fromisoformat(parametro(request, "inicio"))
+        fim = date.fromisoformat(request.query.get("fim") or inicio.isoformat())
+    except ValueError:
+        raise ValueError("Período inválido (use aaaa-mm-dd)")
+
+    ocupacao = await executar(request, onibus.resumos_periodo, inicio, fim, rota)
+    return resposta_json({"resumos": [
+        {"dia": dia, "horario": horario, "capacidade": len(mapa),
+         "ocupados": mapa.ocupados(), "livres": mapa.contar_livres()}
+        for (dia, horario), mapa in ocupacao.items()
+    ]})
+
+
+# Lugares reservados em cada dia de um mês: ?rota=&ano=&mes=
+@rotas.get("/calendario")
+async def calendario(request):
+    onibus = request.app["onibus"]
+    rota = request.query.get("rota", ROTA_PADRAO)
+    ano = parametro_inteiro(request, "ano")
+    mes = parametro_inteiro(request, "mes")
+    if not 1 <= mes <= 12:
+        raise ValueError("Mês inválido")
+
+    dias = await executar(request, onibus.ocupacao_mes, ano, mes, rota)
+    return resposta_json({"dias": [
+        {"dia": dia, "reservados": reservados, "capacidade": capacidade}
+        for dia, (reservados, capacidade) in dias.items()
+    ]})
+
+
+# Reserva de um lugar. Corpo: {lugar, nome, cpf, dia, horario, rota}.
+# Usa a inserção única de 'reservar_lugar'. Responde 201 quando o lugar
+# foi reservado, 409 quando já estava ocupado ou em atendimento e 400
+# quando o lugar ou a data são inválidos.
+@rotas.post("/reservas")
+async def reservar(request):
+    onibus = request.app["onibus"]
+    dados = await ler_corpo(request)
+    try:
+        lugar = int(dados["lugar"])
+        entrada = (lugar, dados["nome"], dados["cpf"], dados["dia"], dados["horario"],
+                   dados.get("rota") or ROTA_PADRAO)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Informe lugar, nome, cpf, dia e horario")
+
+    mensagem = await executar(request, onibus.reservar_lugar, *entrada)
+    dia, horario = entrada[3], entrada[4]
+    if mensagem in (MENSAGEM_LUGAR_INVALIDO,
+                    MENSAGEM_DATA_INVALIDA.format(dia=dia, horario=horario)):
+        raise ValueError(mensagem)
+
+    reservado = mensagem == MENSAGEM_RESERVADO.format(lugar=lugar, horario=horario)
+    return resposta_json({"reservado": reservado, "mensagem": mensagem},
+                         status=201 if reservado else 409)
+
+
+# Reserva de vários lugares. Corpo: {reservas: [...], tudo_ou_nada}.
+@rotas.post("/reservas/lote")
+async def reservar_lote(request):
+    onibus = request.app["onibus"]
+    dados = await ler_corpo(request)
+    try:
+        entradas = [(int(r["lugar"]), r["nome"], r["cpf"], r["dia"], r["horario"],
+                     r.get("rota") or ROTA_PADRAO)
+                    for r in dados["reservas"]]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Cada reserva deve ter lugar, nome, cpf, dia e horario")
+
+    resultados = await executar(request, onibus.reservar_lugares, entradas,
+                                bool(dados.get("tudo_ou_nada")))
+    return resposta_json({"resultados": [{"reservado": reservado, "mensagem": mensagem}
+                                         for reservado, mensagem in resultados]})
+
+
+# Cancelamento de um lugar: ?rota=&dia=&horario=&lugar=
+@rotas.delete("/reservas")
+async def cancelar(request):
+    onibus = request.app["onibus"]
+    rota = request.query.get("rota", ROTA_PADRAO)
+    dia = parametro(request, "dia")
+    horario = parametro(request, "horario")
+    lugar = parametro_inteiro(request, "lugar")
+
+    cancelado = await executar(request, onibus.remover_reserva, lugar, dia, horario, rota)
+    if cancelado:
+        mensagem = f"Lugar {lugar} reserva cancelada para {horario}"
+    else:
+        mensagem = f"Lugar {lugar} não está reservado para {horario}"
+    return resposta_json({"cancelado": cancelado, "mensagem": mensagem},
+                         status=200 if cancelado else 404)
+
+
+# Cancelamento em lote. Corpo: {filtros: {...}, arquivar}.
+@rotas.post("/reservas/cancelamento")
+async def cancelar_lote(request):
+    onibus = request.app["onibus"]
+    dados = await ler_corpo(request)
+    filtros = ler_filtros(dados.get("filtros", {}))
+
+    cancelados = await executar(request, onibus.cancelar_reservas, filtros,
+                                bool(dados.get("arquivar")))
+    return resposta_json({"cancelados": cancelados})
+
+
+# Reserva de um lugar de uma viagem: ?rota=&dia=&horario=&lugar=
+@rotas.get("/reserva")
+async def buscar(request):
+    onibus = request.app["onibus"]
+    rota = request.query.get("rota", ROTA_PADRAO)
+    reserva = await executar(request, onibus.buscar_reserva,
+                             parametro_inteiro(request, "lugar"),
+                             parametro(request, "dia"), parametro(request, "horario"), rota)
+    return resposta_json({"reserva": reserva})
+
+
+# Pesquisa paginada de reservas. Aceita os filtros da janela de pesquisa
+# (lugar, nome, cpf, dia, horario, rota, data_inicial, data_final), o
+# 'cursor' devolvido pela página anterior e o 'limite' de reservas (de 1
+# a LIMITE_PAGINA_SERVICO).
+@rotas.get("/reservas")
+async def pesquisar(request):
+    onibus = request.app["onibus"]
+    filtros = ler_filtros(request.query)
+    cursor = decodificar_cursor(request.query.get("cursor"))
+    limite = TAMANHO_PAGINA
+    if request.query.get("limite"):
+        limite = parametro_inteiro(request, "limite")
+        if limite < 1:
+            raise ValueError("Parâmetro 'limite' deve ser maior que zero")
+    limite = min(limite, LIMITE_PAGINA_SERVICO)
+
+    reservas, proximo = await executar(request, onibus.pesquisar_reservas, filtros, cursor, limite)
+    return resposta_json({"reservas": reservas, "cursor": codificar_cursor(proximo)})
+
+
+# Conecta ao MongoDB quando o serviço inicia, tentando de novo com espera
+# crescente (veja 'espera_conexao') enquanto o banco não responde. O
+# construtor do 'Onibus' bloqueia enquanto tenta conectar, então roda em
+# uma thread.
+async def iniciar(app):
+    app["executor"] = ThreadPoolExecutor(max_workers=TRABALHADORES_SERVICO,
+                                         thread_name_prefix="servico")
+    app["assincrono"] = os.getenv("BANCO_ASSINCRONO") == "1"
+
+    if not app["assincrono"]:
+        laco = asyncio.get_running_loop()
+        onibus = await laco.run_in_executor(app["executor"], conectar_banco)
+        app["onibus"] = OnibusMedido(onibus)
+        return
+
+    # Importado apenas quando usado, pois depende do pacote motor.
+    from onibus_assincrono import OnibusAssincrono
+    app["onibus"] = OnibusMedido(OnibusAssincrono())
+
+    for tentativa in range(1, TENTATIVAS_CONEXAO + 1):
+        try:
+            await app["onibus"].preparar()
+            return
+        except PyMongoError as e:
+            if tentativa == TENTATIVAS_CONEXAO:
+                raise
+            espera = espera_conexao(tentativa)
+            print(f"Tentativa {tentativa} de {TENTATIVAS_CONEXAO} falhou ({e}). "
+                  f"Tentando novamente em {espera:.0f} segundos...")
+            await asyncio.sleep(espera)
+
+
+async def encerrar(app):
+    app["onibus"].cliente.close()
+    app["executor"].shutdown(wait=False)
+
+
+def criar_aplicacao():
+    app = web.Application(middlewares=[exigir_token, tratar_erros])
+    app["token"] = os.getenv("TOKEN_SERVICO")
+    app.add_routes(rotas)
+    app.on_startup.append(iniciar)
+    app.on_cleanup.append(encerrar)
+    return app
+
+
+if __name__ == "__main__":
+    # Sem token, apenas a própria máquina pode acessar o serviço.
+    host_padrao = "0.0.0.0" if os.getenv("TOKEN_SERVICO") else "127.0.0.1"
+    host = os.getenv("HOST", host_padrao)
+    if not os.getenv("TOKEN_SERVICO") and host not in ("127.0.0.1", "localhost", "::1"):
+        print(f"Atenção: serviço escutando em {host} sem TOKEN_SERVICO; "
+              "qualquer um que alcance a porta pode consultar e cancelar reservas.")
+    web.run_app(criar_aplicacao(),
+                host=host,
+                port=int(os.getenv("PORTA", "8080")))
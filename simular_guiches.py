@@ -0,0 +1,403 @@
+# Simulação de muitos guichês vendendo as mesmas viagens ao mesmo tempo.
+#
+# Cada guichê simulado tem seu próprio objeto 'onibus' (como cada terminal
+# real) e repete, durante '--duracao' segundos, uma mistura configurável
+# de operações: consultar o mapa de uma viagem, reservar um lugar que o
+# mapa mostrou livre (possivelmente já vendido por outro guichê) e
+# cancelar uma reserva feita por ele. Todos disputam as mesmas poucas
+# viagens, o que provoca os conflitos que só aparecem com muitos guichês.
+#
+# Os guichês podem ser threads, processos ou tarefas asyncio (estas usam o
+# 'OnibusAssincrono' e exigem o MongoDB). No fim, a simulação informa a
+# vazão, os percentis de latência, a taxa de conflitos e confere o banco:
+# nenhum lugar pode ter sido vendido duas vezes, as reservas gravadas
+# devem ser exatamente as que os guichês acreditam ter vendido e os
+# resumos das viagens devem bater com as reservas. Termina com erro se
+# alguma dessas conferências falhar.
+#
+# Para rodar (o MongoDB de MONGO_URI, no banco '--nome-banco', apagado no
+# início e no fim, ou um arquivo SQLite temporário com '--banco local'):
+#     python simular_guiches.py --guiches 50 --modo processos --duracao 30
+#     python simular_guiches.py --banco local --guiches 20 --mistura reservar=6,cancelar=2,consultar=2
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from benchmark_reservas import (BANCO_BENCHMARK, CargaReservas, abrir_onibus,
+                                resumir_tempos)
+from reserva_passagens import FORMATO_DATA, MENSAGEM_RESERVADO, ROTA_PADRAO, Onibus, OnibusLocal
+
+# Quantidade de guichês, duração (em segundos) e quantidade de viagens
+# disputadas, com a capacidade de cada uma.
+GUICHES_PADRAO = 20
+DURACAO_SIMULACAO = 20
+VIAGENS_SIMULACAO = 2
+CAPACIDADE_SIMULACAO = 40
+
+# Peso de cada operação na mistura sorteada pelos guichês.
+MISTURA_PADRAO = {"reservar": 5, "cancelar": 2, "consultar": 3}
+
+# Tempo (em segundos) dado aos guichês para se conectarem antes que todos
+# comecem juntos.
+ESPERA_INICIO_SIMULACAO = 3
+
+
+# Define a classe 'Guiche', que decide as operações de um guichê simulado
+# e registra seus resultados. 'roteiro' é um gerador: cada passo produz
+# (operação, método do 'onibus', argumentos) e recebe o resultado da
+# chamada (ou a exceção lançada), então o mesmo roteiro é executado por
+# threads, processos e tarefas asyncio.
+class Guiche:
+
+    def __init__(self, numero, viagens, capacidade, mistura, bloquear, semente):
+        self.sorteio = random.Random(semente * 1000 + numero)
+        self.viagens = viagens
+        self.capacidade = capacidade
+        self.operacoes = list(mistura)
+        self.pesos = [mistura[operacao] for operacao in self.operacoes]
+        self.bloquear = bloquear
+
+        # Lugares ocupados de cada viagem no último mapa consultado, e
+        # lugares (dia, horário, lugar) vendidos por este guichê.
+        self.vistos = {}
+        self.vendidos = set()
+
+        self.tempos = {"consultar": [], "bloquear": [], "reservar": [], "cancelar": []}
+        self.contagem = {"tentativas": 0, "confirmadas": 0, "conflitos": 0,
+                         "bloqueios_recusados": 0, "viagens_lotadas": 0,
+                         "cancelamentos": 0, "cancelamentos_perdidos": 0, "erros": 0}
+
+    def roteiro(self):
+        while True:
+            operacao = self.sorteio.choices(self.operacoes, self.pesos)[0]
+            dia, horario = self.sorteio.choice(self.viagens)
+
+            if operacao == "cancelar" and self.vendidos:
+                dia, horario, lugar = self.sorteio.choice(sorted(self.vendidos))
+                resultado = yield "cancelar", "cancelar_reserva", (lugar, dia, horario, ROTA_PADRAO)
+                if self.falhou(resultado):
+                    continue
+                self.vendidos.discard((dia, horario, lugar))
+                if resultado.startswith(f"Lugar {lugar} reserva cancelada"):
+                    self.contagem["cancelamentos"] += 1
+                    self.vistos.get((dia, horario), set()).discard(lugar)
+                else:
+                    # Ninguém cancela as reservas dos outros guichês.
+                    self.contagem["cancelamentos_perdidos"] += 1
+                continue
+
+            # O atendente olha o mapa antes de escolher o lugar.
+            livres = [lugar for lugar in range(1, self.capacidade + 1)
+                      if lugar not in self.vistos.get((dia, horario), ())]
+            if operacao != "reservar" or not livres:
+                if operacao == "reservar":
+                    self.contagem["viagens_lotadas"] += 1
+                # Lê a ocupação do banco, sem o cache de ocupação do guichê
+                # (que só é invalidado pelas gravações do próprio guichê), para
+                # que a consulta meça uma leitura real e o mapa não fique velho.
+                ocupados = yield "consultar", "lugares_ocupados", (dia, horario, ROTA_PADRAO)
+                if not self.falhou(ocupados):
+                    self.vistos[(dia, horario)] = set(ocupados)
+                continue
+
+            lugar = self.sorteio.choice(livres)
+            self.contagem["tentativas"] += 1
+
+            # Com '--bloquear', o lugar é bloqueado antes da reserva, como
+            # no clique da JanelaPrincipal.
+            if self.bloquear:
+                bloqueado = yield "bloquear", "bloquear_lugar", (lugar, dia, horario, ROTA_PADRAO)
+                if self.falhou(bloqueado):
+                    continue
+                if not bloqueado:
+                    self.contagem["bloqueios_recusados"] += 1
+                    self.vistos.setdefault((dia, horario), set()).add(lugar)
+                    continue
+
+            resultado = yield "reservar", "reservar_lugar", (
+                lugar, f"Guichê {self.sorteio.random():.6f}", "00000000000", dia, horario,
+                ROTA_PADRAO)
+            if self.falhou(resultado):
+                continue
+            self.vistos.setdefault((dia, horario), set()).add(lugar)
+            if resultado == MENSAGEM_RESERVADO.format(lugar=lugar, horario=horario):
+                self.contagem["confirmadas"] += 1
+                self.vendidos.add((dia, horario, lugar))
+            else:
+                self.contagem["conflitos"] += 1
+
+    def falhou(self, resultado):
+        if isinstance(resultado, Exception):
+            self.contagem["erros"] += 1
+            return True
+        return False
+
+    def relatorio(self):
+        return {"tempos": self.tempos, "contagem": self.contagem,
+                "vendidos": sorted(self.vendidos)}
+
+
+# Espera até o instante combinado para o início da simulação.
+def aguardar_inicio(inicio):
+    time.sleep(max(0.0, inicio - time.time()))
+
+
+# Define a função 'executar_guiche', que executa um guichê em uma thread ou
+# em um processo e retorna seu relatório.
+def executar_guiche(parametros):
+
+    if parametros["banco"] == "local":
+        onibus = OnibusLocal(parametros["caminho"])
+    else:
+        onibus = Onibus()
+
+    guiche = Guiche(parametros["numero"], parametros["viagens"], parametros["capacidade"],
+                    parametros["mistura"], parametros["bloquear"], parametros["semente"])
+    passos = guiche.roteiro()
+    operacao, metodo, argumentos = next(passos)
+
+    aguardar_inicio(parametros["inicio"])
+    fim = parametros["inicio"] + parametros["duracao"]
+
+    while time.time() < fim:
+        inicio = time.perf_counter()
+        try:
+            resultado = getattr(onibus, metodo)(*argumentos)
+        except Exception as e:
+            resultado = e
+        guiche.tempos[operacao].append(time.perf_counter() - inicio)
+        operacao, metodo, argumentos = passos.send(resultado)
+
+    return guiche.relatorio()
+
+
+# Define a função 'executar_guiche_assincrono', que executa o mesmo roteiro
+# em uma tarefa asyncio, com o 'OnibusAssincrono'.
+async def executar_guiche_assincrono(parametros):
+
+    # Importado apenas aqui, pois depende do pacote motor.
+    from onibus_assincrono import OnibusAssincrono
+
+    onibus = OnibusAssincrono()
+    await onibus.preparar()
+
+    guiche = Guiche(parametros["numero"], parametros["viagens"], parametros["capacidade"],
+                    parametros["mistura"], parametros["bloquear"], parametros["semente"])
+    passos = guiche.roteiro()
+    operacao, metodo, argumentos = next(passos)
+
+    await asyncio.sleep(max(0.0, parametros["inicio"] - time.time()))
+    fim = parametros["inicio"] + parametros["duracao"]
+
+    try:
+        while time.time() < fim:
+            inicio = time.perf_counter()
+            try:
+                resultado = await getattr(onibus, metodo)(*argumentos)
+            except Exception as e:
+                resultado = e
+            guiche.tempos[operacao].append(time.perf_counter() - inicio)
+            operacao, metodo, argumentos = passos.send(resultado)
+    finally:
+        onibus.cliente.close()
+
+    return guiche.relatorio()
+
+
+async def executar_tarefas(lista_parametros):
+    return await asyncio.gather(*(executar_guiche_assincrono(parametros)
+                                  for parametros in lista_parametros))
+
+
+# Define a função 'conferir_banco', que compara as reservas gravadas em
+# cada viagem com os lugares que os guichês acreditam ter vendido e com os
+# resumos das viagens.
+def conferir_banco(onibus, viagens, relatorios):
+
+    vendidos = {}
+    vendidos_duas_vezes = []
+    for relatorio in relatorios:
+        for dia, horario, lugar in relatorio["vendidos"]:
+            chave = (dia, horario, lugar)
+            if chave in vendidos:
+                vendidos_duas_vezes.append(chave)
+            vendidos[chave] = True
+
+    gravados = {}
+    for dia, horario in viagens:
+        cursor = None
+        while True:
+            reservas, cursor = onibus.pesquisar_reservas(
+                {"viagem": onibus.id_viagem(ROTA_PADRAO, dia, horario)}, cursor)
+            for reserva in reservas:
+                chave = (dia, horario, reserva["lugar"])
+                if chave in gravados:
+                    vendidos_duas_vezes.append(chave)
+                gravados[chave] = True
+            if cursor is None:
+                break
+
+    # Lugares vendidos por um guichê sem reserva gravada, ou gravados sem
+    # que nenhum guichê os tenha vendido.
+    divergencias = sorted(set(vendidos) ^ set(gravados))
+
+    resumos_divergentes = []
+    for dia, horario in viagens:
+        data = datetime.strptime(dia, FORMATO_DATA).date()
+        resumo = onibus.resumos_periodo(data, data, ROTA_PADRAO).get((dia, horario))
+        no_resumo = set(resumo.ocupados()) if resumo else set()
+        nas_reservas = {lugar for d, h, lugar in gravados if (d, h) == (dia, horario)}
+        if no_resumo != nas_reservas:
+            resumos_divergentes.append([dia, horario])
+
+    return {
+        "lugares_gravados": len(gravados),
+        "vendidos_duas_vezes": [list(chave) for chave in vendidos_duas_vezes],
+        "divergencias": [list(chave) for chave in divergencias],
+        "resumos_divergentes": resumos_divergentes,
+    }
+
+
+def executar(argumentos):
+
+    onibus, apagar = abrir_onibus(argumentos)
+    carga = CargaReservas(argumentos.capacidade, 1)
+    viagens = [carga.viagem(t) for t in range(argumentos.viagens)]
+
+    inicio = time.time() + ESPERA_INICIO_SIMULACAO
+    lista_parametros = [{
+        "numero": numero,
+        "banco": argumentos.banco,
+        "caminho": getattr(onibus, "caminho", None),
+        "viagens": viagens,
+        "capacidade": argumentos.capacidade,
+        "mistura": argumentos.mistura,
+        "bloquear": argumentos.bloquear,
+        "semente": argumentos.semente,
+        "inicio": inicio,
+        "duracao": argumentos.duracao,
+    } for numero in range(argumentos.guiches)]
+
+    try:
+        print(f"Simulando {argumentos.guiches} guichês ({argumentos.modo}) "
+              f"por {argumentos.duracao} segundos...")
+
+        if argumentos.modo == "asyncio":
+            relatorios = asyncio.run(executar_tarefas(lista_parametros))
+        else:
+            classe = ThreadPoolExecutor if argumentos.modo == "threads" else ProcessPoolExecutor
+            with classe(max_workers=argumentos.guiches) as executor:
+                relatorios = list(executor.map(executar_guiche, lista_parametros))
+
+        resultado = {
+            "gerado_em": datetime.now().isoformat(timespec="seconds"),
+            "parametros": {
+                "banco": argumentos.banco,
+                "modo": argumentos.modo,
+                "guiches": argumentos.guiches,
+                "duracao": argumentos.duracao,
+                "viagens": argumentos.viagens,
+                "capacidade": argumentos.capacidade,
+                "mistura": argumentos.mistura,
+                "bloquear": argumentos.bloquear,
+            },
+        }
+
+        contagem = {}
+        tempos = {}
+        for relatorio in relatorios:
+            for nome, valor in relatorio["contagem"].items():
+                contagem[nome] = contagem.get(nome, 0) + valor
+            for operacao, lista in relatorio["tempos"].items():
+                tempos.setdefault(operacao, []).extend(lista)
+
+        total = sum(len(lista) for lista in tempos.values())
+        resultado["operacoes_por_segundo"] = round(total / argumentos.duracao, 1)
+        resultado["operacoes"] = {operacao: resumir_tempos(lista)
+                                  for operacao, lista in tempos.items() if lista}
+        resultado["contagem"] = contagem
+        resultado["taxa_conflito"] = (round(contagem["conflitos"] / contagem["tentativas"], 4)
+                                      if contagem["tentativas"] else 0)
+        resultado["conferencia"] = conferir_banco(onibus, viagens, relatorios)
+
+    finally:
+        if not argumentos.manter:
+            apagar()
+
+    print(f"Operações por segundo: {resultado['operacoes_por_segundo']}")
+    for operacao, resumo in resultado["operacoes"].items():
+        print(f"  {operacao:<10} p50 {resumo['p50_ms']:9.3f} ms  p99 {resumo['p99_ms']:9.3f} ms  "
+              f"({resumo['medicoes']} medições)")
+    print(f"Reservas: {contagem['confirmadas']} confirmadas de {contagem['tentativas']} "
+          f"tentativas; {contagem['conflitos']} conflitos ({resultado['taxa_conflito']:.1%}), "
+          f"{contagem['bloqueios_recusados']} bloqueios recusados; "
+          f"{contagem['cancelamentos']} cancelamentos; {contagem['erros']} erros.")
+
+    conferencia = resultado["conferencia"]
+    print(f"Lugares vendidos duas vezes: {len(conferencia['vendidos_duas_vezes'])}; "
+          f"divergências: {len(conferencia['divergencias'])}; "
+          f"resumos divergentes: {len(conferencia['resumos_divergentes'])}")
+
+    if argumentos.saida:
+        with open(argumentos.saida, "w", encoding="utf-8") as arquivo:
+            json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+        print(f"Resultado gravado em {argumentos.saida}")
+
+    # Operações que levantaram exceções também reprovam a simulação: os
+    # números de uma execução com erros não medem o que se queria medir.
+    falhou = (conferencia["vendidos_duas_vezes"] or conferencia["divergencias"]
+              or conferencia["resumos_divergentes"] or contagem["cancelamentos_perdidos"]
+              or contagem["erros"])
+    return 1 if falhou else 0
+
+
+# Converte 'reservar=5,cancelar=2,consultar=3' no dicionário de pesos.
+def ler_mistura(texto):
+    mistura = {}
+    for parte in texto.split(","):
+        operacao, _, peso = parte.partition("=")
+        if operacao.strip() not in MISTURA_PADRAO:
+            raise argparse.ArgumentTypeError(f"Operação desconhecida: {operacao}")
+        mistura[operacao.strip()] = float(peso)
+    return mistura
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Simula muitos guichês reservando as mesmas viagens ao mesmo tempo.")
+    parser.add_argument("--banco", choices=["mongo", "local"], default="mongo",
+                        help="MongoDB de MONGO_URI ou arquivo SQLite temporário")
+    parser.add_argument("--nome-banco", default=BANCO_BENCHMARK,
+                        help="banco do MongoDB usado (apagado no início e no fim)")
+    parser.add_argument("--modo", choices=["threads", "processos", "asyncio"], default="threads")
+    parser.add_argument("--guiches", type=int, default=GUICHES_PADRAO)
+    parser.add_argument("--duracao", type=float, default=DURACAO_SIMULACAO)
+    parser.add_argument("--viagens", type=int, default=VIAGENS_SIMULACAO,
+                        help="quantidade de viagens disputadas pelos guichês")
+    parser.add_argument("--capacidade", type=int, default=CAPACIDADE_SIMULACAO)
+    parser.add_argument("--mistura", type=ler_mistura, default=MISTURA_PADRAO,
+                        help="pesos das operações, como reservar=5,cancelar=2,consultar=3")
+    parser.add_argument("--bloquear", action="store_true",
+                        help="bloqueia o lugar antes de reservá-lo (somente MongoDB, "
+                             "com threads ou processos)")
+    parser.add_argument("--semente", type=int, default=1)
+    parser.add_argument("--manter", action="store_true",
+                        help="não apaga o banco da simulação no fim")
+    parser.add_argument("--saida", help="arquivo JSON com o resultado")
+    argumentos = parser.parse_args()
+
+    if argumentos.modo == "asyncio" and argumentos.banco != "mongo":
+        sys.exit("O modo asyncio usa o OnibusAssincrono e exige o MongoDB.")
+    if argumentos.bloquear and argumentos.banco != "mongo":
+        sys.exit("O banco local não bloqueia lugares; use --bloquear com o MongoDB.")
+    if argumentos.bloquear and argumentos.modo == "asyncio":
+        sys.exit("O OnibusAssincrono não bloqueia lugares; use --bloquear com threads ou processos.")
+
+    sys.exit(executar(argumentos))
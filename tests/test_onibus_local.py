@@ -0,0 +1,267 @@
+# Testes do contrato do repositório de reservas sobre o 'OnibusLocal'
+# (SQLite em um arquivo temporário), que dispensam o MongoDB, e do envio do
+# diário local do 'OnibusSincronizado' a um servidor falso.
+#
+# Para rodar, na pasta do projeto:
+#     python -m pytest tests
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+from reserva_passagens import DiarioReservas, OnibusLocal, OnibusSincronizado
+
+DIA = "20/12/2030"
+OUTRO_DIA = "21/12/2030"
+HORARIO = "08:00"
+
+
+class TesteOnibusLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.pasta = tempfile.mkdtemp()
+        self.onibus = OnibusLocal(os.path.join(self.pasta, "reservas.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.pasta, ignore_errors=True)
+
+    def ocupados(self, dia=DIA, horario=HORARIO):
+        return self.onibus.lugares_ocupados(dia, horario)
+
+    def test_reserva_dupla_recusada(self):
+        self.assertEqual(self.onibus.reservar_lugar(1, "Ana", "111", DIA, HORARIO),
+                         f"Lugar 1 reservado com sucesso para {HORARIO}")
+        self.assertEqual(self.onibus.reservar_lugar(1, "Bia", "222", DIA, HORARIO),
+                         f"Lugar 1 indisponível para {HORARIO}")
+        self.assertEqual(self.onibus.buscar_reserva(1, DIA, HORARIO)["nome"], "Ana")
+
+    def test_reserva_dupla_no_mesmo_lote(self):
+        resultados = self.onibus.reservar_lugares([(2, "Ana", "111", DIA, HORARIO),
+                                                   (2, "Bia", "222", DIA, HORARIO)])
+        self.assertEqual([reservado for reservado, _ in resultados], [True, False])
+        self.assertEqual(self.ocupados(), {2})
+
+    def test_lugar_invalido(self):
+        capacidade = self.onibus.capacidade_viagem("PADRAO", HORARIO)
+        for lugar in (0, capacidade + 1):
+            self.assertEqual(self.onibus.reservar_lugar(lugar, "Ana", "111", DIA, HORARIO),
+                             "Lugar inválido")
+        self.assertEqual(self.ocupados(), set())
+
+    def test_tudo_ou_nada_desfaz_o_grupo(self):
+        self.onibus.reservar_lugar(2, "Ana", "111", DIA, HORARIO)
+
+        resultados = self.onibus.reservar_lugares([(1, "Bia", "222", DIA, HORARIO),
+                                                   (2, "Caio", "333", DIA, HORARIO),
+                                                   (3, "Davi", "444", DIA, HORARIO)],
+                                                  tudo_ou_nada=True)
+
+        self.assertFalse(any(reservado for reservado, _ in resultados))
+        self.assertEqual(self.ocupados(), {2})
+
+    def test_cancelar_reservas_com_arquivo(self):
+        self.onibus.reservar_lugares([(lugar, f"Passageiro {lugar}", str(lugar), DIA, HORARIO)
+                                      for lugar in (1, 2, 3)])
+        self.onibus.reservar_lugar(1, "Outra Viagem", "999", OUTRO_DIA, HORARIO)
+
+        viagem = self.onibus.id_viagem("PADRAO", DIA, HORARIO)
+        self.assertEqual(self.onibus.cancelar_reservas({"viagem": viagem}, arquivar=True), 3)
+
+        self.assertEqual(self.ocupados(), set())
+        self.assertEqual(self.ocupados(OUTRO_DIA), {1})
+        arquivadas = self.onibus.conexao().execute(
+            "SELECT lugar, cancelada_em FROM reservas_canceladas ORDER BY lugar").fetchall()
+        self.assertEqual([linha["lugar"] for linha in arquivadas], [1, 2, 3])
+        self.assertTrue(all(linha["cancelada_em"] for linha in arquivadas))
+
+    def test_cancelar_reservas_sem_filtro(self):
+        self.onibus.reservar_lugar(1, "Ana", "111", DIA, HORARIO)
+        with self.assertRaises(ValueError):
+            self.onibus.cancelar_reservas({})
+        self.assertEqual(self.ocupados(), {1})
+
+    def test_paginas_cobrem_todas_as_reservas(self):
+        esperadas = set()
+        for dia in (DIA, OUTRO_DIA):
+            for lugar in range(1, 8):
+                self.onibus.reservar_lugar(lugar, f"Silva {lugar}", str(lugar), dia, HORARIO)
+                esperadas.add((dia, lugar))
+
+        for filtros in ({}, {"nome": "silva"},
+                        {"data_inicial": date(2030, 12, 20), "data_final": date(2030, 12, 21)}):
+            for limite in (1, 3, 13, 14, 15, 100):
+                with self.subTest(filtros=filtros, limite=limite):
+                    lidas = []
+                    cursor = None
+                    while True:
+                        reservas, cursor = self.onibus.pesquisar_reservas(filtros, cursor, limite)
+                        self.assertLessEqual(len(reservas), limite)
+                        lidas += [(r["dia"], r["lugar"]) for r in reservas]
+                        if cursor is None:
+                            break
+
+                    self.assertEqual(len(lidas), len(esperadas))
+                    self.assertEqual(set(lidas), esperadas)
+
+    def test_limite_invalido(self):
+        for limite in (0, -1):
+            with self.subTest(limite=limite), self.assertRaises(ValueError):
+                self.onibus.pesquisar_reservas({}, limite=limite)
+
+    def test_limite_exato_nao_devolve_cursor(self):
+        for lugar in (1, 2):
+            self.onibus.reservar_lugar(lugar, "Ana", "111", DIA, HORARIO)
+        reservas, cursor = self.onibus.pesquisar_reservas({}, limite=2)
+        self.assertEqual(len(reservas), 2)
+        self.assertIsNone(cursor)
+
+
+# Servidor falso para o 'OnibusSincronizado': repassa as operações a um
+# 'OnibusLocal' e, com 'sem_conexao', recusa as que acessam o banco como
+# uma queda de rede. As entradas com lugar em 'lugares_recusados' são
+# recusadas com um erro que não é de conexão.
+class ServidorFalso:
+
+    LOCAIS = {"id_viagem", "partida_viagem", "capacidade_viagem", "horarios_rota",
+              "veiculo_viagem", "listar_rotas", "cache_ocupacao"}
+
+    def __init__(self, onibus):
+        self.onibus = onibus
+        self.sem_conexao = False
+        self.lugares_recusados = set()
+
+    def __getattr__(self, nome):
+        atributo = getattr(self.onibus, nome)
+        if nome in self.LOCAIS:
+            return atributo
+
+        def operacao(*args, **kwargs):
+            if self.sem_conexao:
+                raise ConnectionError("servidor fora do ar")
+            return atributo(*args, **kwargs)
+        return operacao
+
+    def reservar_lugares(self, entradas, tudo_ou_nada=False):
+        if self.sem_conexao:
+            raise ConnectionError("servidor fora do ar")
+        if any(entrada[0] in self.lugares_recusados for entrada in entradas):
+            raise ValueError("Rota alterada no servidor")
+        return self.onibus.reservar_lugares(entradas, tudo_ou_nada)
+
+
+class TesteDiarioSincronizado(unittest.TestCase):
+
+    def setUp(self):
+        self.pasta = tempfile.mkdtemp()
+        self.servidor = OnibusLocal(os.path.join(self.pasta, "servidor.db"))
+        self.remoto = ServidorFalso(self.servidor)
+        # O intervalo longo deixa o envio do diário por conta do teste.
+        self.guiche = OnibusSincronizado(self.remoto, os.path.join(self.pasta, "diario.db"),
+                                         intervalo=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.pasta, ignore_errors=True)
+
+    def no_servidor(self):
+        return self.servidor.lugares_ocupados(DIA, HORARIO)
+
+    # Como o guichê faz ao exibir uma reserva: carrega o mapa da viagem e
+    # consulta o passageiro do lugar.
+    def abrir_lugar(self, lugar):
+        self.guiche.consultar_ocupacao(DIA, HORARIO)
+        self.guiche.buscar_reserva(lugar, DIA, HORARIO)
+
+    def test_reservas_sem_conexao_sao_enviadas(self):
+        self.remoto.sem_conexao = True
+        self.guiche.reservar_lugar(1, "Ana", "111", DIA, HORARIO)
+        self.guiche.reservar_lugar(2, "Bia", "222", DIA, HORARIO)
+        self.assertEqual(self.no_servidor(), set())
+        self.assertEqual(self.guiche.lugares_ocupados(DIA, HORARIO), {1, 2})
+
+        self.remoto.sem_conexao = False
+        self.guiche.enviar_diario()
+
+        self.assertEqual(self.no_servidor(), {1, 2})
+        self.assertEqual(self.guiche.situacao_sincronizacao()["pendentes"], 0)
+        self.assertEqual(self.guiche.conflitos(), [])
+
+    def test_reserva_vendida_por_outro_guiche_vira_conflito(self):
+        self.remoto.sem_conexao = True
+        self.guiche.reservar_lugar(1, "Ana", "111", DIA, HORARIO)
+        self.servidor.reservar_lugar(1, "Bia", "222", DIA, HORARIO)
+
+        self.remoto.sem_conexao = False
+        self.guiche.enviar_diario()
+
+        self.assertEqual(self.servidor.buscar_reserva(1, DIA, HORARIO)["nome"], "Bia")
+        self.assertEqual([c["lugar"] for c in self.guiche.conflitos()], [1])
+
+    def test_cancelamento_do_mesmo_passageiro_e_enviado(self):
+        self.guiche.reservar_lugar(1, "Ana", "111", DIA, HORARIO)
+        self.abrir_lugar(1)
+
+        self.remoto.sem_conexao = True
+        self.guiche.cancelar_reserva(1, DIA, HORARIO)
+
+        self.remoto.sem_conexao = False
+        self.guiche.enviar_diario()
+
+        self.assertEqual(self.no_servidor(), set())
+        self.assertEqual(self.guiche.conflitos(), [])
+
+    def test_cancelamento_de_lugar_revendido_vira_conflito(self):
+        self.guiche.reservar_lugar(1, "Ana", "111", DIA, HORARIO)
+        self.abrir_lugar(1)
+
+        self.remoto.sem_conexao = True
+        self.guiche.cancelar_reserva(1, DIA, HORARIO)
+
+        # Outro guichê cancela e vende o lugar a outro passageiro.
+        self.servidor.cancelar_reserva(1, DIA, HORARIO)
+        self.servidor.reservar_lugar(1, "Bia", "222", DIA, HORARIO)
+
+        self.remoto.sem_conexao = False
+        self.guiche.enviar_diario()
+
+        self.assertEqual(self.servidor.buscar_reserva(1, DIA, HORARIO)["nome"], "Bia")
+        conflitos = self.guiche.conflitos()
+        self.assertEqual([(c["operacao"], c["lugar"]) for c in conflitos], [("cancelamento", 1)])
+
+    def test_cancelamento_de_passageiro_desconhecido_vira_conflito(self):
+        self.servidor.reservar_lugar(1, "Ana", "111", DIA, HORARIO)
+        self.guiche.consultar_ocupacao(DIA, HORARIO)
+
+        self.remoto.sem_conexao = True
+        self.guiche.cancelar_reserva(1, DIA, HORARIO)
+
+        self.remoto.sem_conexao = False
+        self.guiche.enviar_diario()
+
+        self.assertEqual(self.no_servidor(), {1})
+        self.assertEqual([c["operacao"] for c in self.guiche.conflitos()], ["cancelamento"])
+
+    def test_operacao_recusada_nao_trava_o_diario(self):
+        self.remoto.sem_conexao = True
+        self.guiche.reservar_lugar(1, "Ana", "111", DIA, HORARIO)
+        self.guiche.reservar_lugar(2, "Bia", "222", DIA, HORARIO)
+
+        self.remoto.sem_conexao = False
+        self.remoto.lugares_recusados = {1}
+        self.guiche.enviar_diario()
+
+        self.assertEqual(self.no_servidor(), {2})
+        self.assertEqual([c["lugar"] for c in self.guiche.conflitos()], [1])
+        self.assertFalse(self.guiche.diario.tem_pendentes())
+
+    def test_diario_sobrevive_a_reabertura(self):
+        self.remoto.sem_conexao = True
+        self.guiche.reservar_lugar(3, "Ana", "111", DIA, HORARIO)
+
+        diario = DiarioReservas(os.path.join(self.pasta, "diario.db"))
+        self.assertEqual([operacao["lugar"] for operacao in diario.pendentes(10)], [3])
+
+
+if __name__ == "__main__":
+    unittest.main()